@@ -0,0 +1,340 @@
+"""
+Synthetic inputs for the benchmarks: structures and SNLs of any size, and
+VASP run directories (vasp.out, OUTCAR, vasprun.xml, FW.json, ...) laid out
+the way a finished VaspCustodianTask leaves them. Everything is generated
+from a seed, so two runs of the suite see exactly the same data.
+"""
+
+import json
+import math
+import os
+import random
+from pymatgen import Structure, Lattice
+from pymatgen.io.vaspio.vasp_input import Incar, Poscar, Kpoints
+from pymatgen.matproj.snl import StructureNL
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 30, 2013'
+
+# prototypes: (lattice constant, species slots, frac coords); slots are
+# filled with cations ('A', 'B') and anions ('X')
+PROTOTYPES = {
+    'rocksalt': (4.2, ['A', 'A', 'A', 'A', 'X', 'X', 'X', 'X'],
+                 [[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5],
+                  [0.5, 0, 0], [0, 0.5, 0], [0, 0, 0.5], [0.5, 0.5, 0.5]]),
+    'perovskite': (3.9, ['A', 'B', 'X', 'X', 'X'],
+                   [[0, 0, 0], [0.5, 0.5, 0.5], [0.5, 0.5, 0], [0.5, 0, 0.5],
+                    [0, 0.5, 0.5]]),
+    'cscl': (3.4, ['A', 'X'], [[0, 0, 0], [0.5, 0.5, 0.5]]),
+    'fluorite': (5.4, ['A', 'A', 'A', 'A', 'X', 'X', 'X', 'X', 'X', 'X', 'X', 'X'],
+                 [[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5],
+                  [0.25, 0.25, 0.25], [0.75, 0.25, 0.25], [0.25, 0.75, 0.25],
+                  [0.25, 0.25, 0.75], [0.75, 0.75, 0.25], [0.75, 0.25, 0.75],
+                  [0.25, 0.75, 0.75], [0.75, 0.75, 0.75]])}
+# no +U elements, so the workflows have a single relaxation branch
+CATIONS = ['Li', 'Na', 'K', 'Mg', 'Ca', 'Sr', 'Ba', 'Al', 'Ga', 'Zn', 'Ti', 'Zr']
+ANIONS = ['O', 'S', 'Se', 'F', 'Cl', 'N']
+
+# lines of the files the signal detectors grep through
+VASP_OUT_LINES = [
+    'DAV:   {:>3d}    -0.{:08d}E+02   -0.27911E+01   -0.54105E+03  4624   0.123E+03',
+    'RMM:   {:>3d}    -0.{:08d}E+02   -0.16357E-03   -0.10548E-03  4464   0.541E-02    0.161E-01']
+# scheduler error file of a run that spews warnings
+ERROR_LINES = [
+    'forrtl: warning (402): fort: (1): In call to DGEMM, an array temporary was created {} {}',
+    'WARNING: CNORMN: search vector ill defined, step {} of {}']
+OUTCAR_LINES = [
+    ' --------------------------------------- Iteration {:>6d}(   1)  ---------------------------------------',
+    '   free energy    TOTEN  =       -{:>12d}.37811282 eV',
+    '   POTLOK:  cpu time    0.1600: real time    0.1621',
+    '   SETDIJ:  cpu time    0.0100: real time    0.0095']
+
+
+def get_structure(prototype='rocksalt', supercell=1, seed=0, perturb=0.0):
+    """
+    :param prototype: (str) a key of PROTOTYPES
+    :param supercell: (int) repetitions along a, i.e. nsites scales linearly
+    :param seed: (int) picks the elements
+    :param perturb: (float) max random displacement of each site (fractional)
+    :return: (Structure)
+    """
+    rng = random.Random(seed)
+    a, slots, coords = PROTOTYPES[prototype]
+    cations = rng.sample(CATIONS, 2)
+    anion = rng.choice(ANIONS)
+    fill = {'A': cations[0], 'B': cations[1], 'X': anion}
+
+    lattice = Lattice([[a * supercell, 0, 0], [0, a, 0], [0, 0, a]])
+    species, frac_coords = [], []
+    for i in range(supercell):
+        for slot, c in zip(slots, coords):
+            species.append(fill[slot])
+            frac_coords.append([(c[0] + i) / float(supercell) + rng.uniform(-perturb, perturb),
+                                c[1] + rng.uniform(-perturb, perturb),
+                                c[2] + rng.uniform(-perturb, perturb)])
+    return Structure(lattice, species, frac_coords)
+
+
+def get_snl_set(n_snl, max_supercell=2, dupe_fraction=0.3, seed=0):
+    """
+    SNLs of random compositions and prototypes. A dupe_fraction of them are
+    slightly perturbed copies of earlier ones, so that grouping them does
+    real structure matching.
+
+    :return: ([StructureNL])
+    """
+    rng = random.Random(seed)
+    snls = []
+    for i in range(n_snl):
+        if snls and rng.random() < dupe_fraction:
+            structure = snls[rng.randrange(len(snls))].structure
+            structure = Structure(structure.lattice, structure.species,
+                                  [[x + rng.uniform(-0.002, 0.002) for x in site.frac_coords]
+                                   for site in structure])
+        else:
+            structure = get_structure(rng.choice(sorted(PROTOTYPES)),
+                                      rng.randint(1, max_supercell), rng.randint(0, 10 ** 6))
+        snls.append(StructureNL(structure, 'Anubhav Jain <ajain@lbl.gov>',
+                                remarks=['benchmark fixture {}'.format(i)]))
+    return snls
+
+
+def write_text_file(filename, templates, n_lines, needle=None, needle_at=None):
+    """
+    Write n_lines of VASP-like output built from templates. If needle is
+    given, it is written after needle_at lines (default: the last line).
+
+    :return: (int) size of the file in bytes
+    """
+    needle_at = n_lines if needle_at is None else needle_at
+    with open(filename, 'w') as f:
+        for i in range(n_lines):
+            if needle and i == needle_at:
+                f.write(needle + '\n')
+            f.write(templates[i % len(templates)].format(i % 1000, i) + '\n')
+        if needle and needle_at >= n_lines:
+            f.write(needle + '\n')
+    return os.path.getsize(filename)
+
+
+def _v(values):
+    return '<v>' + ' '.join(['{:16.8f}'.format(x) for x in values]) + ' </v>'
+
+
+def _structure_xml(structure, name=None):
+    lines = [' <structure name="{}" >'.format(name) if name else ' <structure>',
+             '  <crystal>', '   <varray name="basis" >']
+    lines.extend(['    ' + _v(row) for row in structure.lattice.matrix])
+    lines.extend(['   </varray>',
+                  '   <i name="volume">{:16.8f} </i>'.format(structure.volume),
+                  '   <varray name="rec_basis" >'])
+    # VASP writes the reciprocal basis without the 2*pi
+    rec = structure.lattice.reciprocal_lattice.matrix / (2 * math.pi)
+    lines.extend(['    ' + _v(row) for row in rec])
+    lines.extend(['   </varray>', '  </crystal>', '  <varray name="positions" >'])
+    lines.extend(['   ' + _v(site.frac_coords) for site in structure])
+    lines.extend(['  </varray>', ' </structure>'])
+    return lines
+
+
+def get_vasprun_xml(structure, n_ionic_steps=3, n_elec_steps=10, kpts=(4, 4, 4),
+                    nbands=None, nedos=301, seed=0):
+    """
+    A vasprun.xml that pymatgen's Vasprun parses, with n_ionic_steps
+    calculations, eigenvalues for all kpts and a total DOS of nedos points
+
+    :return: (str)
+    """
+    rng = random.Random(seed)
+    nsites = len(structure)
+    nbands = nbands if nbands else max(8, 4 * nsites)
+    elements = []
+    for site in structure:
+        if site.specie.symbol not in elements:
+            elements.append(site.specie.symbol)
+    nkpts = kpts[0] * kpts[1] * kpts[2]
+    energy = -5.0 * nsites
+
+    lines = ['<?xml version="1.0" encoding="ISO-8859-1"?>', '<modeling>',
+             ' <generator>', '  <i name="program" type="string">vasp </i>',
+             '  <i name="version" type="string">5.2.12 </i>', ' </generator>',
+             ' <incar>', '  <i type="string" name="PREC">accurate</i>',
+             '  <i name="ENCUT">    520.00000000</i>', '  <i type="int" name="ISPIN">     1</i>',
+             '  <i type="int" name="NSW">    99</i>', '  <i type="int" name="IBRION">     2</i>',
+             '  <i type="logical" name="LDAU"> F  </i>', ' </incar>',
+             ' <kpoints>', '  <generation param="Monkhorst-Pack">',
+             '   <v type="int" name="divisions">{} {} {} </v>'.format(*kpts),
+             '   <v name="usershift">0 0 0 </v>', '  </generation>',
+             '  <varray name="kpointlist" >']
+    kpoints = [[i / float(kpts[0]), j / float(kpts[1]), k / float(kpts[2])]
+               for i in range(kpts[0]) for j in range(kpts[1]) for k in range(kpts[2])]
+    lines.extend(['   ' + _v(k) for k in kpoints])
+    lines.extend(['  </varray>', '  <varray name="weights" >'])
+    lines.extend(['   ' + _v([1.0 / nkpts]) for _ in kpoints])
+    lines.extend(['  </varray>', ' </kpoints>', ' <parameters>',
+                  '  <separator name="electronic" >',
+                  '   <i type="int" name="NELM">    100</i>',
+                  '   <i type="int" name="ISPIN">     1</i>',
+                  '   <i type="int" name="NBANDS">{:>6d}</i>'.format(nbands),
+                  '   <i name="ENCUT">    520.00000000</i>',
+                  '   <i name="EDIFF">      0.00005000</i>',
+                  '   <i type="logical" name="LDAU"> F  </i>',
+                  '  </separator>',
+                  '  <separator name="ionic" >',
+                  '   <i type="int" name="NSW">     99</i>',
+                  '   <i type="int" name="IBRION">      2</i>',
+                  '  </separator>', ' </parameters>',
+                  ' <atominfo>', '  <atoms>{:>6d} </atoms>'.format(nsites),
+                  '  <types>{:>6d} </types>'.format(len(elements)),
+                  '  <array name="atoms" >', '   <dimension dim="1">ion</dimension>',
+                  '   <field type="string">element</field>',
+                  '   <field type="int">atomtype</field>', '   <set>'])
+    lines.extend(['    <rc><c>{:<2s}</c><c>{:>4d}</c></rc>'.format(
+        site.specie.symbol, elements.index(site.specie.symbol) + 1) for site in structure])
+    lines.extend(['   </set>', '  </array>', '  <array name="atomtypes" >',
+                  '   <dimension dim="1">type</dimension>',
+                  '   <field type="int">atomspertype</field>',
+                  '   <field type="string">element</field>', '   <field>mass</field>',
+                  '   <field>valence</field>',
+                  '   <field type="string">pseudopotential</field>', '   <set>'])
+    for el in elements:
+        lines.append('    <rc><c>{:>4d}</c><c>{:<2s}</c><c>  10.00000000</c>'
+                     '<c>   4.00000000</c><c>  PAW_PBE {} 05Jan2001 </c></rc>'.format(
+                         len([s for s in structure if s.specie.symbol == el]), el, el))
+    lines.extend(['   </set>', '  </array>', ' </atominfo>'])
+    lines.extend(_structure_xml(structure, 'initialpos'))
+
+    for step in range(n_ionic_steps):
+        lines.append(' <calculation>')
+        for elec in range(n_elec_steps):
+            e = energy - 1.0 / (elec + 1) - 0.01 * step
+            lines.extend(['  <scstep>', '   <energy>',
+                          '    <i name="e_fr_energy">{:16.8f} </i>'.format(e),
+                          '    <i name="e_wo_entrp">{:16.8f} </i>'.format(e),
+                          '    <i name="e_0_energy">{:16.8f} </i>'.format(e),
+                          '   </energy>', '  </scstep>'])
+        lines.extend(['  ' + l for l in _structure_xml(structure)])
+        lines.append('  <varray name="forces" >')
+        lines.extend(['   ' + _v([rng.uniform(-0.1, 0.1) for _ in range(3)])
+                      for _ in range(nsites)])
+        lines.extend(['  </varray>', '  <varray name="stress" >'])
+        lines.extend(['   ' + _v([rng.uniform(-5, 5) for _ in range(3)]) for _ in range(3)])
+        lines.extend(['  </varray>'])
+
+        if step == n_ionic_steps - 1:
+            lines.extend(['  <eigenvalues>', '   <array>',
+                          '    <dimension dim="1">band</dimension>',
+                          '    <dimension dim="2">kpoint</dimension>',
+                          '    <dimension dim="3">spin</dimension>',
+                          '    <field>eigene</field>', '    <field>occ</field>',
+                          '    <set>', '     <set comment="spin 1">'])
+            for k in range(nkpts):
+                lines.append('      <set comment="kpoint {}">'.format(k + 1))
+                for b in range(nbands):
+                    lines.append('       <r>{:10.4f} {:8.4f} </r>'.format(
+                        -10.0 + 15.0 * b / nbands + rng.uniform(0, 0.1),
+                        1.0 if b < nbands // 2 else 0.0))
+                lines.append('      </set>')
+            lines.extend(['     </set>', '    </set>', '   </array>', '  </eigenvalues>',
+                          '  <dos>', '   <i name="efermi">      0.50000000 </i>',
+                          '   <total>', '    <array>',
+                          '     <dimension dim="1">gridpoints</dimension>',
+                          '     <dimension dim="2">spin</dimension>',
+                          '     <field>energy</field>', '     <field>total</field>',
+                          '     <field>integrated</field>', '     <set>',
+                          '      <set comment="spin 1">'])
+            integrated = 0.0
+            for p in range(nedos):
+                dos = rng.uniform(0, 2)
+                integrated += dos * 0.05
+                lines.append('       <r>{:10.4f} {:10.4f} {:10.4f} </r>'.format(
+                    -10.0 + 0.05 * p, dos, integrated))
+            lines.extend(['      </set>', '     </set>', '    </array>', '   </total>',
+                          '  </dos>'])
+        lines.append(' </calculation>')
+
+    lines.extend(_structure_xml(structure, 'finalpos'))
+    lines.append('</modeling>')
+    return '\n'.join(lines) + '\n'
+
+
+def get_outcar_tail(structure):
+    """
+    The end of an OUTCAR, with everything pymatgen's Outcar looks for
+    """
+    nsites = len(structure)
+    lines = [' E-fermi :   0.5000     XC(G=0):  -6.1327     alpha+bet : -1.8238',
+             ' number of electron      {:>10.7f} magnetization       0.0000000'.format(
+                 4.0 * nsites),
+             '', ' total charge', '',
+             '# of ion     s       p       d       tot',
+             '----------------------------------------']
+    lines.extend(['{:>4d}        0.500   0.700   0.000   1.200'.format(i + 1)
+                  for i in range(nsites)])
+    lines.extend(['----------------------------------------',
+                  'tot         {:.3f}   {:.3f}   0.000   {:.3f}'.format(
+                      0.5 * nsites, 0.7 * nsites, 1.2 * nsites), '',
+                  ' General timing and accounting informations for this job:',
+                  ' ========================================================', '',
+                  '                  Total CPU time used (sec):      123.456',
+                  '                            User time (sec):      120.000',
+                  '                          System time (sec):        3.456',
+                  '                         Elapsed time (sec):      130.789', '',
+                  '                   Maximum memory used (kb):       98765.',
+                  '                   Average memory used (kb):           0.', '',
+                  '                          Minor page faults:         1234',
+                  '                          Major page faults:            0',
+                  '                 Voluntary context switches:          567'])
+    return '\n'.join(lines) + '\n'
+
+
+def write_vasp_run_dir(dir_name, structure, n_ionic_steps=3, kpts=(4, 4, 4),
+                       vasp_out_lines=10000, outcar_lines=10000, error_needle=None,
+                       fw_id=1, task_type='GGA static', seed=0):
+    """
+    A finished run directory, as left by VaspCustodianTask: inputs, vasp.out,
+    OUTCAR, vasprun.xml, FW.json (with a spec that MPVaspDrone.process_fw
+    accepts) and an empty *.error file.
+
+    :param error_needle: (str) a VASPOutSignal error string to put in vasp.out
+    :return: (dict) sizes of the generated files, in bytes
+    """
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    sizes = {}
+
+    Incar({'ENCUT': 520, 'ISPIN': 1, 'NSW': 99, 'IBRION': 2}).write_file(
+        os.path.join(dir_name, 'INCAR'))
+    Poscar(structure).write_file(os.path.join(dir_name, 'POSCAR'))
+    Poscar(structure).write_file(os.path.join(dir_name, 'CONTCAR'))
+    Kpoints.monkhorst_automatic(kpts).write_file(os.path.join(dir_name, 'KPOINTS'))
+    for f, text in [('POTCAR', '  PAW_PBE fixture 05Jan2001\n'), ('CHGCAR', 'fixture\n'),
+                    ('OSZICAR', '   1 F= -.10000000E+02 E0= -.10000000E+02  d E =-.1E+02\n')]:
+        with open(os.path.join(dir_name, f), 'w') as fh:
+            fh.write(text)
+    open(os.path.join(dir_name, 'vasp.error'), 'w').close()
+
+    sizes['vasp.out'] = write_text_file(os.path.join(dir_name, 'vasp.out'), VASP_OUT_LINES,
+                                        vasp_out_lines, error_needle)
+    # OUTCAR: starts with the version banner, ends with the accounting section
+    outcar = os.path.join(dir_name, 'OUTCAR')
+    write_text_file(outcar, OUTCAR_LINES, outcar_lines,
+                    ' vasp.5.2.12 11Nov11 complex', needle_at=0)
+    with open(outcar, 'a') as f:
+        f.write(get_outcar_tail(structure))
+    sizes['OUTCAR'] = os.path.getsize(outcar)
+
+    with open(os.path.join(dir_name, 'vasprun.xml'), 'w') as f:
+        f.write(get_vasprun_xml(structure, n_ionic_steps, kpts=kpts, seed=seed))
+    sizes['vasprun.xml'] = os.path.getsize(os.path.join(dir_name, 'vasprun.xml'))
+
+    snl = StructureNL(structure, 'Anubhav Jain <ajain@lbl.gov>')
+    spec = {'mpsnl': snl.to_dict, 'snlgroup_id': fw_id, 'task_type': task_type,
+            'run_tags': ['benchmark'], 'vaspinputset_name': 'MPGGAVaspInputSet'}
+    with open(os.path.join(dir_name, 'FW.json'), 'w') as f:
+        json.dump({'fw_id': fw_id, 'spec': spec}, f)
+    return sizes
@@ -0,0 +1,208 @@
+"""
+A small benchmark harness: benchmarks are registered with @benchmark, timed
+with a warm-up and several repeats, and the results of a run are saved as a
+JSON file (with the git revision and machine) so that a later run can be
+compared against it to catch regressions.
+"""
+
+import datetime
+import getpass
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import tempfile
+import timeit
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 30, 2013'
+
+logger = logging.getLogger(__name__)
+
+# name -> (setup function, groups); see benchmark()
+BENCHMARKS = {}
+
+# fixture sizes; each benchmark reads the parameters it needs
+SIZES = {
+    'small': {'n_lines': 10000, 'nsites': 8, 'n_ionic_steps': 3, 'kpts': (4, 4, 4),
+              'n_snl': 20, 'n_groups': 20, 'n_wf': 5},
+    'medium': {'n_lines': 200000, 'nsites': 32, 'n_ionic_steps': 10, 'kpts': (6, 6, 6),
+               'n_snl': 100, 'n_groups': 100, 'n_wf': 20},
+    'large': {'n_lines': 2000000, 'nsites': 128, 'n_ionic_steps': 30, 'kpts': (8, 8, 8),
+              'n_snl': 500, 'n_groups': 500, 'n_wf': 100}}
+
+DEFAULT_REPEAT = 5
+# a benchmark that got this much slower (median) is reported as a regression
+DEFAULT_THRESHOLD = 0.2
+
+
+def benchmark(name, groups=None):
+    """
+    Register a benchmark. The decorated function is the setup: it gets a
+    BenchmarkContext and returns the zero-argument callable to time.
+
+    :param name: (str) unique name, e.g. 'signals.detect_all'
+    :param groups: ([str]) e.g. ['mongo'] for benchmarks that need a database
+    """
+    def _register(setup):
+        BENCHMARKS[name] = (setup, groups if groups else [])
+        return setup
+    return _register
+
+
+class BenchmarkContext():
+    """
+    What a benchmark setup gets: the fixture size parameters, a scratch dir
+    that is removed afterwards, and cleanup callbacks
+    """
+
+    def __init__(self, size, params, mongo=None, seed=0):
+        """
+        :param size: (str) a key of SIZES
+        :param params: (dict) the fixture parameters of that size
+        :param mongo: (str) 'mongomock' or 'host:port' of a mongod, None if
+        there is no database to benchmark against
+        :param seed: (int) for the fixtures
+        """
+        self.size = size
+        self.params = params
+        self.mongo = mongo
+        self.seed = seed
+        self.work_dir = tempfile.mkdtemp(prefix='mpworks_bench_')
+        self.info = {}  # extra facts about the fixture, saved with the results
+        self._cleanups = []
+
+    def add_cleanup(self, f):
+        self._cleanups.append(f)
+
+    def close(self):
+        for f in reversed(self._cleanups):
+            try:
+                f()
+            except Exception:
+                logger.exception('Benchmark cleanup failed')
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def _get_stats(times):
+    times = sorted(times)
+    n = len(times)
+    mean = sum(times) / n
+    median = times[n // 2] if n % 2 else (times[n // 2 - 1] + times[n // 2]) / 2.0
+    stdev = math.sqrt(sum([(t - mean) ** 2 for t in times]) / (n - 1)) if n > 1 else 0.0
+    return {'n': n, 'min': times[0], 'max': times[-1], 'mean': mean, 'median': median,
+            'stdev': stdev}
+
+
+def run_benchmark(name, size='small', repeat=DEFAULT_REPEAT, mongo=None, seed=0):
+    """
+    :return: (dict) timing stats (secs) of one benchmark, or None if it was
+    skipped
+    """
+    setup, groups = BENCHMARKS[name]
+    if 'mongo' in groups and not mongo:
+        logger.info('Skipping {}: no database'.format(name))
+        return None
+
+    ctx = BenchmarkContext(size, SIZES[size], mongo, seed)
+    try:
+        func = setup(ctx)
+        func()  # warm-up: imports, caches, page cache
+        times = []
+        for _ in range(repeat):
+            t0 = timeit.default_timer()
+            func()
+            times.append(timeit.default_timer() - t0)
+    finally:
+        ctx.close()
+    stats = _get_stats(times)
+    stats['info'] = ctx.info
+    return stats
+
+
+def _get_git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_machine_info():
+    return {'host': socket.gethostname(), 'user': getpass.getuser(),
+            'platform': platform.platform(), 'python': platform.python_version(),
+            'processor': platform.processor()}
+
+
+def run_benchmarks(names=None, size='small', repeat=DEFAULT_REPEAT, mongo=None, seed=0):
+    """
+    :param names: ([str]) benchmarks to run (substrings match), default all
+    :return: (dict) the results document
+    """
+    selected = sorted([n for n in BENCHMARKS
+                       if not names or any([s in n for s in names])])
+    results = {}
+    for name in selected:
+        logger.info('Running {} ({})'.format(name, size))
+        stats = run_benchmark(name, size, repeat, mongo, seed)
+        if stats:
+            results[name] = stats
+    return {'created_at': datetime.datetime.utcnow().isoformat(),
+            'git_revision': _get_git_revision(), 'machine': get_machine_info(),
+            'size': size, 'params': SIZES[size], 'repeat': repeat, 'seed': seed,
+            'mongo': 'mongomock' if mongo == 'mongomock' else bool(mongo),
+            'results': results}
+
+
+def save_results(doc, results_dir):
+    """
+    :return: (str) the file the results were written to
+    """
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    filename = '{}_{}_{}.json'.format(doc['created_at'][:19].replace(':', ''), doc['size'],
+                                      (doc['git_revision'] or 'norev')[:8])
+    filename = os.path.join(results_dir, filename)
+    with open(filename, 'w') as f:
+        json.dump(doc, f, indent=4, sort_keys=True)
+    return filename
+
+
+def compare_results(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare the medians of two results documents
+
+    :param baseline: (dict) results document of the reference run
+    :param current: (dict) results document of the new run
+    :param threshold: (float) relative slowdown reported as a regression
+    :return: (dict) name -> baseline, current, ratio and status ('ok',
+    'regression', 'improvement', 'new' or 'missing')
+    """
+    if baseline.get('size') != current.get('size'):
+        logger.warn('Comparing runs of different sizes ({} vs. {})'.format(
+            baseline.get('size'), current.get('size')))
+    comparison = {}
+    for name in sorted(set(baseline['results']) | set(current['results'])):
+        b = baseline['results'].get(name)
+        c = current['results'].get(name)
+        if not b or not c:
+            comparison[name] = {'status': 'new' if c else 'missing'}
+            continue
+        ratio = c['median'] / b['median'] if b['median'] else None
+        status = 'ok'
+        if ratio and ratio > 1 + threshold:
+            status = 'regression'
+        elif ratio and ratio < 1 / (1 + threshold):
+            status = 'improvement'
+        comparison[name] = {'baseline': b['median'], 'current': c['median'], 'ratio': ratio,
+                            'status': status}
+    return comparison
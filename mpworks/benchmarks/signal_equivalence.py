@@ -0,0 +1,196 @@
+"""
+Fuzzing of the chunked file search of the signal detectors (search_lines in
+mpworks.drones.signals) against the line-by-line search it replaced: random
+files (plain and gzipped; long lines, matches across line and chunk
+boundaries, mixed case, no trailing newline, empty) are searched with both,
+using tiny chunk sizes so that every boundary case comes up.
+
+Likewise, the compiled signal rules (signal_rules.yaml) are checked against
+the SignalDetector classes on random run dirs.
+"""
+
+import gzip
+import os
+import random
+import re
+import shutil
+import tempfile
+from mpworks.drones.signal_rules import get_rule_set
+from mpworks.drones.signals import string_list_in_file, regex_in_file, SEGFAULT_RX, \
+    VASPOutSignal, SignalDetectorList, VASPInputsExistSignal, VASPOutputsExistSignal, \
+    HitAMemberSignal, SegFaultSignal, VASPStartedCompletedSignal, WallTimeSignal, \
+    DiskSpaceExceededSignal
+from pymatgen import zopen
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'Jun 07, 2013'
+
+TARGETS = VASPOutSignal().signames_targetstrings.values() + \
+    ['hit a member that was already found in another star', 'job killed: walltime',
+     'No space left', 'vasp', 'Voluntary context switches:']
+REGEXES = [SEGFAULT_RX, re.compile(r'^ERROR'), re.compile(r'fault\s*$'),
+           re.compile(r'segmentation\s+fault', re.IGNORECASE), re.compile(r'a.b')]
+CHUNK_SIZES = [1, 7, 64, 4096]
+
+
+def line_string_list_in_file(s_list, filename, ignore_case=True):
+    # the line-by-line search, as it was
+    matches = set()
+    with zopen(filename, 'r') as f:
+        for line in f:
+            for s in s_list:
+                if (ignore_case and s.lower() in line.lower()) or s in line:
+                    matches.add(s)
+                    if len(matches) == len(s_list):
+                        return s_list
+    return list(matches)
+
+
+def line_regex_in_file(rx, filename):
+    with zopen(filename, 'r') as f:
+        for line in f:
+            if rx.search(line) is not None:
+                return True
+    return False
+
+
+def _random_line(rng, pieces):
+    alphabet = 'abcdefghijklmnopqrstuvwxyz ABCDEFGHIJKLMNOPQRSTUVWXYZ:0123456789.\t'
+    parts = []
+    for _ in range(rng.randint(0, 4)):
+        parts.append(''.join([rng.choice(alphabet) for _ in range(rng.randint(0, 40))]))
+        if rng.random() < 0.15:
+            piece = rng.choice(pieces)
+            if rng.random() < 0.3:
+                piece = piece.upper() if rng.random() < 0.5 else piece.lower()
+            if rng.random() < 0.3:
+                # split over two lines: must not match
+                cut = rng.randint(0, len(piece))
+                piece = piece[:cut] + rng.choice(['\n', '\r\n']) + piece[cut:]
+            parts.append(piece)
+    return ''.join(parts)
+
+
+def write_random_file(filename, rng, n_lines=None):
+    """
+    :return: (str) the text written
+    """
+    pieces = TARGETS + ['segmentation', 'fault', 'ERROR', 'aXb', 'segmentation \n fault']
+    n_lines = rng.choice([0, 1, 2, 10, 100]) if n_lines is None else n_lines
+    lines = [_random_line(rng, pieces) for _ in range(n_lines)]
+    if lines and rng.random() < 0.2:
+        lines[rng.randrange(len(lines))] += 'x' * rng.randint(100, 10000)  # a long line
+    text = '\n'.join(lines)
+    if lines and rng.random() < 0.7:
+        text += '\n'
+    with open(filename, 'wb') as f:
+        f.write(text)
+    return text
+
+
+def check_equivalence(n_cases=200, seed=0, chunk_sizes=None):
+    """
+    :return: ([dict]) the cases where the chunked and line-by-line searches
+    disagree (empty if none)
+    """
+    rng = random.Random(seed)
+    chunk_sizes = chunk_sizes if chunk_sizes else CHUNK_SIZES
+    work_dir = tempfile.mkdtemp(prefix='mpworks_fuzz_')
+    mismatches = []
+    try:
+        for case in range(n_cases):
+            filename = os.path.join(work_dir, 'case.error')
+            text = write_random_file(filename, rng)
+            gz_filename = filename + '.gz'
+            with open(filename, 'rb') as f_in:
+                f_out = gzip.open(gz_filename, 'wb')
+                shutil.copyfileobj(f_in, f_out)
+                f_out.close()
+
+            targets = rng.sample(TARGETS, rng.randint(1, 4))
+            ignore_case = rng.random() < 0.7
+            for fname in [filename, gz_filename]:
+                expected = sorted(line_string_list_in_file(targets, fname, ignore_case))
+                expected_rx = [line_regex_in_file(rx, fname) for rx in REGEXES]
+                for chunk_size in chunk_sizes:
+                    got = sorted(string_list_in_file(targets, fname, ignore_case, chunk_size))
+                    got_rx = [regex_in_file(rx, fname, chunk_size) for rx in REGEXES]
+                    if got != expected or got_rx != expected_rx:
+                        mismatches.append({'case': case, 'file': os.path.basename(fname),
+                                           'chunk_size': chunk_size, 'targets': targets,
+                                           'ignore_case': ignore_case, 'expected': expected,
+                                           'got': got, 'expected_rx': expected_rx,
+                                           'got_rx': got_rx, 'text': text[:2000]})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return mismatches
+
+
+def detector_signals(run_dir, error_dirs):
+    # the signals as the SignalDetector classes find them
+    sl = SignalDetectorList([VASPInputsExistSignal(), VASPOutputsExistSignal(), VASPOutSignal(),
+                             HitAMemberSignal(), SegFaultSignal(),
+                             VASPStartedCompletedSignal()])
+    signals = sl.detect_all(run_dir)
+    for error_dir in error_dirs:
+        signals = signals.union(WallTimeSignal().detect(error_dir))
+        signals = signals.union(DiskSpaceExceededSignal().detect(error_dir))
+    return signals
+
+
+def write_random_run_dir(dir_name, rng):
+    # some of the files VASP and the scheduler leave, possibly gzipped,
+    # empty, missing or from several relaxations
+    os.makedirs(dir_name)
+    names = ['POSCAR', 'INCAR', 'KPOINTS', 'POTCAR', 'OUTCAR', 'CONTCAR', 'OSZICAR',
+             'vasprun.xml', 'CHGCAR', 'vasp.out', 'job.error', 'other.error']
+    for name in names:
+        r = rng.random()
+        if r < 0.1:
+            continue
+        filename = os.path.join(dir_name, name)
+        if r < 0.15:
+            open(filename, 'w').close()
+            continue
+        write_random_file(filename, rng, rng.choice([1, 5, 50]))
+        if rng.random() < 0.2:
+            with open(filename, 'rb') as f_in:
+                f_out = gzip.open(filename + '.gz', 'wb')
+                shutil.copyfileobj(f_in, f_out)
+                f_out.close()
+            os.remove(filename)
+        if name in ['OUTCAR', 'vasp.out'] and rng.random() < 0.2:
+            write_random_file(filename + '.relax1', rng, 10)
+
+
+def check_rule_set_equivalence(n_cases=100, seed=0):
+    """
+    :return: ([dict]) the run dirs where the signal rules and the detector
+    classes disagree (empty if none)
+    """
+    rng = random.Random(seed)
+    rule_set = get_rule_set()
+    work_dir = tempfile.mkdtemp(prefix='mpworks_fuzz_')
+    mismatches = []
+    try:
+        for case in range(n_cases):
+            parent = os.path.join(work_dir, 'case{}'.format(case))
+            run_dir = os.path.join(parent, 'run')
+            write_random_run_dir(run_dir, rng)
+            for name in ['job.error', 'other.error']:
+                if rng.random() < 0.5:
+                    write_random_file(os.path.join(parent, name), rng, 5)
+            error_dirs = [run_dir, parent] if rng.random() < 0.5 else [run_dir]
+            expected = detector_signals(run_dir, error_dirs)
+            got = rule_set.detect(run_dir, error_dirs)
+            if got != expected:
+                mismatches.append({'case': case, 'expected': sorted(expected),
+                                   'got': sorted(got)})
+            shutil.rmtree(parent)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return mismatches
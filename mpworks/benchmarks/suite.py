@@ -0,0 +1,248 @@
+"""
+The benchmarks of the ingestion and workflow-generation hot paths. Importing
+this module registers them with the harness.
+
+Benchmarks in the 'mongo' group need a database: either mongomock (an
+in-memory stand-in, so they measure the mpworks/pymatgen side only) or a
+local mongod given as host:port, in which case a scratch database is
+created and dropped.
+"""
+
+import gzip
+import os
+import shutil
+from mpworks.benchmarks.fixtures import get_structure, get_snl_set, \
+    write_text_file, write_vasp_run_dir, VASP_OUT_LINES, ERROR_LINES
+from mpworks.benchmarks.harness import benchmark
+from mpworks.benchmarks.signal_equivalence import line_string_list_in_file, \
+    line_regex_in_file
+from mpworks.drones.signal_rules import get_rule_set
+from mpworks.drones.signals import string_list_in_file, SignalDetectorList, \
+    VASPInputsExistSignal, VASPOutputsExistSignal, VASPOutSignal, HitAMemberSignal, \
+    SegFaultSignal, VASPStartedCompletedSignal, SEGFAULT_RX
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 30, 2013'
+
+BENCH_DB = 'mpworks_benchmark'
+
+
+def _patch_mongo(ctx, modules):
+    """
+    Point the MongoClient of modules at ctx.mongo; returns (host, port) to
+    give to the code under test
+    """
+    if ctx.mongo != 'mongomock':
+        host, port = ctx.mongo.rsplit(':', 1)
+        from pymongo import MongoClient
+        ctx.add_cleanup(lambda: MongoClient(host, int(port)).drop_database(BENCH_DB))
+        return host, int(port)
+
+    import mongomock
+    client = mongomock.MongoClient()
+    for module in modules:
+        if hasattr(module, 'MongoClient'):
+            original = module.MongoClient
+            module.MongoClient = lambda *args, **kwargs: client
+            ctx.add_cleanup(lambda m=module, o=original: setattr(m, 'MongoClient', o))
+    return 'localhost', 27017
+
+
+def _get_signal_detectors():
+    # the detectors run by MPVaspDrone.process_fw on the run dir
+    sl = SignalDetectorList()
+    sl.extend([VASPInputsExistSignal(), VASPOutputsExistSignal(), VASPOutSignal(),
+               HitAMemberSignal(), SegFaultSignal(), VASPStartedCompletedSignal()])
+    return sl
+
+
+@benchmark('signals.string_list_in_file')
+def bench_string_list_in_file(ctx):
+    # nothing matches, so the whole file is scanned (the common case)
+    filename = os.path.join(ctx.work_dir, 'vasp.out')
+    ctx.info['bytes'] = write_text_file(filename, VASP_OUT_LINES, ctx.params['n_lines'])
+    targets = VASPOutSignal().signames_targetstrings.values()
+    return lambda: string_list_in_file(targets, filename)
+
+
+@benchmark('signals.string_list_in_file_lines')
+def bench_string_list_in_file_lines(ctx):
+    # the line-by-line search string_list_in_file replaced, for reference
+    filename = os.path.join(ctx.work_dir, 'vasp.out')
+    ctx.info['bytes'] = write_text_file(filename, VASP_OUT_LINES, ctx.params['n_lines'])
+    targets = VASPOutSignal().signames_targetstrings.values()
+    return lambda: line_string_list_in_file(targets, filename)
+
+
+@benchmark('signals.segfault_error_file')
+def bench_segfault_error_file(ctx):
+    # a large scheduler error file without a segfault
+    filename = os.path.join(ctx.work_dir, 'job.error')
+    ctx.info['bytes'] = write_text_file(filename, ERROR_LINES, ctx.params['n_lines'])
+    detector = SegFaultSignal()
+    return lambda: detector.detect(ctx.work_dir)
+
+
+@benchmark('signals.segfault_error_file_lines')
+def bench_segfault_error_file_lines(ctx):
+    # same, with the line-by-line regex search, for reference
+    filename = os.path.join(ctx.work_dir, 'job.error')
+    ctx.info['bytes'] = write_text_file(filename, ERROR_LINES, ctx.params['n_lines'])
+    return lambda: line_regex_in_file(SEGFAULT_RX, filename)
+
+
+@benchmark('signals.string_list_in_file_gz')
+def bench_string_list_in_file_gz(ctx):
+    # same, on an output gzipped by the OutputCompressor
+    filename = os.path.join(ctx.work_dir, 'vasp.out')
+    ctx.info['bytes'] = write_text_file(filename, VASP_OUT_LINES, ctx.params['n_lines'])
+    with open(filename, 'rb') as f_in:
+        f_out = gzip.open(filename + '.gz', 'wb')
+        shutil.copyfileobj(f_in, f_out)
+        f_out.close()
+    os.remove(filename)
+    ctx.info['bytes_gz'] = os.path.getsize(filename + '.gz')
+    targets = VASPOutSignal().signames_targetstrings.values()
+    return lambda: string_list_in_file(targets, filename + '.gz')
+
+
+@benchmark('signals.detect_all')
+def bench_detect_all(ctx):
+    dir_name = os.path.join(ctx.work_dir, 'run')
+    ctx.info['bytes'] = write_vasp_run_dir(
+        dir_name, get_structure(supercell=max(1, ctx.params['nsites'] // 8)),
+        n_ionic_steps=1, kpts=(2, 2, 2), vasp_out_lines=ctx.params['n_lines'],
+        outcar_lines=ctx.params['n_lines'], seed=ctx.seed)
+    sl = _get_signal_detectors()
+    return lambda: sl.detect_all(dir_name)
+
+
+@benchmark('signals.rule_set_detect')
+def bench_rule_set_detect(ctx):
+    # same run dir, with the compiled signal rules (one pass per file)
+    dir_name = os.path.join(ctx.work_dir, 'run')
+    ctx.info['bytes'] = write_vasp_run_dir(
+        dir_name, get_structure(supercell=max(1, ctx.params['nsites'] // 8)),
+        n_ionic_steps=1, kpts=(2, 2, 2), vasp_out_lines=ctx.params['n_lines'],
+        outcar_lines=ctx.params['n_lines'], seed=ctx.seed)
+    rule_set = get_rule_set()
+    return lambda: rule_set.detect(dir_name)
+
+
+def _write_assimilate_run(ctx):
+    dir_name = os.path.join(ctx.work_dir, 'run')
+    ctx.info['bytes'] = write_vasp_run_dir(
+        dir_name, get_structure(supercell=max(1, ctx.params['nsites'] // 8)),
+        n_ionic_steps=ctx.params['n_ionic_steps'], kpts=ctx.params['kpts'],
+        vasp_out_lines=ctx.params['n_lines'] // 10,
+        outcar_lines=ctx.params['n_lines'] // 10, seed=ctx.seed)
+    return dir_name
+
+
+def _setup_assimilate(ctx, compact_arrays):
+    # update_duplicates, so that every repeat goes through the full insert path
+    import matgendb.creator
+    from mpworks.drones import mp_vaspdrone
+    host, port = _patch_mongo(ctx, [mp_vaspdrone, matgendb.creator])
+    dir_name = _write_assimilate_run(ctx)
+    drone = mp_vaspdrone.MPVaspDrone(host=host, port=port, database=BENCH_DB, user=None,
+                                     password=None, collection='tasks', parse_dos=False,
+                                     additional_fields={}, update_duplicates=True,
+                                     compact_arrays=compact_arrays)
+    db = mp_vaspdrone.MongoClient(host, port)[BENCH_DB]
+    db.counter.insert({'_id': 'taskid', 'c': 1})
+    return lambda: drone.assimilate(dir_name)
+
+
+@benchmark('drone.assimilate', groups=['mongo'])
+def bench_assimilate(ctx):
+    return _setup_assimilate(ctx, False)
+
+
+@benchmark('drone.assimilate_compact', groups=['mongo'])
+def bench_assimilate_compact(ctx):
+    # same, with the calculation outputs stored as binary blobs
+    return _setup_assimilate(ctx, True)
+
+
+@benchmark('drone.compact_task_doc')
+def bench_compact_task_doc(ctx):
+    # encoding cost, and the document sizes before and after (in info)
+    from mpworks.drones.compact_arrays import compact_task_doc
+    from mpworks.drones.mp_vaspdrone import MPVaspDrone
+    dir_name = _write_assimilate_run(ctx)
+    drone = MPVaspDrone(host=None, port=None, database=None, user=None, password=None,
+                        collection=None, parse_dos=False, simulate_mode=True)
+    d = drone.get_task_doc(dir_name, False, {})
+    compacted = compact_task_doc(d)
+    ctx.info['bson_bytes'] = compacted['compact_arrays']['bytes_before']
+    ctx.info['bson_bytes_compact'] = compacted['compact_arrays']['bytes_after']
+    return lambda: compact_task_doc(d)
+
+
+@benchmark('setup.nonscf_kpoints')
+def bench_nonscf_kpoints(ctx):
+    # the uniform mesh (1000 k-points per reciprocal atom) and the k-path of
+    # the non-SCF runs, as SetupNonSCFTask computed them for every run
+    from mpworks.firetasks.kpoint_cache import get_nonscf_kpoints, get_nonscf_structure
+    structure = get_nonscf_structure(get_structure(supercell=max(1, ctx.params['nsites'] // 8)))
+    ctx.info['nsites'] = len(structure)
+    return lambda: [get_nonscf_kpoints(structure, mode) for mode in ['uniform', 'line']]
+
+
+@benchmark('setup.nonscf_kpoints_cached')
+def bench_nonscf_kpoints_cached(ctx):
+    # same, from the k-point cache (the key still needs the symmetry)
+    from mpworks.firetasks.kpoint_cache import KpointCache, get_nonscf_structure
+    structure = get_nonscf_structure(get_structure(supercell=max(1, ctx.params['nsites'] // 8)))
+    ctx.info['nsites'] = len(structure)
+    cache = KpointCache(os.path.join(ctx.work_dir, 'kpoint_cache'))
+    cache.precompute([structure])
+    return lambda: [cache.get_kpoints(structure, mode) for mode in ['uniform', 'line']]
+
+
+@benchmark('snl.get_meta_from_structure')
+def bench_get_meta_from_structure(ctx):
+    # the proximity check is quadratic in nsites
+    from mpworks.snl_utils.mpsnl import get_meta_from_structure
+    structures = [get_structure('rocksalt', max(1, ctx.params['nsites'] // 8), seed=i)
+                  for i in range(10)]
+    ctx.info['nsites'] = len(structures[0])
+    return lambda: [get_meta_from_structure(s) for s in structures]
+
+
+@benchmark('snl.build_groups', groups=['mongo'])
+def bench_build_groups(ctx):
+    # n_groups SNLs in the database, then n_snl candidates (many of them
+    # perturbed copies of SNLs in the database) are matched against them
+    from mpworks.snl_utils import snl_mongo
+    from mpworks.snl_utils.mpsnl import MPStructureNL
+    from mpworks.snl_utils.symmetry import get_symmetry_data
+    host, port = _patch_mongo(ctx, [snl_mongo])
+
+    n_groups = ctx.params['n_groups']
+    mpsnls = []
+    for i, snl in enumerate(get_snl_set(n_groups + ctx.params['n_snl'], seed=ctx.seed)):
+        sym = get_symmetry_data(snl.structure)
+        mpsnls.append(MPStructureNL.from_snl(snl, i + 1, sym['sg_num'], sym['sg_symbol'],
+                                             sym['hall'], sym['xtal_system'],
+                                             sym['lattice_type']))
+    sma = snl_mongo.SNLMongoAdapter(host, port, BENCH_DB)
+    sma._reset()
+    for mpsnl in mpsnls[:n_groups]:
+        sma.add_mpsnl(mpsnl)
+    ctx.info['n_snlgroups'] = sma.snlgroups.count()
+    candidates = mpsnls[n_groups:]
+    return lambda: [sma.build_groups(m, testing_mode=True) for m in candidates]
+
+
+@benchmark('workflows.snl_to_wf')
+def bench_snl_to_wf(ctx):
+    from mpworks.workflows.snl_to_wf import snl_to_wf
+    snls = get_snl_set(ctx.params['n_wf'], dupe_fraction=0, seed=ctx.seed)
+    ctx.info['nsites'] = [len(s.structure) for s in snls]
+    return lambda: [snl_to_wf(snl) for snl in snls]
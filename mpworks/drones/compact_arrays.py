@@ -0,0 +1,248 @@
+"""
+A compact storage format for the numeric data in task documents. The output
+of each calculation (forces, stresses and structures of every ionic step, the
+electronic steps, eigenvalues, ...) is stored by MPVaspDrone as nested lists
+of floats, which BSON encodes at ~13 bytes a number; compact_task_doc()
+replaces them by zlib-compressed typed binary blobs:
+
+    numeric arrays (e.g. forces) -> {'@array': {dtype, shape, codec, data}}
+    lists of records with the same numeric keys (e.g. electronic_steps)
+        -> {'@records': {keys, n, array}}
+    ordered structures of the ionic steps
+        -> {'@structure': {species, lattice, frac_coords}}
+
+Blobs larger than max_inline_bytes go to GridFS (collection array_fs), and
+'data' is replaced by 'gridfs_id'. expand_task_doc() restores the original
+lists and structure dicts; everything else in the document is left alone, so
+queries on e.g. calculations.output.final_energy are not affected. Only what
+comes back exactly is compacted: lists must hold only ints or only floats,
+and structures must rebuild into the same dict.
+"""
+
+import hashlib
+import logging
+import time
+import zlib
+import gridfs
+import numpy as np
+from bson import BSON
+from bson.binary import Binary
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'Jun 04, 2013'
+
+logger = logging.getLogger(__name__)
+
+ARRAY_FS = 'array_fs'
+# smaller arrays are not worth a blob
+MIN_ARRAY_SIZE = 16
+MAX_INLINE_BYTES = 256 * 1024
+ZLIB_LEVEL = 1
+
+
+def _get_leaf_types(values, types):
+    if isinstance(values, list):
+        for v in values:
+            _get_leaf_types(v, types)
+    else:
+        types.add(type(values))
+    return types
+
+
+def _to_array(values):
+    # the numpy array of a rectangular list of ints/floats, else None
+    if not isinstance(values, list) or not values:
+        return None
+    try:
+        arr = np.array(values)
+    except (ValueError, TypeError):
+        return None
+    if arr.dtype.kind not in 'if' or arr.size < MIN_ARRAY_SIZE:
+        return None
+    # mixed ints and floats (or bools) would all come back as floats (ints)
+    if _get_leaf_types(values, set()) not in [set([int]), set([float])]:
+        return None
+    return arr
+
+
+def encode_array(arr, fs=None, max_inline_bytes=MAX_INLINE_BYTES, blob_hashes=None):
+    """
+    :param arr: (numpy array) of ints or floats
+    :param fs: (GridFS) where blobs larger than max_inline_bytes go; if None,
+    all blobs are stored inline
+    :param blob_hashes: (dict) if given, gets {gridfs_id: sha1 of the decoded
+    data} of the blob put in GridFS
+    :return: (dict) the '@array' document
+    """
+    dtype = 'int64' if arr.dtype.kind == 'i' else 'float64'
+    raw = arr.astype(dtype).tostring()
+    data = zlib.compress(raw, ZLIB_LEVEL)
+    d = {'dtype': dtype, 'shape': list(arr.shape), 'codec': 'zlib'}
+    if fs is not None and len(data) > max_inline_bytes:
+        d['gridfs_id'] = fs.put(data)
+        if blob_hashes is not None:
+            blob_hashes[d['gridfs_id']] = hashlib.sha1(raw).hexdigest()
+    else:
+        d['data'] = Binary(data)
+    return {'@array': d}
+
+
+def decode_array(d, fs=None):
+    """
+    :param d: (dict) an '@array' document
+    :param fs: (GridFS) needed if the blob is in GridFS
+    :return: (numpy array)
+    """
+    d = d['@array']
+    if 'gridfs_id' in d:
+        if fs is None:
+            raise ValueError('Array {} is stored in GridFS, but no database was '
+                             'given'.format(d['gridfs_id']))
+        data = fs.get(d['gridfs_id']).read()
+    else:
+        data = d['data']
+    return np.frombuffer(zlib.decompress(data), dtype=d['dtype']).reshape(d['shape'])
+
+
+def _compact_records(records, fs, max_inline_bytes, blob_hashes):
+    # a list of dicts with the same keys, all with numbers as values
+    if not isinstance(records, list) or len(records) < 2 or \
+            not all([isinstance(r, dict) for r in records]):
+        return None
+    keys = sorted(records[0].keys())
+    if any([sorted(r.keys()) != keys for r in records]):
+        return None
+    # all ints or all floats, so that they come back with their type
+    if set([type(v) for r in records for v in r.values()]) not in [set([int]),
+                                                                    set([float])]:
+        return None
+    arr = np.array([[r[k] for k in keys] for r in records])
+    return {'@records': {'keys': keys, 'n': len(records),
+                         'array': encode_array(arr, fs, max_inline_bytes, blob_hashes)}}
+
+
+def _get_structure_dict(species, lattice, frac_coords):
+    from pymatgen import Lattice, Structure
+    return Structure(Lattice(lattice), species, frac_coords).to_dict
+
+
+def _compact_structure(s, fs, max_inline_bytes, blob_hashes):
+    # only ordered structures of plain elements (no oxidation states, no site
+    # properties) can round-trip, and only if they rebuild into the same dict
+    try:
+        sites = s['sites']
+        species = []
+        for site in sites:
+            if len(site['species']) != 1 or site['species'][0].get('occu', 1) != 1 or \
+                    set(site['species'][0].keys()) - set(['element', 'occu']) or \
+                    site.get('properties'):
+                return None
+            species.append(site['species'][0]['element'])
+        frac_coords = np.array([site['abc'] for site in sites])
+        lattice = np.array(s['lattice']['matrix'])
+        if _get_structure_dict(species, lattice, frac_coords) != s:
+            return None
+    except (KeyError, TypeError, IndexError, ValueError):
+        return None
+    return {'@structure': {'species': species,
+                           'lattice': encode_array(lattice, fs, max_inline_bytes,
+                                                   blob_hashes),
+                           'frac_coords': encode_array(frac_coords, fs, max_inline_bytes,
+                                                       blob_hashes)}}
+
+
+def _compact(obj, fs, max_inline_bytes, blob_hashes):
+    if isinstance(obj, dict):
+        d = {}
+        for k, v in obj.items():
+            if k == 'structure' and isinstance(v, dict):
+                d[k] = _compact_structure(v, fs, max_inline_bytes, blob_hashes) or \
+                    _compact(v, fs, max_inline_bytes, blob_hashes)
+            else:
+                d[k] = _compact(v, fs, max_inline_bytes, blob_hashes)
+        return d
+    if isinstance(obj, list):
+        arr = _to_array(obj)
+        if arr is not None:
+            return encode_array(arr, fs, max_inline_bytes, blob_hashes)
+        records = _compact_records(obj, fs, max_inline_bytes, blob_hashes)
+        if records is not None:
+            return records
+        return [_compact(v, fs, max_inline_bytes, blob_hashes) for v in obj]
+    return obj
+
+
+def _expand(obj, fs):
+    if isinstance(obj, dict):
+        if '@array' in obj:
+            return decode_array(obj, fs).tolist()
+        if '@records' in obj:
+            r = obj['@records']
+            arr = decode_array(r['array'], fs)
+            return [dict(zip(r['keys'], row)) for row in arr.tolist()]
+        if '@structure' in obj:
+            s = obj['@structure']
+            return _get_structure_dict(s['species'], decode_array(s['lattice'], fs),
+                                       decode_array(s['frac_coords'], fs))
+        return dict([(k, _expand(v, fs)) for k, v in obj.items()])
+    if isinstance(obj, list):
+        return [_expand(v, fs) for v in obj]
+    return obj
+
+
+def compact_task_doc(d, db=None, max_inline_bytes=MAX_INLINE_BYTES, blob_hashes=None):
+    """
+    Compact the outputs of the calculations of a task document
+
+    :param d: (dict) a task document; it is not modified
+    :param db: (pymongo Database) for the GridFS blobs; if None, all blobs are
+    stored in the document
+    :param max_inline_bytes: (int) larger blobs go to GridFS
+    :param blob_hashes: (dict) if given, gets {gridfs_id: sha1 of the decoded
+    data} of the blobs put in GridFS (see incremental_update.get_update)
+    :return: (dict) the compacted copy of d, with the sizes before and after
+    in 'compact_arrays'
+    """
+    t0 = time.time()
+    fs = gridfs.GridFS(db, ARRAY_FS) if db is not None else None
+    new_d = dict(d)
+    new_d['calculations'] = []
+    for calc in d.get('calculations', []):
+        calc = dict(calc)
+        if 'output' in calc:
+            calc['output'] = _compact(calc['output'], fs, max_inline_bytes, blob_hashes)
+        new_d['calculations'].append(calc)
+    new_d['compact_arrays'] = {'version': 1}
+    stats = {'bytes_before': len(BSON.encode(d)), 'bytes_after': len(BSON.encode(new_d)),
+             'time': time.time() - t0}
+    new_d['compact_arrays'].update(stats)
+    logger.info('Compacted task doc of {}: {} -> {} bytes in {:.3f}s'.format(
+        d.get('dir_name'), stats['bytes_before'], stats['bytes_after'], stats['time']))
+    return new_d
+
+
+def expand_task_doc(d, db=None):
+    """
+    Undo compact_task_doc(); documents that were not compacted are returned
+    as they are
+
+    :param d: (dict) a task document, e.g. from the tasks collection
+    :param db: (pymongo Database) needed if some blobs are in GridFS
+    :return: (dict) the task document with plain lists and structure dicts
+    """
+    if 'compact_arrays' not in d:
+        return d
+    fs = gridfs.GridFS(db, ARRAY_FS) if db is not None else None
+    new_d = dict(d)
+    del new_d['compact_arrays']
+    new_d['calculations'] = []
+    for calc in d.get('calculations', []):
+        calc = dict(calc)
+        if 'output' in calc:
+            calc['output'] = _expand(calc['output'], fs)
+        new_d['calculations'].append(calc)
+    return new_d
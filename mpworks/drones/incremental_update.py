@@ -0,0 +1,118 @@
+"""
+Minimal updates of task documents that are already in the database. When
+MPVaspDrone reprocesses a run (update_duplicates), most of the new document is
+identical to the stored one; instead of $set-ing all of it, the hashes of its
+fields (top-level keys, and the keys of each calculations[i]) are compared
+with those stored with the old document in 'field_hashes', and only the fields
+that changed are $set (or $unset, if they are gone).
+
+The GridFS blobs of a document (DOS, compacted arrays) get new ids each time
+the run is reprocessed; given their content hashes, their ids are hashed as
+that content, so that an unchanged blob does not count as a change.
+"""
+
+import hashlib
+from bson.objectid import ObjectId
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'Jun 05, 2013'
+
+HASH_KEY = 'field_hashes'
+
+
+def _update_hash(h, obj, blob_hashes):
+    # canonical: dict keys sorted, types included
+    if isinstance(obj, dict):
+        h.update('{')
+        for k in sorted(obj.keys()):
+            h.update(repr(k))
+            h.update(':')
+            _update_hash(h, obj[k], blob_hashes)
+        h.update('}')
+    elif isinstance(obj, (list, tuple)):
+        h.update('[')
+        for v in obj:
+            _update_hash(h, v, blob_hashes)
+            h.update(',')
+        h.update(']')
+    elif isinstance(obj, ObjectId) and obj in blob_hashes:
+        h.update('blob')
+        h.update(blob_hashes[obj])
+    else:
+        h.update(type(obj).__name__)
+        h.update(repr(obj))
+
+
+def get_hash(obj, blob_hashes=None):
+    h = hashlib.sha1()
+    _update_hash(h, obj, blob_hashes or {})
+    return h.hexdigest()
+
+
+def get_field_hashes(d, blob_hashes=None):
+    """
+    :param d: (dict) a task document
+    :param blob_hashes: (dict) {gridfs_id: hash of the content} of the blobs
+    referenced by d
+    :return: (dict) {'top': {key: hash}, 'calculations': [{key: hash}]}, to
+    be stored in the document under HASH_KEY
+    """
+    top = {}
+    for k, v in d.items():
+        if k not in [HASH_KEY, 'calculations']:
+            top[k] = get_hash(v, blob_hashes)
+    calcs = [dict([(k, get_hash(v, blob_hashes)) for k, v in calc.items()])
+             for calc in d.get('calculations', [])]
+    return {'top': top, 'calculations': calcs}
+
+
+def get_update(old_hashes, d, blob_hashes=None):
+    """
+    :param old_hashes: (dict) HASH_KEY of the stored document, None if it has
+    none (it was inserted before hashes were kept)
+    :param d: (dict) the new task document
+    :param blob_hashes: (dict) {gridfs_id: hash of the content} of the blobs
+    just put in GridFS for d
+    :return: (dict, [str]) the Mongo update document (with the new hashes),
+    and the paths that changed
+    """
+    new_hashes = get_field_hashes(d, blob_hashes)
+    if not old_hashes:
+        doc = dict(d)
+        doc[HASH_KEY] = new_hashes
+        return {'$set': doc}, sorted(d.keys())
+
+    to_set, to_unset = {}, {}
+    for k, h in new_hashes['top'].items():
+        if old_hashes['top'].get(k) != h:
+            to_set[k] = d[k]
+    for k in old_hashes['top']:
+        if k not in new_hashes['top']:
+            to_unset[k] = 1
+
+    old_calcs, new_calcs = old_hashes['calculations'], new_hashes['calculations']
+    if len(old_calcs) != len(new_calcs):
+        # a different number of calculations: replace them all
+        if 'calculations' in d:
+            to_set['calculations'] = d['calculations']
+        else:
+            to_unset['calculations'] = 1
+    else:
+        for i, (old_calc, new_calc) in enumerate(zip(old_calcs, new_calcs)):
+            for k, h in new_calc.items():
+                if old_calc.get(k) != h:
+                    to_set['calculations.{}.{}'.format(i, k)] = d['calculations'][i][k]
+            for k in old_calc:
+                if k not in new_calc:
+                    to_unset['calculations.{}.{}'.format(i, k)] = 1
+
+    changed = sorted(to_set.keys()) + sorted(to_unset.keys())
+    to_set[HASH_KEY] = new_hashes
+    update = {'$set': to_set}
+    if to_unset:
+        update['$unset'] = to_unset
+    return update, changed
@@ -1,17 +1,24 @@
 import json
 import os
 import datetime
+import hashlib
+import inspect
 import logging
+import traceback
+from bson.objectid import ObjectId
 from pymongo import MongoClient
 import gridfs
 from matgendb.creator import VaspToDbTaskDrone
-from mpworks.drones.signals import VASPInputsExistSignal, \
-    VASPOutputsExistSignal, VASPOutSignal, HitAMemberSignal, SegFaultSignal, \
-    VASPStartedCompletedSignal, WallTimeSignal, DiskSpaceExceededSignal, \
-    SignalDetectorList
+from mpworks.drones.compact_arrays import compact_task_doc, ARRAY_FS
+from mpworks.drones.incremental_update import get_update, HASH_KEY
+from mpworks.drones import signals as signals_module
+from mpworks.drones.signal_rules import get_rule_set
+from mpworks.firetasks.mongo_profiler import profiled, profile_collection
+from mpworks.firetasks.task_timing import span, count, MONGO_ROUND_TRIPS
 from mpworks.snl_utils.snl_mongo import SNLMongoAdapter
 from pymatgen.core.structure import Structure
 from pymatgen.matproj.snl import StructureNL
+from pymatgen.util.io_utils import zpath
 
 __author__ = 'Anubhav Jain'
 __copyright__ = 'Copyright 2013, The Materials Project'
@@ -22,19 +29,148 @@ __date__ = 'Mar 26, 2013'
 
 logger = logging.getLogger(__name__)
 
-
 def is_valid_vasp_dir(mydir):
     # note that the OUTCAR and POSCAR are known to be empty in some
     # situations
     files = ["OUTCAR", "POSCAR", "INCAR", "KPOINTS"]
     for f in files:
-        m_file = os.path.join(mydir, f)
+        m_file = zpath(os.path.join(mydir, f))
         if not (os.path.exists(m_file) and os.stat(m_file).st_size > 0):
             return False
     return True
 
 
+def _get_signal_dirs(dir_name):
+    """
+    :return: (last_relax_dir, [dirs searched for *.error files], new_style)
+    """
+    new_style = os.path.exists(os.path.join(dir_name, 'FW.json'))
+    last_relax_dir = dir_name
+    error_dirs = [dir_name]
+
+    if not new_style:
+        # get the last relaxation dir
+        # the order is relax2, current dir, then relax1. This is because
+        # after completing relax1, the job happens in the current dir.
+        # Finally, it gets moved to relax2.
+        # There are some weird cases where both the current dir and relax2
+        # contain data. The relax2 is good, but the current dir is bad.
+        if is_valid_vasp_dir(os.path.join(dir_name, "relax2")):
+            last_relax_dir = os.path.join(dir_name, "relax2")
+        elif is_valid_vasp_dir(dir_name):
+            pass
+        elif is_valid_vasp_dir(os.path.join(dir_name, "relax1")):
+            last_relax_dir = os.path.join(dir_name, "relax1")
+        error_dirs.append(os.path.dirname(dir_name))  # one level above dir_name
+
+    return last_relax_dir, error_dirs, new_style
+
+
+def get_signals_fingerprint(dir_name):
+    """
+    A hash of the signal detection code, of the signal rules and of the names,
+    sizes and mtimes of the files they read for dir_name: if it did not
+    change, neither did the signals
+    """
+    rule_set = get_rule_set()
+    h = hashlib.sha1()
+    h.update(inspect.getsource(signals_module))
+    h.update(rule_set.version)
+    last_relax_dir, error_dirs, _ = _get_signal_dirs(dir_name)
+    for filename in rule_set.get_files(last_relax_dir, error_dirs):
+        if os.path.exists(filename):
+            st = os.stat(filename)
+            h.update('{}:{}:{}'.format(filename, st.st_size, st.st_mtime))
+        else:
+            h.update('{}:missing'.format(filename))
+    return h.hexdigest()
+
+
+def get_vasp_signals(dir_name):
+    """
+    Run the signal rules (see signal_rules) on a run dir
+
+    :param dir_name: (str) the dir given to MPVaspDrone.assimilate
+    :return: (dict) the 'vasp_signals' of the task document
+    """
+    last_relax_dir, error_dirs, _ = _get_signal_dirs(dir_name)
+    vasp_signals = {'last_relax_dir': last_relax_dir}
+    ## see what error signals are present
+
+    print "getting signals for dir :{}".format(last_relax_dir)
+
+    rule_set = get_rule_set()
+    with span('signals'):
+        signals = list(rule_set.detect(last_relax_dir, error_dirs))
+
+    critical_signals = rule_set.get_critical(signals)
+
+    vasp_signals['signals'] = signals
+    vasp_signals['critical_signals'] = critical_signals
+
+    vasp_signals['num_signals'] = len(signals)
+    vasp_signals['num_critical'] = len(critical_signals)
+    vasp_signals['rules_version'] = rule_set.version
+    vasp_signals['fingerprint'] = get_signals_fingerprint(dir_name)
+    return vasp_signals
+
+
+def get_state(state, critical_signals):
+    """
+    :param state: (str) the state of the parsed run; 'error' if it was
+    already set from earlier signals
+    :param critical_signals: ([str])
+    :return: (str) the state of the task
+    """
+    # only successful runs are turned into errors
+    if state == 'error':
+        state = 'successful'
+    return 'error' if critical_signals and state == 'successful' else state
+
+
+def _get_blobs(obj):
+    """
+    :param obj: a task doc, or a part of one
+    :return: ([(str, ObjectId)]) the GridFS collection and id of the DOS and
+    compacted array blobs obj refers to
+    """
+    if isinstance(obj, dict):
+        if "@array" in obj:
+            return [(ARRAY_FS, obj["@array"]["gridfs_id"])] \
+                if "gridfs_id" in obj["@array"] else []
+        blobs = []
+        for k, v in obj.items():
+            if k == "dos_fs_id" and isinstance(v, ObjectId):
+                blobs.append(("dos_fs", v))
+            else:
+                blobs.extend(_get_blobs(v))
+        return blobs
+    if isinstance(obj, list):
+        return [b for v in obj for b in _get_blobs(v)]
+    return []
+
+
+def _get_field(d, path):
+    # the value at a dotted path of get_update(), None if it is not there
+    for k in path.split("."):
+        try:
+            d = d[int(k)] if isinstance(d, list) else d[k]
+        except (KeyError, IndexError, ValueError, TypeError):
+            return None
+    return d
+
+
 class MPVaspDrone(VaspToDbTaskDrone):
+    def __init__(self, *args, **kwargs):
+        """
+        Takes the arguments of VaspToDbTaskDrone, and compact_arrays: if True,
+        the numeric arrays of the calculations are stored as binary blobs
+        (see compact_arrays.compact_task_doc)
+        """
+        self.compact_arrays = kwargs.pop('compact_arrays', False)
+        VaspToDbTaskDrone.__init__(self, *args, **kwargs)
+
+    @profiled
     def assimilate(self, path):
         """
         Parses vasp runs. Then insert the result into the db. and return the
@@ -45,51 +181,24 @@ class MPVaspDrone(VaspToDbTaskDrone):
             purposes. Else, only the task_id of the inserted doc is returned.
         """
 
-        d = self.get_task_doc(path, self.parse_dos,
-                              self.additional_fields)
+        with span('parse'):
+            d = self.get_task_doc(path, self.parse_dos,
+                                  self.additional_fields)
         if not self.simulate:
             # Perform actual insertion into db. Because db connections cannot
             # be pickled, every insertion needs to create a new connection
             # to the db.
-            conn = MongoClient(self.host, self.port)
-            db = conn[self.database]
-            if self.user:
-                db.authenticate(self.user, self.password)
-            coll = db[self.collection]
-
-            # Insert dos data into gridfs and then remove it from the dict.
-            # DOS data tends to be above the 4Mb limit for mongo docs. A ref
-            # to the dos file is in the dos_fs_id.
+            db, coll = self._get_db()
             result = coll.find_one({"dir_name": d["dir_name"]},
-                                   fields=["dir_name", "task_id"])
+                                   fields=["dir_name", "task_id", HASH_KEY])
+            count(MONGO_ROUND_TRIPS)
             if result is None or self.update_duplicates:
-                if self.parse_dos and "calculations" in d:
-                    for calc in d["calculations"]:
-                        if "dos" in calc:
-                            dos = json.dumps(calc["dos"])
-                            fs = gridfs.GridFS(db, "dos_fs")
-                            dosid = fs.put(dos)
-                            calc["dos_fs_id"] = dosid
-                            del calc["dos"]
-
-                d["last_updated"] = datetime.datetime.today()
-                if result is None:
-                    if ("task_id" not in d) or (not d["task_id"]):
-                        d["task_id"] = db.counter.find_and_modify(
-                            query={"_id": "taskid"},
-                            update={"$inc": {"c": 1}}
-                        )["c"]
-                    logger.info("Inserting {} with taskid = {}"
-                                .format(d["dir_name"], d["task_id"]))
-                elif self.update_duplicates:
-                    d["task_id"] = result["task_id"]
-                    logger.info("Updating {} with taskid = {}"
-                                .format(d["dir_name"], d["task_id"]))
-
-                #Fireworks processing
-                self.process_fw(path, d)
-                coll.update({"dir_name": d["dir_name"]}, {"$set": d},
-                            upsert=True)
+                task_id = None
+                if result is None and not d.get("task_id"):
+                    task_id = self._get_task_ids(db, 1)[0]
+                update, changed, blobs = self._prepare_doc(path, d, db, result, task_id)
+                with span('insert'):
+                    self._write_doc(db, coll, d, result, update, changed, blobs)
                 return d["task_id"], d
             else:
                 logger.info("Skipping duplicate {}".format(d["dir_name"]))
@@ -99,6 +208,153 @@ class MPVaspDrone(VaspToDbTaskDrone):
                         .format(d["dir_name"], d["task_id"]))
             return 0, d
 
+    @profiled
+    def insert_task_docs(self, items):
+        """
+        Insert task docs parsed elsewhere (e.g. in a worker pool, see
+        insertion_service): one query for the docs already there and one for
+        the new task_ids, then each doc is processed and written on its own,
+        so that a bad doc does not take the others down with it.
+
+        :param items: ([(str, dict)]) run dirs and their docs from
+        get_task_doc()
+        :return: ([(int, str)]) the task_id and error (a traceback) of each
+        item, in the same order; the task_id is None for skipped duplicates
+        and failed docs
+        """
+        db, coll = self._get_db()
+        dir_names = [d["dir_name"] for _, d in items]
+        results = dict([(r["dir_name"], r) for r in coll.find(
+            {"dir_name": {"$in": dir_names}}, fields=["dir_name", "task_id", HASH_KEY])])
+        count(MONGO_ROUND_TRIPS)
+
+        seen = set()
+        todo = []
+        for i, (path, d) in enumerate(items):
+            result = results.get(d["dir_name"])
+            if d["dir_name"] in seen or (result is not None and not self.update_duplicates):
+                logger.info("Skipping duplicate {}".format(d["dir_name"]))
+                continue
+            seen.add(d["dir_name"])
+            todo.append((i, path, d, result))
+
+        n_ids = len([1 for _, _, d, result in todo if result is None and not d.get("task_id")])
+        task_ids = self._get_task_ids(db, n_ids) if n_ids else []
+        outcomes = [(None, None)] * len(items)
+        for i, path, d, result in todo:
+            task_id = task_ids.pop(0) if result is None and not d.get("task_id") else None
+            try:
+                update, changed, blobs = self._prepare_doc(path, d, db, result, task_id)
+                with span('insert'):
+                    self._write_doc(db, coll, d, result, update, changed, blobs)
+                outcomes[i] = (d["task_id"], None)
+            except Exception:
+                # the reserved task_id is lost, as when assimilate() fails
+                outcomes[i] = (None, traceback.format_exc())
+        return outcomes
+
+    def _get_db(self):
+        conn = MongoClient(self.host, self.port)
+        db = conn[self.database]
+        if self.user:
+            db.authenticate(self.user, self.password)
+            count(MONGO_ROUND_TRIPS)
+        return db, profile_collection(db[self.collection])
+
+    def _get_task_ids(self, db, n):
+        # reserve n consecutive task_ids
+        c = profile_collection(db.counter).find_and_modify(
+            query={"_id": "taskid"}, update={"$inc": {"c": n}})["c"]
+        count(MONGO_ROUND_TRIPS)
+        return range(c, c + n)
+
+    def _prepare_doc(self, path, d, db, result, task_id):
+        """
+        Everything between parsing a run and writing its doc: the DOS goes to
+        GridFS, the task_id is set, the FireWorks processing is done, and the
+        arrays are compacted
+
+        :param result: (dict) dir_name, task_id and hashes of the doc already
+        in the database, None if there is none
+        :param task_id: (int) for a new doc that has none
+        :return: (dict, [str], [(str, ObjectId)]) the Mongo update of the doc,
+        the paths it changes and the GridFS blobs of the doc
+        """
+        blob_hashes = {}
+        # Insert dos data into gridfs and then remove it from the dict.
+        # DOS data tends to be above the 4Mb limit for mongo docs. A ref
+        # to the dos file is in the dos_fs_id.
+        if self.parse_dos and "calculations" in d:
+            for calc in d["calculations"]:
+                if "dos" in calc:
+                    dos = json.dumps(calc["dos"])
+                    fs = gridfs.GridFS(db, "dos_fs")
+                    with span('gridfs'):
+                        dosid = fs.put(dos)
+                    count(MONGO_ROUND_TRIPS)
+                    blob_hashes[dosid] = hashlib.sha1(dos).hexdigest()
+                    calc["dos_fs_id"] = dosid
+                    del calc["dos"]
+
+        d["last_updated"] = datetime.datetime.today()
+        if result is None:
+            if task_id is not None:
+                d["task_id"] = task_id
+            logger.info("Inserting {} with taskid = {}"
+                        .format(d["dir_name"], d["task_id"]))
+        elif self.update_duplicates:
+            d["task_id"] = result["task_id"]
+            logger.info("Updating {} with taskid = {}"
+                        .format(d["dir_name"], d["task_id"]))
+
+        #Fireworks processing
+        with span('process_fw'):
+            self.process_fw(path, d)
+        doc = d
+        if self.compact_arrays:
+            with span('compact'):
+                doc = compact_task_doc(d, db, blob_hashes=blob_hashes)
+        # only the fields that changed, if the doc is already there
+        update, changed = get_update(result.get(HASH_KEY) if result else None, doc,
+                                     blob_hashes)
+        if result is not None:
+            logger.info("Updating fields {} of {}".format(changed, d["dir_name"]))
+        return update, changed, _get_blobs(doc)
+
+    def _write_doc(self, db, coll, d, result, update, changed, blobs):
+        """
+        Write the update of a doc, then delete the GridFS blobs nothing refers
+        to any more: those of the fields it replaced, and the ones just put for
+        the fields it left alone (their content did not change)
+
+        :param result: (dict) as in _prepare_doc()
+        :param update: (dict),
+        :param changed: ([str]) and
+        :param blobs: ([(str, ObjectId)]) as returned by _prepare_doc()
+        """
+        old = None
+        if result is not None and changed:
+            # the replaced fields, for their blobs
+            fields = set([p if not p.startswith("calculations.")
+                          else "calculations." + p.split(".", 2)[2] for p in changed])
+            old = coll.find_one({"dir_name": d["dir_name"]}, fields=list(fields))
+            count(MONGO_ROUND_TRIPS)
+        coll.update({"dir_name": d["dir_name"]}, update, upsert=True)
+        count(MONGO_ROUND_TRIPS)
+
+        stale = []
+        if old:
+            for p in changed:
+                stale.extend(_get_blobs({p.split(".")[-1]: _get_field(old, p)}))
+        used = set(_get_blobs(dict([(p.split(".")[-1], v)
+                                    for p, v in update["$set"].items()])))
+        stale.extend([b for b in blobs if b not in used])
+        for fs_name, blob_id in stale:
+            gridfs.GridFS(db, fs_name).delete(blob_id)
+            count(MONGO_ROUND_TRIPS)
+        if stale:
+            logger.info("Deleted {} unused blobs of {}".format(len(stale), d["dir_name"]))
+
     def process_fw(self, dir_name, d):
         # custom Materials Project post-processing for FireWorks
         with open(os.path.join(dir_name, 'FW.json')) as f:
@@ -111,6 +367,16 @@ class MPVaspDrone(VaspToDbTaskDrone):
             d['vaspinputset_name'] = fw_dict['spec'].get('vaspinputset_name')
             d['task_type'] = fw_dict['spec']['task_type']
 
+            # ranks and NPAR/KPAR used for the run, see VaspCustodianTask
+            if os.path.exists(os.path.join(dir_name, 'launch_layout.json')):
+                with open(os.path.join(dir_name, 'launch_layout.json')) as f2:
+                    d['launch_layout'] = json.load(f2)
+
+            # disk saved and CPU spent compressing the outputs, see OutputCompressor
+            if os.path.exists(os.path.join(dir_name, 'compression.json')):
+                with open(os.path.join(dir_name, 'compression.json')) as f2:
+                    d['compression'] = json.load(f2)
+
             if 'optimize structure' in d['task_type'] and 'output' in d:
                 # create a new SNL based on optimized structure
                 new_s = Structure.from_dict(d['output']['crystal'])
@@ -138,67 +404,6 @@ class MPVaspDrone(VaspToDbTaskDrone):
                                          d['snlgroup_id_final'])
 
         # custom processing for detecting errors
-        new_style = os.path.exists(os.path.join(dir_name, 'FW.json'))
-        vasp_signals = {}
-        critical_errors = ["INPUTS_DONT_EXIST",
-                           "OUTPUTS_DONT_EXIST", "INCOHERENT_POTCARS",
-                           "VASP_HASNT_STARTED", "VASP_HASNT_COMPLETED",
-                           "CHARGE_UNCONVERGED", "NETWORK_QUIESCED",
-                           "HARD_KILLED", "WALLTIME_EXCEEDED",
-                           "ATOMS_TOO_CLOSE", "DISK_SPACE_EXCEEDED"]
-
-        last_relax_dir = dir_name
-
-        if not new_style:
-            # get the last relaxation dir
-            # the order is relax2, current dir, then relax1. This is because
-            # after completing relax1, the job happens in the current dir.
-            # Finally, it gets moved to relax2.
-            # There are some weird cases where both the current dir and relax2
-            # contain data. The relax2 is good, but the current dir is bad.
-            if is_valid_vasp_dir(os.path.join(dir_name, "relax2")):
-                last_relax_dir = os.path.join(dir_name, "relax2")
-            elif is_valid_vasp_dir(dir_name):
-                pass
-            elif is_valid_vasp_dir(os.path.join(dir_name, "relax1")):
-                last_relax_dir = os.path.join(dir_name, "relax1")
-
-        vasp_signals['last_relax_dir'] = last_relax_dir
-        ## see what error signals are present
-
-        print "getting signals for dir :{}".format(last_relax_dir)
-
-        sl = SignalDetectorList()
-        sl.append(VASPInputsExistSignal())
-        sl.append(VASPOutputsExistSignal())
-        sl.append(VASPOutSignal())
-        sl.append(HitAMemberSignal())
-        sl.append(SegFaultSignal())
-        sl.append(VASPStartedCompletedSignal())
-
-        signals = sl.detect_all(last_relax_dir)
-
-        signals = signals.union(WallTimeSignal().detect(dir_name))
-        if not new_style:
-            root_dir = os.path.dirname(dir_name)  # one level above dir_name
-            signals = signals.union(WallTimeSignal().detect(root_dir))
-
-        signals = signals.union(DiskSpaceExceededSignal().detect(dir_name))
-        if not new_style:
-            root_dir = os.path.dirname(dir_name)  # one level above dir_name
-            signals = signals.union(DiskSpaceExceededSignal().detect(root_dir))
-
-        signals = list(signals)
-
-        critical_signals = [val for val in signals if val in critical_errors]
-
-        vasp_signals['signals'] = signals
-        vasp_signals['critical_signals'] = critical_signals
-
-        vasp_signals['num_signals'] = len(signals)
-        vasp_signals['num_critical'] = len(critical_signals)
-
-        if len(critical_signals) > 0 and d['state'] == "successful":
-            d["state"] = "error"
-
-        d['vasp_signals'] = vasp_signals
\ No newline at end of file
+        vasp_signals = get_vasp_signals(dir_name)
+        d['state'] = get_state(d['state'], vasp_signals['critical_signals'])
+        d['vasp_signals'] = vasp_signals
@@ -0,0 +1,116 @@
+"""
+Re-evaluate the signals of tasks already in the database, e.g. after a new
+pattern was added to the signal rules (see signal_rules), without
+reparsing the VASP outputs: only the signal detectors are run again over the
+run dirs, and only vasp_signals and state are updated.
+
+A task is skipped if its vasp_signals.fingerprint (see
+get_signals_fingerprint) still matches, i.e. neither the signal detection code
+nor the files it reads changed since the signals were computed.
+"""
+
+import logging
+import os
+import traceback
+from multiprocessing import Pool
+from mpworks.drones.incremental_update import get_hash, HASH_KEY
+from mpworks.drones.mp_vaspdrone import get_vasp_signals, get_signals_fingerprint, \
+    get_state
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'Jun 06, 2013'
+
+logger = logging.getLogger(__name__)
+
+
+def get_local_dir(dir_name):
+    # task docs store dir_name as <host>:<path>
+    return dir_name.split(':', 1)[1] if ':' in dir_name else dir_name
+
+
+def _normalize(vasp_signals):
+    # the signals come from a set: compare them regardless of order
+    return dict([(k, sorted(v) if isinstance(v, list) else v)
+                 for k, v in vasp_signals.items() if k != 'fingerprint'])
+
+
+def _refresh_task(args):
+    """
+    Runs in the worker processes
+
+    :return: (task_id, new vasp_signals or None if skipped, new state, error)
+    """
+    task_id, dir_name, state, fingerprint, force = args
+    try:
+        if not os.path.isdir(dir_name):
+            return task_id, None, state, 'missing dir {}'.format(dir_name)
+        if not force and fingerprint and fingerprint == get_signals_fingerprint(dir_name):
+            return task_id, None, state, None
+        vasp_signals = get_vasp_signals(dir_name)
+        return task_id, vasp_signals, get_state(state, vasp_signals['critical_signals']), None
+    except Exception:
+        return task_id, None, state, traceback.format_exc()
+
+
+def refresh_signals(coll, query=None, nprocs=1, force=False, dry_run=False):
+    """
+    :param coll: (pymongo Collection) the tasks collection
+    :param query: (dict) restricts the tasks, e.g. {'task_type': 'GGA optimize structure (2x)'}
+    :param nprocs: (int) processes running the detectors
+    :param force: (bool) rerun the detectors even if the fingerprint matches
+    :param dry_run: (bool) don't update the database
+    :return: (dict) counts of the tasks skipped, unchanged, updated and
+    failed, and the state changes ('<old> -> <new>': n)
+    """
+    fields = {'task_id': 1, 'dir_name': 1, 'state': 1, 'vasp_signals': 1,
+              HASH_KEY + '.top.state': 1}
+    tasks = {}
+    work = []
+    for t in coll.find(query if query else {}, fields):
+        tasks[t['task_id']] = t
+        fingerprint = t.get('vasp_signals', {}).get('fingerprint')
+        work.append((t['task_id'], get_local_dir(t['dir_name']), t['state'], fingerprint, force))
+
+    stats = {'n_tasks': len(work), 'skipped': 0, 'unchanged': 0, 'updated': 0, 'errors': 0,
+             'state_changes': {}}
+    pool = Pool(nprocs) if nprocs > 1 else None
+    results = pool.imap_unordered(_refresh_task, work, chunksize=16) if pool \
+        else (_refresh_task(w) for w in work)
+    try:
+        for task_id, vasp_signals, state, error in results:
+            t = tasks[task_id]
+            if error:
+                logger.error('Task {}: {}'.format(task_id, error))
+                stats['errors'] += 1
+                continue
+            if vasp_signals is None:
+                stats['skipped'] += 1
+                continue
+
+            changed = _normalize(t.get('vasp_signals', {})) != _normalize(vasp_signals) or \
+                state != t['state']
+            stats['updated' if changed else 'unchanged'] += 1
+            if state != t['state']:
+                change = '{} -> {}'.format(t['state'], state)
+                stats['state_changes'][change] = stats['state_changes'].get(change, 0) + 1
+            if dry_run:
+                continue
+
+            to_set = {'vasp_signals': vasp_signals} if changed \
+                else {'vasp_signals.fingerprint': vasp_signals['fingerprint']}
+            if changed:
+                to_set['state'] = state
+            if HASH_KEY in t:
+                # keep the hashes of the incremental updates in line
+                to_set[HASH_KEY + '.top.vasp_signals'] = get_hash(vasp_signals)
+                to_set[HASH_KEY + '.top.state'] = get_hash(str(state))
+            coll.update({'task_id': task_id}, {'$set': to_set})
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return stats
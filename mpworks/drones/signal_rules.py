@@ -0,0 +1,217 @@
+"""
+The registry of the signals detected in VASP run dirs. The rules are declared
+in signal_rules.yaml (see the comments there for the format), plus any rule
+files listed in $MP_SIGNAL_RULES (separated by ':'), which replace the rules
+of the signals they name; new error patterns can thus be added without code
+changes.
+
+The rules are compiled into a SignalRuleSet: the pattern rules are grouped by
+file, and each file is searched once for all of its patterns (see
+FileMatcher). get_rule_set() compiles them once per process, and again only
+if a rule file changes.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import re
+import yaml
+from mpworks.drones.signals import FileMatcher, last_file
+from pymatgen.util.io_utils import zpath
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'Jun 10, 2013'
+
+DEFAULT_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'signal_rules.yaml')
+SEVERITIES = ['critical', 'warning']
+DIRS = ['run', 'error']
+RULE_KEYS = ['signal', 'severity', 'dirs', 'files', 'pattern', 'regex', 'ignore_case',
+             'invert', 'region', 'require_files', 'require_nonempty', 'disabled']
+
+# the compiled rules of this process, see get_rule_set()
+_cache = {'key': None, 'rule_set': None}
+
+
+def _parse_region(region):
+    if not region:
+        return None
+    kind, n = region.split(':')
+    if kind not in ['head', 'tail']:
+        raise ValueError('Invalid region: {}'.format(region))
+    return kind, int(n)
+
+
+def _check_rule(rule):
+    name = rule.get('signal')
+    if not name:
+        raise ValueError('Signal rule without a signal name: {}'.format(rule))
+    unknown = [k for k in rule if k not in RULE_KEYS]
+    if unknown:
+        raise ValueError('Signal rule {}: unknown keys {}'.format(name, unknown))
+    if rule.get('severity', 'warning') not in SEVERITIES:
+        raise ValueError('Signal rule {}: severity must be one of {}'.format(name, SEVERITIES))
+    if rule.get('dirs', 'run') not in DIRS:
+        raise ValueError('Signal rule {}: dirs must be one of {}'.format(name, DIRS))
+    if ('pattern' in rule) == ('require_files' in rule or 'require_nonempty' in rule):
+        raise ValueError('Signal rule {}: needs either a pattern and files, or '
+                         'require_files/require_nonempty'.format(name))
+    if 'pattern' in rule:
+        if not rule.get('files'):
+            raise ValueError('Signal rule {}: no files to search'.format(name))
+        if rule.get('regex'):
+            re.compile(rule['pattern'])
+        _parse_region(rule.get('region'))
+
+
+def load_rules(filenames):
+    """
+    :param filenames: ([str]) rule files (YAML or JSON), later ones replacing
+    the rules of the signals they name
+    :return: ([dict], str) the rules, and their version
+    """
+    rules = []
+    versions = []
+    for filename in filenames:
+        with open(filename) as f:
+            d = json.load(f) if filename.endswith('.json') else yaml.safe_load(f)
+        file_rules = d.get('rules', [])
+        for rule in file_rules:
+            _check_rule(rule)
+        names = set([r['signal'] for r in file_rules])
+        rules = [r for r in rules if r['signal'] not in names] + \
+            [r for r in file_rules if not r.get('disabled')]
+        versions.append(str(d.get('version', 0)))
+    h = hashlib.sha1(json.dumps(rules, sort_keys=True)).hexdigest()
+    return rules, '{}-{}'.format('.'.join(versions), h[:8])
+
+
+class SignalRuleSet():
+    """
+    The compiled signal rules
+    """
+
+    def __init__(self, rules, version=None):
+        """
+        :param rules: ([dict]) see signal_rules.yaml
+        :param version: (str) stored with the signals, see load_rules()
+        """
+        self.rules = rules
+        self.version = version
+        self.critical = set([r['signal'] for r in rules if r.get('severity') == 'critical'])
+        # (file spec, region) -> (FileMatcher, {key: rule})
+        self.matchers = {}
+        self.require_rules = []
+        for i, rule in enumerate(rules):
+            if 'pattern' not in rule:
+                self.require_rules.append(rule)
+                continue
+            ignore_case = rule.get('ignore_case', True)
+            for spec in rule['files']:
+                group = self.matchers.setdefault((spec, rule.get('region')), ([], [], {}))
+                if rule.get('regex'):
+                    flags = re.IGNORECASE if ignore_case else 0
+                    group[1].append((i, re.compile(str(rule['pattern']), flags)))
+                else:
+                    group[0].append((i, rule['pattern'], ignore_case))
+                group[2][i] = rule
+        self.matchers = dict([(k, (FileMatcher(literals, regexes), key_rules))
+                              for k, (literals, regexes, key_rules) in self.matchers.items()])
+
+    @staticmethod
+    def _resolve(dir_name, spec):
+        # the files a spec stands for in dir_name
+        path = os.path.join(dir_name, spec)
+        if glob.has_magic(spec):
+            return sorted(glob.glob(path))
+        # like SignalDetectorSimple: the last relaxation's file, if the file is there
+        return [last_file(path)] if os.path.exists(zpath(path)) else []
+
+    def _get_dirs(self, rule, run_dir, error_dirs):
+        return error_dirs if rule.get('dirs') == 'error' else [run_dir]
+
+    def get_files(self, run_dir, error_dirs):
+        """
+        :return: ([str]) every file the rules look at (existing or not), e.g.
+        to fingerprint them
+        """
+        files = set()
+        for (spec, _), (_, key_rules) in self.matchers.items():
+            for rule in key_rules.values():
+                for d in self._get_dirs(rule, run_dir, error_dirs):
+                    files.update(self._resolve(d, spec))
+        for rule in self.require_rules:
+            for name in rule.get('require_files', []) + rule.get('require_nonempty', []):
+                files.add(last_file(os.path.join(run_dir, name)))
+        return sorted(files)
+
+    def detect(self, run_dir, error_dirs=None):
+        """
+        :param run_dir: (str) the last relaxation dir
+        :param error_dirs: ([str]) the dirs of the scheduler error files
+        (default: run_dir)
+        :return: (set) the signals found
+        """
+        error_dirs = error_dirs if error_dirs else [run_dir]
+        signals = set()
+
+        for (spec, region), (matcher, key_rules) in self.matchers.items():
+            # which rules apply to which files, so that each file is read once
+            file_keys = {}
+            for key, rule in key_rules.items():
+                for d in self._get_dirs(rule, run_dir, error_dirs):
+                    for filename in self._resolve(d, spec):
+                        file_keys.setdefault(filename, set()).add(key)
+            for filename, keys in file_keys.items():
+                if all([key_rules[k]['signal'] in signals and not key_rules[k].get('invert')
+                        for k in keys]):
+                    continue
+                found = matcher.match(filename, _parse_region(region))
+                for k in keys:
+                    if (k in found) != bool(key_rules[k].get('invert')):
+                        signals.add(key_rules[k]['signal'])
+
+        for rule in self.require_rules:
+            names = [last_file(os.path.join(run_dir, x)) for x in rule.get('require_files', [])]
+            nonempty = [last_file(os.path.join(run_dir, x))
+                        for x in rule.get('require_nonempty', [])]
+            if not all([os.path.exists(f) for f in names]) or \
+                    not all([os.path.exists(f) and os.stat(f).st_size > 0 for f in nonempty]):
+                signals.add(rule['signal'])
+        return signals
+
+    def get_critical(self, signals):
+        return [s for s in signals if s in self.critical]
+
+    def get_patterns(self, filename):
+        """
+        :return: ([(lower-cased string, signal)]) the case-insensitive literal
+        patterns searched for in filename, e.g. for watching it while VASP runs
+        """
+        return [(r['pattern'].lower(), r['signal']) for r in self.rules
+                if 'pattern' in r and filename in r['files'] and not r.get('regex')
+                and not r.get('invert') and r.get('ignore_case', True)]
+
+
+def get_rule_files():
+    extra = os.environ.get('MP_SIGNAL_RULES')
+    return [DEFAULT_RULES_FILE] + ([f for f in extra.split(':') if f] if extra else [])
+
+
+def get_rule_set():
+    """
+    :return: (SignalRuleSet) compiled from the rule files, cached as long as
+    they don't change
+    """
+    filenames = get_rule_files()
+    key = tuple([(f, os.path.getmtime(f)) for f in filenames])
+    if _cache['key'] != key:
+        rules, version = load_rules(filenames)
+        _cache['rule_set'] = SignalRuleSet(rules, version)
+        _cache['key'] = key
+    return _cache['rule_set']
@@ -1,7 +1,9 @@
 import glob
+import mmap
 import os
 import re
 from pymatgen import zopen
+from pymatgen.util.io_utils import zpath
 
 __author__ = 'Anubhav Jain'
 __copyright__ = 'Copyright 2013, The Materials Project'
@@ -12,39 +14,199 @@ __date__ = 'Apr 29, 2013'
 
 # TODO: This is all really ugly...
 
+# files are searched this many bytes at a time (compressed files are
+# decompressed one chunk at a time)
+CHUNK_SIZE = 4 * 1024 * 1024
+COMPRESSED_EXTENSIONS = ['.GZ', '.Z', '.BZ2']
 
-def last_file(filename):
 
-    relaxations = glob.glob('%s.relax*' % filename)
+def last_file(filename):
+    # the files may have been gzipped after the run (e.g. OUTCAR.relax2.gz)
+    relaxations = sorted(glob.glob('%s.relax*' % filename))
     if relaxations:
         return relaxations[-1]
     else:
-        return filename
+        return zpath(filename)
+
+
+def _iter_chunks(filename, chunk_size=CHUNK_SIZE, region=None):
+    """
+    Yields (buffer, start, end): the file in pieces of about chunk_size bytes
+    that end at a line break (or at the end of the file). Plain files are
+    mmap'd, so no piece is copied into memory; compressed files are read one
+    chunk at a time.
+
+    :param region: ('head', n) for the lines starting in the first n bytes,
+    ('tail', n) for those starting in the last n bytes, None for all
+    """
+    kind, n = region if region else (None, None)
+    if os.path.splitext(filename)[1].upper() in COMPRESSED_EXTENSIONS:
+        with zopen(filename, 'rb') as f:
+            carry, offset, tail = '', 0, ''
+            while True:
+                data = f.read(chunk_size)
+                if kind == 'tail':
+                    # keep the last n bytes, and the one before (is it a line break?)
+                    tail = (tail + data)[-(n + 1):]
+                    if data:
+                        continue
+                    start = 0
+                    if len(tail) > n:
+                        nl = tail.find('\n')
+                        start = len(tail) if nl == -1 else nl + 1
+                    if start < len(tail):
+                        yield tail, start, len(tail)
+                    return
+                if not data:
+                    if carry:
+                        yield carry, 0, len(carry)
+                    return
+                data = carry + data
+                end = data.rfind('\n') + 1
+                if end == 0:  # a line longer than the chunk
+                    carry = data
+                    continue
+                carry = data[end:]
+                yield data, 0, end
+                offset += end
+                if kind == 'head' and offset >= n:
+                    return
+    else:
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start, limit = 0, size
+                if kind == 'head':
+                    limit = min(n, size)
+                elif kind == 'tail' and size > n:
+                    nl = mm.find('\n', size - n - 1)
+                    start = size if nl == -1 else nl + 1
+                while start < limit:
+                    end = min(start + chunk_size, size)
+                    if end < size:
+                        nl = mm.rfind('\n', start, end)
+                        if nl == -1:  # a line longer than the chunk
+                            nl = mm.find('\n', end)
+                        end = size if nl == -1 else nl + 1
+                    yield mm, start, end
+                    start = end
+            finally:
+                mm.close()
+
+
+class FileMatcher(object):
+    """
+    Searches a file for several literal strings and regexes in a single pass,
+    with the same result as testing every line for each of them, and stops
+    once all were found.
+
+    Literals are looked for with str.find in each chunk (lower-cased if
+    ignore_case); a string can only match across lines if it has a line break
+    in it, and those are treated as regexes. For the regexes, the alternation
+    of those not found yet runs over the raw bytes, and only the lines it hits
+    are checked regex by regex.
+    """
+
+    def __init__(self, literals=None, regexes=None):
+        """
+        :param literals: ([(key, str, ignore_case)])
+        :param regexes: ([(key, compiled regex)])
+        """
+        self.literals = []
+        self.regexes = list(regexes) if regexes else []
+        for key, s, ignore_case in (literals if literals else []):
+            # the chunks are bytes: a unicode needle would decode each of them
+            s = s.encode('utf-8') if isinstance(s, unicode) else s
+            if '\n' in s.rstrip('\n'):
+                self.regexes.append((key, re.compile(re.escape(s),
+                                                     re.IGNORECASE if ignore_case else 0)))
+            else:
+                self.literals.append((key, s.lower() if ignore_case else s, ignore_case))
+
+    @staticmethod
+    def _get_finder(regexes):
+        # case-insensitive: finds a superset of the lines, which are checked anyway
+        if not regexes:
+            return None
+        return re.compile('|'.join(['(?:{})'.format(rx.pattern) for _, rx in regexes]),
+                          re.IGNORECASE | re.MULTILINE)
+
+    def match(self, filename, region=None, chunk_size=CHUNK_SIZE):
+        """
+        :param filename: (str) plain or compressed file
+        :param region: see _iter_chunks
+        :return: (set) the keys of the literals and regexes found
+        """
+        found = set()
+        literals, regexes = self.literals, self.regexes
+        finder = self._get_finder(regexes)
+        for buf, start, end in _iter_chunks(filename, chunk_size, region):
+            if literals:
+                data = buf[start:end]
+                lower = data.lower() if any([l[2] for l in literals]) else None
+                found.update([key for key, needle, ignore_case in literals
+                              if needle in (lower if ignore_case else data)])
+            pos = start
+            while finder and pos < end:
+                m = finder.search(buf, pos, end)
+                if not m:
+                    break
+                line_start = max(buf.rfind('\n', start, m.start()) + 1, start)
+                line_end = buf.find('\n', m.start(), end)
+                line_end = end if line_end == -1 else line_end + 1
+                line = buf[line_start:line_end]
+                new = [key for key, rx in regexes if key not in found and rx.search(line)]
+                if new:
+                    found.update(new)
+                    regexes = [r for r in regexes if r[0] not in found]
+                    finder = self._get_finder(regexes)
+                pos = line_end
+            literals = [l for l in literals if l[0] not in found]
+            n_regexes = len(regexes)
+            regexes = [r for r in regexes if r[0] not in found]
+            if not literals and not regexes:
+                break
+            if len(regexes) != n_regexes:  # found by a literal with the same key
+                finder = self._get_finder(regexes)
+        return found
+
+
+def search_lines(patterns, filename, chunk_size=CHUNK_SIZE):
+    """
+    :param patterns: ([compiled regex])
+    :param filename: (str) plain or compressed file
+    :return: (set) indices of the patterns that match a line of the file
+    """
+    return FileMatcher(regexes=list(enumerate(patterns))).match(filename, chunk_size=chunk_size)
 
-def string_list_in_file(s_list, filename, ignore_case=True):
-    #based on Michael's code
+
+def string_list_in_file(s_list, filename, ignore_case=True, chunk_size=CHUNK_SIZE):
     """
     args ->
         s_list  (str) : a list of strings in the file
         filename (str) : is the absolute path of the file that is analyzed
 
-    Returns the strings that matched...
+    Returns the strings that matched (s_list itself if all of them did), like
+    testing each line for each string (see FileMatcher)
+    """
+    targets = list(set(s_list))
+    matcher = FileMatcher(literals=[(i, s, ignore_case) for i, s in enumerate(targets)])
+    found = matcher.match(filename, chunk_size=chunk_size)
+    if len(found) == len(targets) == len(s_list):
+        return s_list
+    return [targets[i] for i in found]
 
-    Note: this is going to be slow as mud for huge files (e.g., OUTCAR)
-    Using grep via subprocess might be better, but has dependency of
-    shell (i.e., non-windows)
 
+def regex_in_file(rx, filename, chunk_size=CHUNK_SIZE):
+    """
+    :param rx: (compiled regex)
+    :return: (bool) whether rx matches a line of the file
     """
-    matches = set()
-    with zopen(filename, 'r') as f:
-        for line in f:
-            for s in s_list:
-                if (ignore_case and s.lower() in line.lower()) or s in line:
-                    matches.add(s)
-                    if len(matches) == len(s_list):
-                        return s_list
+    return bool(search_lines([rx], filename, chunk_size))
 
-    return list(matches)
 
 class SignalDetector(object):
     '''
@@ -98,7 +260,7 @@ class SignalDetectorSimple(SignalDetector):
 
         for filename in self.filename_list:
             #find the strings that match in the file
-            if not self.ignore_nonexistent_file or os.path.exists(os.path.join(dir_name, filename)):
+            if not self.ignore_nonexistent_file or os.path.exists(zpath(os.path.join(dir_name, filename))):
                 f = last_file(os.path.join(dir_name, filename))
                 errors = string_list_in_file(self.signames_targetstrings.values(), f, ignore_case=self.ignore_case)
                 if self.invert_search:
@@ -178,6 +340,9 @@ class DiskSpaceExceededSignal(SignalDetector):
         return set()
 
 
+SEGFAULT_RX = re.compile(r'(fault|segmentation)', re.IGNORECASE)
+
+
 class SegFaultSignal(SignalDetector):
 
     def detect(self, dir_name):
@@ -188,13 +353,9 @@ class SegFaultSignal(SignalDetector):
             'forrtl: severe (174): SIGSEGV, segmentation fault occurred'
         """
         file_names = glob.glob("%s/*.error" % dir_name)
-        rx = re.compile(r'(fault|segmentation)', re.IGNORECASE)
         for file_name in file_names:
-            with open(file_name, 'r') as f:
-                lines = f.readlines()
-                for line in lines:
-                    if rx.search(line) is not None:
-                        return set(["SEGFAULT"])
+            if regex_in_file(SEGFAULT_RX, file_name):
+                return set(["SEGFAULT"])
         return set()
 
 
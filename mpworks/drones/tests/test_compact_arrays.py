@@ -0,0 +1,62 @@
+import shutil
+import tempfile
+import unittest
+from mpworks.drones.compact_arrays import compact_task_doc, expand_task_doc
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'Jun 04, 2013'
+
+
+class CompactArraysTest(unittest.TestCase):
+
+    def test_task_doc(self):
+        from mpworks.benchmarks.fixtures import get_structure, write_vasp_run_dir
+        from mpworks.drones.mp_vaspdrone import MPVaspDrone
+        dir_name = tempfile.mkdtemp()
+        try:
+            write_vasp_run_dir(dir_name, get_structure(supercell=2), n_ionic_steps=3,
+                               vasp_out_lines=100, outcar_lines=100)
+            drone = MPVaspDrone(host=None, port=None, database=None, user=None,
+                                password=None, collection=None, parse_dos=False,
+                                simulate_mode=True)
+            d = drone.get_task_doc(dir_name, False, {})
+        finally:
+            shutil.rmtree(dir_name)
+        compacted = compact_task_doc(d)
+        self.assertLess(compacted['compact_arrays']['bytes_after'],
+                        compacted['compact_arrays']['bytes_before'])
+        self.assertEqual(expand_task_doc(compacted), d)
+
+    def test_mixed_types(self):
+        # left as they are: they would not come back with the same types
+        output = {'mixed': [[1, 2.5]] * 10, 'bools': [True, 1] * 10,
+                  'records': [{'nelm': 1, 'e': -1.5}] * 3,
+                  'structure': {'lattice': {'matrix': [[3, 0, 0], [0, 3, 0], [0, 0, 3]]},
+                                'sites': [{'species': [{'element': 'Na', 'occu': 1,
+                                                        'oxidation_state': 1}],
+                                           'abc': [0, 0, 0]}]}}
+        d = {'calculations': [{'output': output}]}
+        compacted = compact_task_doc(d)
+        self.assertEqual(compacted['calculations'][0]['output'], output)
+        self.assertEqual(expand_task_doc(compacted), d)
+
+    def test_types_kept(self):
+        d = {'calculations': [{'output': {'ints': [[1, 2]] * 10, 'floats': [[1.0, 2.5]] * 10,
+                                          'records': [{'nelm': 1, 'nsteps': 2}] * 3}}]}
+        compacted = compact_task_doc(d)
+        output = compacted['calculations'][0]['output']
+        self.assertIn('@array', output['ints'])
+        self.assertIn('@array', output['floats'])
+        self.assertIn('@records', output['records'])
+        expanded = expand_task_doc(compacted)['calculations'][0]['output']
+        self.assertEqual(expanded, d['calculations'][0]['output'])
+        self.assertEqual(type(expanded['ints'][0][0]), int)
+        self.assertEqual(type(expanded['records'][0]['nelm']), int)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import copy
+import unittest
+from bson.objectid import ObjectId
+from mpworks.drones.incremental_update import get_update, get_field_hashes, HASH_KEY
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'Jun 05, 2013'
+
+
+def get_task_doc():
+    return {'dir_name': 'mom:/runs/block_1/launcher_1', 'task_id': 1234,
+            'state': 'successful', 'nsites': 2, 'pretty_formula': 'NaCl',
+            'run_stats': {'relax1': {'Elapsed time (sec)': 120.5}},
+            'calculations': [{'input': {'incar': {'ENCUT': 520, 'ISPIN': 2}},
+                              'output': {'final_energy': -6.5, 'forces': [[0.0, 0.1, 0.2]]}},
+                             {'input': {'incar': {'ENCUT': 520, 'ISPIN': 2}},
+                              'output': {'final_energy': -6.6, 'forces': [[0.0, 0.0, 0.0]]}}]}
+
+
+class GetUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.old = get_task_doc()
+        self.hashes = get_field_hashes(self.old)
+        self.new = get_task_doc()
+
+    def test_unchanged(self):
+        update, changed = get_update(self.hashes, self.new)
+        self.assertEqual(changed, [])
+        self.assertEqual(update, {'$set': {HASH_KEY: self.hashes}})
+
+    def test_changed(self):
+        self.new['state'] = 'error'
+        self.new['calculations'][1]['output']['final_energy'] = -6.7
+        update, changed = get_update(self.hashes, self.new)
+        self.assertEqual(changed, ['calculations.1.output', 'state'])
+        self.assertEqual(update['$set']['state'], 'error')
+        self.assertEqual(update['$set']['calculations.1.output'],
+                         self.new['calculations'][1]['output'])
+        self.assertEqual(update['$set'][HASH_KEY], get_field_hashes(self.new))
+        self.assertNotIn('$unset', update)
+
+    def test_removed(self):
+        del self.new['run_stats']
+        del self.new['calculations'][0]['input']
+        update, changed = get_update(self.hashes, self.new)
+        self.assertEqual(changed, ['calculations.0.input', 'run_stats'])
+        self.assertEqual(update['$unset'], {'run_stats': 1, 'calculations.0.input': 1})
+        self.assertEqual(update['$set'].keys(), [HASH_KEY])
+
+    def test_resized_calculations(self):
+        self.new['calculations'].append(copy.deepcopy(self.new['calculations'][1]))
+        update, changed = get_update(self.hashes, self.new)
+        self.assertEqual(changed, ['calculations'])
+        self.assertEqual(update['$set']['calculations'], self.new['calculations'])
+
+        del self.new['calculations']
+        update, changed = get_update(self.hashes, self.new)
+        self.assertEqual(changed, ['calculations'])
+        self.assertEqual(update['$unset'], {'calculations': 1})
+
+    def test_legacy_doc(self):
+        # inserted before the hashes were kept: the whole doc is set
+        update, changed = get_update(None, self.new)
+        self.assertEqual(changed, sorted(self.new.keys()))
+        expected = dict(self.new)
+        expected[HASH_KEY] = get_field_hashes(self.new)
+        self.assertEqual(update, {'$set': expected})
+
+    def test_blobs(self):
+        # a reprocessed run puts its blobs again, under new ids
+        old_id, new_id = ObjectId(), ObjectId()
+        self.old['calculations'][0]['dos_fs_id'] = old_id
+        self.new['calculations'][0]['dos_fs_id'] = new_id
+        hashes = get_field_hashes(self.old, {old_id: 'dos'})
+        update, changed = get_update(hashes, self.new, {new_id: 'dos'})
+        self.assertEqual(changed, [])
+
+        update, changed = get_update(hashes, self.new, {new_id: 'other dos'})
+        self.assertEqual(changed, ['calculations.0.dos_fs_id'])
+        self.assertEqual(update['$set']['calculations.0.dos_fs_id'], new_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
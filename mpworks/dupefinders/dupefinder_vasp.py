@@ -1,3 +1,5 @@
+import hashlib
+import json
 from fireworks.features.dupefinder import DupeFinderBase
 
 __author__ = 'Anubhav Jain'
@@ -7,19 +9,58 @@ __maintainer__ = 'Anubhav Jain'
 __email__ = 'ajain@lbl.gov'
 __date__ = 'Mar 22, 2013'
 
-# TODO: add Launchpad indices that make this query efficient
+
+def get_dupe_key(spec):
+    """
+    Canonical signature of the task_type and run_tags of a spec. The
+    snlgroup_id is not part of the key because it is only known once the
+    parent FireWorks have run (it arrives through update_spec); instead it
+    is the second field of the compound dupe index.
+    """
+    m_str = json.dumps([spec['task_type'], sorted(set(spec.get('run_tags', [])))])
+    return hashlib.md5(m_str).hexdigest()
+
+
+def ensure_dupe_indices(launchpad):
+    launchpad.fireworks.ensure_index([('spec._dupe_key', 1), ('spec.snlgroup_id', 1)])
+
+
+def backfill_dupe_keys(launchpad):
+    """
+    Write spec._dupe_key for FireWorks that use DupeFinderVasp but were
+    created before the key existed. Returns the number of FireWorks updated.
+    """
+    ensure_dupe_indices(launchpad)
+    n_updated = 0
+    for fw in launchpad.fireworks.find(
+            {'spec._dupefinder._fw_name': DupeFinderVasp._fw_name,
+             'spec._dupe_key': {'$exists': False}},
+            {'fw_id': 1, 'spec.task_type': 1, 'spec.run_tags': 1}):
+        launchpad.fireworks.update({'fw_id': fw['fw_id']},
+                                   {'$set': {'spec._dupe_key': get_dupe_key(fw['spec'])}})
+        n_updated += 1
+    return n_updated
+
 
 class DupeFinderVasp(DupeFinderBase):
     """
-    TODO: add docs
+    Matches FireWorks with the same task_type, snlgroup_id and run_tags.
+    New FireWorks carry a precomputed spec._dupe_key (see get_dupe_key) so
+    that candidates are found with one equality query on an indexed pair.
     """
 
     _fw_name = 'Dupe Finder Vasp'
 
     def verify(self, spec1, spec2):
         # assert: task_type and snlgroup_id have already been checked through query
+        if '_dupe_key' in spec1 and '_dupe_key' in spec2:
+            return spec1['_dupe_key'] == spec2['_dupe_key']
         return set(spec1['run_tags']) == set(spec2['run_tags'])
 
     def query(self, spec):
+        if '_dupe_key' in spec:
+            return {'spec._dupe_key': spec['_dupe_key'],
+                    'spec.snlgroup_id': spec['snlgroup_id']}
+        # FireWorks created before _dupe_key existed (see backfill_dupe_keys)
         return {'spec.task_type': spec['task_type'],
-                'spec.snlgroup_id': spec['snlgroup_id']}
\ No newline at end of file
+                'spec.snlgroup_id': spec['snlgroup_id']}
@@ -1,6 +1,9 @@
+import logging
 from fireworks.core.firework import FireTaskBase, FWAction, FireWork, Workflow
 from fireworks.utilities.fw_serializers import FWSerializable
-from mpworks.dupefinders.dupefinder_vasp import DupeFinderVasp
+from mpworks.dupefinders.dupefinder_vasp import DupeFinderVasp, get_dupe_key
+from mpworks.firetasks.kpoint_cache import get_kpoint_cache
+from mpworks.firetasks.pipeline_tasks import VaspEStructurePipelineTask
 from mpworks.firetasks.vasp_io_tasks import VaspCopyTask, VaspToDBTask
 from mpworks.firetasks.vasp_setup_tasks import SetupStaticRunTask, \
     SetupNonSCFTask
@@ -13,6 +16,8 @@ __maintainer__ = 'Anubhav Jain'
 __email__ = 'ajain@lbl.gov'
 __date__ = 'May 01, 2013'
 
+logger = logging.getLogger(__name__)
+
 
 class AddEStructureTask(FireTaskBase, FWSerializable):
     _fw_name = "Add Electronic Structure Task"
@@ -25,75 +30,151 @@ class AddEStructureTask(FireTaskBase, FWSerializable):
         parameters = parameters if parameters else {}
         self.update(parameters)  # store the parameters explicitly set by the user
         self.gap_cutoff = parameters.get('gap_cutoff', 0.5)  # see e-mail from Geoffroy, 5/1/2013
+        # run static, uniform and band structure in one FireWork (see VaspEStructurePipelineTask)
+        self.pipelined = parameters.get('pipelined', False)
+        # fill the shared k-point cache for the non-SCF runs (see kpoint_cache)
+        self.precompute_kpoints = parameters.get('precompute_kpoints', False)
+        # leave the new FireWorks to a batch (see estructure_batch)
+        self.deferred = parameters.get('deferred', False)
 
     def run_task(self, fw_spec):
-        from mpworks.workflows.snl_to_wf import _get_metadata, \
-            _get_custodian_task
         # TODO: only add the workflow if the gap is > 1.0 eV
         # TODO: add stored data?
 
         if fw_spec['analysis']['bandgap'] >= self.gap_cutoff:
             type_name = 'GGA+U' if 'GGA+U' in fw_spec['prev_task_type'] else 'GGA'
 
+            if self.deferred:
+                # added later, in a batch with the others (see estructure_batch)
+                from mpworks.workflows.estructure_batch import EStructureQueue
+                EStructureQueue.auto_load().defer(fw_spec, type_name, dict(self))
+                return FWAction(stored_data={'deferred': True})
+
             snl = StructureNL.from_dict(fw_spec['mpsnl'])
+            if self.precompute_kpoints:
+                self._precompute_kpoints([snl.structure])
+
+            fws, connections = self.get_fws(fw_spec, snl, type_name)
+            return FWAction(additions=Workflow(fws, connections))
+        return FWAction()
+
+    def get_fws(self, fw_spec, snl, type_name, first_fw_id=-10):
+        """
+        :param fw_spec: (dict) spec of the controller, passed on to the first
+        new FireWork
+        :param first_fw_id: (int) the new FireWorks are numbered from there,
+        up to first_fw_id + 5
+        :return: ([FireWork], dict) the FireWorks to add, and their connections
+        """
+        if self.pipelined:
+            return self._get_pipelined_fws(fw_spec, snl, type_name, first_fw_id)
 
-            fws = []
-            connections = {}
-
-            # run GGA static
-            spec = fw_spec  # pass all the items from the current spec to the new
-            #  one
-            spec.update({'task_type': '{} static'.format(type_name),
-                         '_dupefinder': DupeFinderVasp().to_dict()})
-            spec.update(_get_metadata(snl))
-            fws.append(
-                FireWork(
-                    [VaspCopyTask({'extension': '.relax2'}), SetupStaticRunTask(),
-                     _get_custodian_task(spec)], spec, name=spec['task_type'], fw_id=-10))
-
-            # insert into DB - GGA static
-            spec = {'task_type': 'VASP db insertion',
-                    '_allow_fizzled_parents': True}
-            spec.update(_get_metadata(snl))
-            fws.append(
-                FireWork([VaspToDBTask()], spec, name=spec['task_type'], fw_id=-9))
-            connections[-10] = -9
-
-            # run GGA Uniform
-            spec = {'task_type': '{} Uniform'.format(type_name),
-                    '_dupefinder': DupeFinderVasp().to_dict()}
-            spec.update(_get_metadata(snl))
-            fws.append(FireWork(
-                [VaspCopyTask(), SetupNonSCFTask({'mode': 'uniform'}),
-                 _get_custodian_task(spec)], spec, name=spec['task_type'], fw_id=-8))
-            connections[-9] = -8
-
-            # insert into DB - GGA Uniform
-            spec = {'task_type': 'VASP db insertion',
-                    '_allow_fizzled_parents': True}
-            spec.update(_get_metadata(snl))
-            fws.append(
-                FireWork([VaspToDBTask({'parse_uniform': True})], spec, name=spec['task_type'],
-                         fw_id=-7))
-            connections[-8] = -7
-
-            # run GGA Band structure
-            spec = {'task_type': '{} band structure'.format(type_name),
-                    '_dupefinder': DupeFinderVasp().to_dict()}
-            spec.update(_get_metadata(snl))
-            fws.append(FireWork([VaspCopyTask(), SetupNonSCFTask({'mode': 'line'}),
-                                 _get_custodian_task(spec)], spec, name=spec['task_type'],
-                                fw_id=-6))
-            connections[-7] = -6
-
-            # insert into DB - GGA Band structure
-            spec = {'task_type': 'VASP db insertion',
-                    '_allow_fizzled_parents': True}
-            spec.update(_get_metadata(snl))
-            fws.append(FireWork([VaspToDBTask({})], spec, name=spec['task_type'], fw_id=-5))
-            connections[-6] = -5
-
-            wf = Workflow(fws, connections)
-
-            return FWAction(additions=wf)
-        return FWAction()
\ No newline at end of file
+        from mpworks.workflows.snl_to_wf import _get_metadata, \
+            _get_custodian_task
+        from mpworks.workflows.scheduling_hints import add_scheduling_hints, \
+            get_insertion_spec
+        fw_ids = range(first_fw_id, first_fw_id + 6)
+
+        fws = []
+        connections = {}
+
+        # run GGA static
+        spec = fw_spec  # pass all the items from the current spec to the new
+        #  one
+        spec.update({'task_type': '{} static'.format(type_name),
+                     '_dupefinder': DupeFinderVasp().to_dict()})
+        spec.update(_get_metadata(snl))
+        spec['_dupe_key'] = get_dupe_key(spec)
+        spec.pop('_category', None)  # the controller runs in the fast category
+        add_scheduling_hints(spec, snl.structure)
+        fws.append(
+            FireWork(
+                [VaspCopyTask({'extension': '.relax2'}), SetupStaticRunTask(),
+                 _get_custodian_task(spec)], spec, name=spec['task_type'], fw_id=fw_ids[0]))
+
+        # insert into DB - GGA static
+        spec = {'task_type': 'VASP db insertion',
+                '_allow_fizzled_parents': True}
+        spec.update(get_insertion_spec())
+        spec.update(_get_metadata(snl))
+        fws.append(
+            FireWork([VaspToDBTask()], spec, name=spec['task_type'], fw_id=fw_ids[1]))
+        connections[fw_ids[0]] = fw_ids[1]
+
+        # run GGA Uniform
+        spec = {'task_type': '{} Uniform'.format(type_name),
+                '_dupefinder': DupeFinderVasp().to_dict()}
+        spec.update(_get_metadata(snl))
+        spec['_dupe_key'] = get_dupe_key(spec)
+        add_scheduling_hints(spec, snl.structure)
+        fws.append(FireWork(
+            [VaspCopyTask(), SetupNonSCFTask({'mode': 'uniform'}),
+             _get_custodian_task(spec)], spec, name=spec['task_type'], fw_id=fw_ids[2]))
+        connections[fw_ids[1]] = fw_ids[2]
+
+        # insert into DB - GGA Uniform
+        spec = {'task_type': 'VASP db insertion',
+                '_allow_fizzled_parents': True}
+        spec.update(get_insertion_spec())
+        spec.update(_get_metadata(snl))
+        fws.append(
+            FireWork([VaspToDBTask({'parse_uniform': True})], spec, name=spec['task_type'],
+                     fw_id=fw_ids[3]))
+        connections[fw_ids[2]] = fw_ids[3]
+
+        # run GGA Band structure
+        spec = {'task_type': '{} band structure'.format(type_name),
+                '_dupefinder': DupeFinderVasp().to_dict()}
+        spec.update(_get_metadata(snl))
+        spec['_dupe_key'] = get_dupe_key(spec)
+        add_scheduling_hints(spec, snl.structure)
+        fws.append(FireWork([VaspCopyTask(), SetupNonSCFTask({'mode': 'line'}),
+                             _get_custodian_task(spec)], spec, name=spec['task_type'],
+                            fw_id=fw_ids[4]))
+        connections[fw_ids[3]] = fw_ids[4]
+
+        # insert into DB - GGA Band structure
+        spec = {'task_type': 'VASP db insertion',
+                '_allow_fizzled_parents': True}
+        spec.update(get_insertion_spec())
+        spec.update(_get_metadata(snl))
+        fws.append(FireWork([VaspToDBTask({})], spec, name=spec['task_type'], fw_id=fw_ids[5]))
+        connections[fw_ids[4]] = fw_ids[5]
+
+        return fws, connections
+
+    @staticmethod
+    def _precompute_kpoints(structures):
+        # only worth it if the runs can see the cache
+        cache = get_kpoint_cache()
+        if not cache.cache_dir:
+            return None
+        try:
+            return cache.precompute(structures, standardize=True)
+        except Exception:
+            # the runs compute their k-points themselves
+            logger.exception('Could not precompute the non-SCF k-points')
+            return None
+
+    def _get_pipelined_fws(self, fw_spec, snl, type_name, first_fw_id):
+        from mpworks.workflows.snl_to_wf import _get_metadata, \
+            _get_custodian_task
+        from mpworks.workflows.scheduling_hints import add_scheduling_hints
+
+        steps = []
+        for name, task_type in [('static', '{} static'), ('uniform', '{} Uniform'),
+                                ('band_structure', '{} band structure')]:
+            step_spec = {'task_type': task_type.format(type_name)}
+            steps.append({'name': name, 'task_type': step_spec['task_type'],
+                          'custodian': dict(_get_custodian_task(step_spec))})
+
+        spec = fw_spec  # pass all the items from the current spec to the new one
+        spec.update({'task_type': '{} electronic structure'.format(type_name),
+                     '_dupefinder': DupeFinderVasp().to_dict()})
+        spec.update(_get_metadata(snl))
+        spec['_dupe_key'] = get_dupe_key(spec)
+        spec.pop('_category', None)  # the controller runs in the fast category
+        add_scheduling_hints(spec, snl.structure)
+        fw = FireWork([VaspEStructurePipelineTask({'steps': steps})], spec,
+                      name=spec['task_type'], fw_id=first_fw_id)
+        return [fw], {}
@@ -1,11 +1,22 @@
-import socket
 import string
-from fireworks.core.firework import FireTaskBase, FWAction
+from fireworks.core.firework import FireTaskBase, FWAction, FireWork
 from fireworks.utilities.fw_serializers import FWSerializable
 from custodian.custodian import Custodian
 from custodian.vasp.handlers import VaspErrorHandler
 from custodian.vasp.jobs import VaspJob
-import shlex
+from mpworks.drones.signals import string_list_in_file
+from mpworks.firetasks.output_compression import OutputCompressor
+from mpworks.firetasks.parallel_advisor import ParallelizationAdvisor
+from mpworks.firetasks.scratch_staging import ScratchStager
+from mpworks.firetasks.task_timing import timed_task, span
+from mpworks.firetasks.vasp_io_tasks import VaspCopyTask
+from mpworks.firetasks.vasp_launcher import get_launch_layout, get_vasp_exe, \
+    get_walltime_end
+from mpworks.firetasks.vasp_monitor import VaspOutputMonitor, \
+    VaspMonitorHandler, LaunchProgressPublisher, VaspFatalSignalError
+from pymatgen.io.vaspio.vasp_input import Incar, Poscar
+import json
+import logging
 import os
 
 __author__ = 'Anubhav Jain'
@@ -15,6 +26,8 @@ __maintainer__ = 'Anubhav Jain'
 __email__ = 'ajain@lbl.gov'
 __date__ = 'Mar 15, 2013'
 
+logger = logging.getLogger(__name__)
+
 
 class VaspCustodianTask(FireTaskBase, FWSerializable):
     _fw_name = "Vasp Custodian Task"
@@ -25,37 +38,202 @@ class VaspCustodianTask(FireTaskBase, FWSerializable):
         self.handlers = [VaspErrorHandler.from_dict(d)
                          for d in self['handlers']]
         self.max_errors = self.get('max_errors', 1)
+        self.monitor = self.get('monitor', False)  # watch the run as it goes
+        self.monitor_action = self.get('monitor_action', 'terminate')  # or 'checkpoint'
+        self.walltime_margin = self.get('walltime_margin', 600)  # secs, see VaspOutputMonitor
+        self.max_continuations = self.get('max_continuations', 5)
 
+    @timed_task
     def run_task(self, fw_spec):
         # write a file containing the formula and task_type for somewhat easier file system browsing
         self._write_formula_file(fw_spec)
 
-        # TODO: make this better - is there a way to load an environment variable as the VASP_EXE?
-        if 'nid' in socket.gethostname():  # hopper compute nodes
-            v_exe = shlex.split('aprun -n 48 vasp')  # TODO: make ncores dynamic!
-        elif 'c' in socket.gethostname():  # carver / mendel compute nodes
-            v_exe = shlex.split('mpirun -n 32 vasp')  # TODO: make ncores dynamic!
-        else:
-            raise ValueError('Unrecognized host!')
-
-        for job in self.jobs:
-            job.vasp_command = v_exe
-
-        c = Custodian(self.handlers, self.jobs, self.max_errors)
-        custodian_out = c.run()
+        # run on node-local scratch if there is any
+        launch_dir = os.getcwd()
+        stager = ScratchStager.auto_load(launch_dir)
+        with span('stage_in'):
+            os.chdir(stager.stage_in())
+        result = None
+        try:
+            result = self._run_jobs(fw_spec, launch_dir)
+        finally:
+            os.chdir(launch_dir)
+            # WAVECAR etc. are needed uncompressed to continue the run
+            with span('stage_out'):
+                stager.stage_out(compress=result is None or result['interrupted_job'] is None)
+        interrupted_job = result['interrupted_job']
 
         all_errors = set()
-        for run in custodian_out:
+        for run in result['custodian_out']:
             for correction in run['corrections']:
                 all_errors.update(correction['errors'])
 
-        stored_data = {'error_list': list(all_errors)}
+        stored_data = {'error_list': list(all_errors), 'launch_layout': result['layout'],
+                       'staging': stager.stats}
+        if self.monitor:
+            stored_data['vasp_progress'] = result['monitor'].progress
+            if result['monitor'].checkpoint_signals:
+                stored_data['checkpoint_signals'] = sorted(result['monitor'].checkpoint_signals)
+        if result['fatal_signals']:
+            # the run ended there; the drone records it as an error
+            stored_data['fatal_signals'] = result['fatal_signals']
+        if result['compression']:
+            stored_data['compression'] = result['compression']
+
+        if interrupted_job is not None and interrupted_job < len(self.jobs):
+            n_continuations = fw_spec.get('_walltime_continuations', 0) + 1
+            if n_continuations > self.max_continuations:
+                raise RuntimeError('Walltime reached after {} continuations'
+                                   .format(self.max_continuations))
+            stored_data['walltime_continuation'] = n_continuations
+            # the continuation inherits our children (e.g. the DB insertion)
+            # and passes them its own prev_vasp_dir when it completes
+            return FWAction(stored_data=stored_data,
+                            detours=[self._get_continuation_fw(fw_spec, self.jobs[result['last_job']],
+                                                               interrupted_job, n_continuations)])
+
         update_spec = {'prev_vasp_dir': os.getcwd(), 'prev_task_type': fw_spec['task_type']}
 
         update_spec.update({'mpsnl': fw_spec['mpsnl'], 'snlgroup_id': fw_spec['snlgroup_id']})
 
         return FWAction(stored_data=stored_data, update_spec=update_spec)
 
+    def _run_jobs(self, fw_spec, launch_dir):
+        # figure out the MPI launcher, number of ranks and NPAR/KPAR for this node
+        with span('setup'):
+            layout = get_launch_layout(nsites=len(Poscar.from_file('POSCAR').structure))
+            layout.update(ParallelizationAdvisor.auto_load().get_parallelization(
+                layout['nranks'], fw_spec['task_type']))
+            self._write_parallelization(layout)
+            v_exe = get_vasp_exe(layout)
+
+        for job in self.jobs:
+            job.vasp_command = v_exe
+
+        custodian_out = []
+        monitor = None
+        last_job, interrupted_job = None, None
+        fatal_signals = None
+        compressor = OutputCompressor.auto_load(os.getcwd())
+        if compressor:
+            compressor.start()
+        try:
+            if self.monitor:
+                publisher = LaunchProgressPublisher.auto_load(os.getcwd(), launch_dir)
+                monitor = VaspOutputMonitor(os.getcwd(), publisher,
+                                            walltime_end=get_walltime_end(),
+                                            walltime_margin=self.walltime_margin)
+                monitor.start()
+                handlers = self.handlers + [VaspMonitorHandler(monitor, self.monitor_action)]
+                try:
+                    # one Custodian per job, so that we can stop between jobs once
+                    # the walltime is almost over (max_errors is per job anyway)
+                    for idx, job in enumerate(self.jobs):
+                        c = Custodian(handlers, [job], self.max_errors, monitor_freq=1)
+                        try:
+                            with span('custodian'):
+                                custodian_out.extend(c.run())
+                        except VaspFatalSignalError as e:
+                            logger.error(str(e))
+                            fatal_signals = e.signals
+                            break
+                        finally:
+                            # each Custodian rewrites custodian.json with its own job only
+                            with open('custodian.json', 'w') as f:
+                                json.dump(custodian_out, f, indent=4)
+                        if monitor.walltime_stop or monitor.checkpoint_signals:
+                            last_job = idx
+                            interrupted_job = idx if self._was_soft_stopped(job) else idx + 1
+                            break
+                        if compressor and job.suffix and idx < len(self.jobs) - 1:
+                            # e.g. the .relax1 outputs, while the next job runs
+                            compressor.submit(job.suffix)
+                finally:
+                    monitor.stop()
+            else:
+                c = Custodian(self.handlers, self.jobs, self.max_errors)
+                with span('custodian'):
+                    custodian_out = c.run()
+                if compressor:
+                    for job in self.jobs[:-1]:
+                        if job.suffix:
+                            compressor.submit(job.suffix)
+        except Exception:
+            if compressor:
+                compressor.finish()  # don't stage out while still compressing
+            raise
+
+        compression = None
+        if compressor:
+            # outputs of the final job are needed as they are by a continuation
+            suffix = None if interrupted_job is not None else \
+                (self.jobs[-1].suffix if self.jobs[-1].final else '')
+            with span('compress'):
+                compression = compressor.finish(suffix)
+            compression['task_type'] = fw_spec['task_type']
+            # picked up by MPVaspDrone, see scripts/compression_report
+            with open('compression.json', 'w') as f:
+                json.dump(compression, f)
+
+        return {'layout': layout, 'custodian_out': custodian_out, 'monitor': monitor,
+                'last_job': last_job, 'interrupted_job': interrupted_job,
+                'fatal_signals': fatal_signals, 'compression': compression}
+
+    def _was_soft_stopped(self, job):
+        # final jobs with a suffix have had their outputs renamed by custodian
+        output_file = job.output_file + job.suffix if job.final else job.output_file
+        if not os.path.exists(output_file):
+            output_file = job.output_file
+        return os.path.exists(output_file) and \
+            bool(string_list_in_file(['soft stop encountered'], output_file))
+
+    def _get_continuation_fw(self, fw_spec, last_job, start_job, n_continuations):
+        """
+        A FireWork that picks up the remaining jobs from the CONTCAR (and
+        WAVECAR/CHGCAR, if present) of this run
+        """
+        # custodian renames the outputs of final jobs (e.g., CONTCAR.relax2)
+        ext = last_job.suffix if last_job.final and last_job.suffix else ''
+
+        files = ['INCAR', 'KPOINTS', 'POTCAR']
+        if os.path.exists('CONTCAR' + ext) and os.stat('CONTCAR' + ext).st_size > 0:
+            files.append('CONTCAR')
+        else:
+            files.append('POSCAR')
+        files.extend([f for f in ['WAVECAR', 'CHGCAR'] if os.path.exists(f + ext)])
+
+        jobs = [j.to_dict for j in self.jobs[start_job:]]
+        # the inputs are copied by VaspCopyTask, so only keep INCAR/KPOINTS changes
+        override = [a for a in (jobs[0]['settings_override'] or []) if 'dict' in a]
+        if 'WAVECAR' in files:
+            override.append({'dict': 'INCAR', 'action': {'_set': {'ISTART': 1}}})
+        jobs[0]['settings_override'] = override if override else None
+
+        params = dict(self)
+        params['jobs'] = jobs
+
+        spec = dict(fw_spec)
+        # the continuation must not steal the launch of this (partial) run as a duplicate
+        spec.pop('_dupefinder', None)
+        spec.pop('_dupe_key', None)
+        spec['prev_vasp_dir'] = os.getcwd()
+        spec['_walltime_continuations'] = n_continuations
+
+        tasks = [VaspCopyTask({'files': files, 'extension': ext, 'use_CONTCAR': True}),
+                 VaspCustodianTask(params)]
+        return FireWork(tasks, spec, name='{} (continuation {})'.format(fw_spec['task_type'],
+                                                                      n_continuations))
+
+    def _write_parallelization(self, layout):
+        incar = Incar.from_file('INCAR')
+        incar['NPAR'] = layout['npar']
+        if layout['kpar'] > 1:
+            incar['KPAR'] = layout['kpar']
+        incar.write_file('INCAR')
+        # picked up by MPVaspDrone so that the ParallelizationAdvisor can learn from it
+        with open('launch_layout.json', 'w') as f:
+            json.dump(layout, f)
+
     def _write_formula_file(self, fw_spec):
         valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
         filename = 'JOB--' + fw_spec['mpsnl']['formula_abc_red'] + '--' + fw_spec['task_type']
@@ -0,0 +1,360 @@
+"""
+Inserts finished VASP runs into the tasks database outside of the batch
+queue. Instead of each 'VASP db insertion' FireWork waiting for a batch job of
+its own, a long-running InsertionDaemon (see scripts/insertion_daemon):
+
+- checks out the READY insertion FireWorks from the LaunchPad, as a Rocket
+  would, and spools their run dirs into a work queue (a collection next to
+  the tasks collection, which also takes run dirs enqueued by hand);
+- parses the queued runs in a process pool;
+- writes the parsed docs in batches (MPVaspDrone.insert_task_docs), each doc
+  on its own;
+- completes the launches with the same FWAction as VaspToDBTask, so the rest
+  of the workflow proceeds as usual (or fizzles them, with the traceback).
+
+FireWorks are only checked out to keep about a batch in the queue, and the
+daemon pings their launches until they are completed, so that detect_fizzled
+leaves them alone. Runs that could not be parsed are retried; runs that
+failed while being written are not, as their new SNL may already be in the
+SNL database.
+
+Queue items are claimed with find_and_modify, so several daemons can share a
+queue; items of a daemon that died are requeued after stale_secs. With
+$MP_INSERTION_DAEMON set when the workflows are created, the insertion
+FireWorks get a category of their own (see scheduling_hints), so that only
+the daemon picks them up.
+"""
+
+import datetime
+import json
+import logging
+import os
+import socket
+import time
+import traceback
+from multiprocessing import Pool
+from fireworks.core.firework import FWAction
+from fireworks.core.fworker import FWorker
+from mpworks.firetasks.vasp_io_tasks import get_vasp_drone, get_insertion_action, \
+    VaspToDBTask
+from pymongo import MongoClient
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'Jun 12, 2013'
+
+logger = logging.getLogger(__name__)
+
+QUEUE_COLLECTION = 'insertion_queue'
+INSERTION_TASK_TYPE = 'VASP db insertion'
+PING_SECS = 600  # well below the RUN_EXPIRATION_SECS of FireWorks
+
+
+class InsertionQueue():
+    """
+    Run dirs waiting to be inserted. Items go from 'queued' to 'running'
+    (claimed by a daemon) to 'done' or 'error'.
+    """
+
+    def __init__(self, coll):
+        """
+        :param coll: (pymongo Collection)
+        """
+        self.coll = coll
+        self.coll.ensure_index([('state', 1), ('queued_at', 1)])
+        self.coll.ensure_index('dir_name')
+
+    def enqueue(self, dir_name, parse_dos=False, additional_fields=None,
+                update_duplicates=False, fw_id=None, launch_id=None, fw_spec=None):
+        """
+        :param dir_name: (str) the run dir
+        :param fw_id: (int) the insertion FireWork, if any
+        :param launch_id: (int) its launch, completed once the run is inserted
+        :param fw_spec: (dict) prev_vasp_dir and prev_task_type of the FireWork
+        :return: the id of the item
+        """
+        return self.coll.insert({'dir_name': dir_name, 'parse_dos': parse_dos,
+                                 'additional_fields': additional_fields or {},
+                                 'update_duplicates': update_duplicates,
+                                 'fw_id': fw_id, 'launch_id': launch_id, 'fw_spec': fw_spec,
+                                 'state': 'queued', 'attempts': 0,
+                                 'queued_at': datetime.datetime.utcnow()})
+
+    def claim(self, n, worker_id):
+        """
+        :return: ([dict]) up to n queued items, oldest first, now 'running'
+        """
+        items = []
+        for _ in range(n):
+            item = self.coll.find_and_modify(
+                query={'state': 'queued'}, sort=[('queued_at', 1)], new=True,
+                update={'$set': {'state': 'running', 'claimed_by': worker_id,
+                                 'claimed_at': datetime.datetime.utcnow()},
+                        '$inc': {'attempts': 1}})
+            if not item:
+                break
+            items.append(item)
+        return items
+
+    def finish(self, item, task_id):
+        self.coll.update({'_id': item['_id']}, {'$set': {
+            'state': 'done', 'task_id': task_id, 'finished_at': datetime.datetime.utcnow()}})
+
+    def fail(self, item, error, max_attempts):
+        """
+        :param max_attempts: (int) 0 to never requeue the item
+        :return: (bool) True if the item was requeued for another attempt
+        """
+        retry = item['attempts'] < max_attempts
+        self.coll.update({'_id': item['_id']}, {'$set': {
+            'state': 'queued' if retry else 'error', 'error': error,
+            'finished_at': datetime.datetime.utcnow()}})
+        return retry
+
+    def requeue_stale(self, stale_secs):
+        """
+        Requeue the items claimed by daemons that did not finish them in time
+
+        :return: (int) number of items requeued
+        """
+        oldest = datetime.datetime.utcnow() - datetime.timedelta(seconds=stale_secs)
+        result = self.coll.update({'state': 'running', 'claimed_at': {'$lt': oldest}},
+                                  {'$set': {'state': 'queued'}}, multi=True)
+        return result.get('n', 0) if result else 0
+
+    def get_launch_ids(self):
+        """
+        :return: ([int]) the launches of the FireWorks whose runs are queued
+        or being inserted
+        """
+        return [item['launch_id'] for item in self.coll.find(
+            {'state': {'$in': ['queued', 'running']}, 'launch_id': {'$ne': None}},
+            {'launch_id': 1})]
+
+    def count_queued(self):
+        return self.coll.find({'state': 'queued'}).count()
+
+    def get_counts(self):
+        return dict([(state, self.coll.find({'state': state}).count())
+                     for state in ['queued', 'running', 'done', 'error']])
+
+    @classmethod
+    def auto_load(cls):
+        """
+        The queue in the tasks database of $DB_LOC/tasks_db.json
+        """
+        with open(os.path.join(os.environ['DB_LOC'], 'tasks_db.json')) as f:
+            db_creds = json.load(f)
+        db = MongoClient(db_creds['host'], db_creds['port'])[db_creds['database']]
+        db.authenticate(db_creds['admin_user'], db_creds['admin_password'])
+        return InsertionQueue(db[QUEUE_COLLECTION])
+
+
+def _parse_run(args):
+    # runs in the worker pool: parsing is the slow part of an insertion
+    dir_name, parse_dos, additional_fields = args
+    try:
+        drone = get_vasp_drone(parse_dos=parse_dos, additional_fields=additional_fields)
+        return drone.get_task_doc(dir_name, parse_dos, additional_fields), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+class InsertionDaemon():
+
+    def __init__(self, queue, launchpad=None, fworker=None, nprocs=4, batch_size=20,
+                 max_attempts=3, stale_secs=3600, launch_dir=None):
+        """
+        :param queue: (InsertionQueue)
+        :param launchpad: (LaunchPad) to take the insertion FireWorks from;
+        None to only insert what is enqueued otherwise
+        :param fworker: (FWorker) its query is restricted to the insertion
+        FireWorks, of any category
+        :param nprocs: (int) parsing processes
+        :param batch_size: (int) runs parsed and written together
+        :param max_attempts: (int) before a run is given up on
+        :param stale_secs: (int) after which the runs claimed by another
+        daemon are taken back
+        :param launch_dir: (str) recorded as the launch dir of the FireWorks,
+        default is cwd
+        """
+        fworker = fworker if fworker else FWorker()
+        query = dict(fworker.query)
+        query['spec.task_type'] = INSERTION_TASK_TYPE
+        # any category: the fast one, or the daemon's own (INSERTION_CATEGORY)
+        query.pop('spec._category', None)
+        self.fworker = FWorker(fworker.name, None, query)
+        self.queue = queue
+        self.launchpad = launchpad
+        self.nprocs = nprocs
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.stale_secs = stale_secs
+        self.launch_dir = os.path.abspath(launch_dir if launch_dir else os.getcwd())
+        self.worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.stats = {'fireworks': 0, 'inserted': 0, 'failed': 0, 'retried': 0,
+                      'batches': 0}
+        self._last_ping = 0
+
+    def fetch_fireworks(self, n):
+        """
+        Check out up to n READY insertion FireWorks and queue their runs
+
+        :return: (int) number of FireWorks checked out
+        """
+        if not self.launchpad:
+            return 0
+        n_fws = 0
+        for _ in range(n):
+            # as Rocket.run(): the FireWork is RUNNING under this daemon from now on
+            fw, launch_id = self.launchpad._checkout_fw(self.fworker, self.launch_dir)
+            if not fw:
+                break
+            n_fws += 1
+            try:
+                if 'prev_vasp_dir' not in fw.spec or 'prev_task_type' not in fw.spec:
+                    # e.g. the VASP run fizzled: there is nothing to insert
+                    raise ValueError('No prev_vasp_dir in the spec of fw_id {}'.format(
+                        fw.fw_id))
+                params = [t for t in fw.tasks if isinstance(t, VaspToDBTask)]
+                params = params[0] if params else {}
+                self.queue.enqueue(fw.spec['prev_vasp_dir'],
+                                   parse_dos=params.get('parse_uniform', False),
+                                   additional_fields=params.get('additional_fields', {}),
+                                   update_duplicates=params.get('update_duplicates', False),
+                                   fw_id=fw.fw_id, launch_id=launch_id,
+                                   fw_spec={'prev_vasp_dir': fw.spec['prev_vasp_dir'],
+                                            'prev_task_type': fw.spec['prev_task_type']})
+            except Exception:
+                error = traceback.format_exc()
+                logger.error('Cannot queue fw_id {}: {}'.format(fw.fw_id, error))
+                self.stats['failed'] += 1
+                self._complete({'launch_id': launch_id}, FWAction(
+                    stored_data={'_message': 'DB insertion failed', '_exception': error}),
+                    'FIZZLED')
+        self.stats['fireworks'] += n_fws
+        return n_fws
+
+    def ping_launches(self, force=False):
+        """
+        Ping the launches of the queued runs, at most every PING_SECS
+        """
+        if not self.launchpad or (not force and time.time() - self._last_ping < PING_SECS):
+            return
+        for launch_id in self.queue.get_launch_ids():
+            try:
+                self.launchpad._ping_launch(launch_id)
+            except Exception:
+                logger.exception('Could not ping launch {}'.format(launch_id))
+        self._last_ping = time.time()
+
+    def _complete(self, item, action, state):
+        if self.launchpad and item.get('launch_id') is not None:
+            self.launchpad._complete_launch(item['launch_id'], action, state)
+
+    def _fail(self, item, error, retry=True):
+        logger.error('Insertion of {} failed: {}'.format(item['dir_name'], error))
+        if self.queue.fail(item, error, self.max_attempts if retry else 0):
+            self.stats['retried'] += 1
+            return
+        self.stats['failed'] += 1
+        self._complete(item, FWAction(stored_data={'_message': 'DB insertion failed',
+                                                   '_exception': error}), 'FIZZLED')
+
+    def process_batch(self, pool=None):
+        """
+        Parse and insert the next batch of queued runs
+
+        :param pool: (Pool) for the parsing, None to parse in this process
+        :return: (int) number of runs processed
+        """
+        items = self.queue.claim(self.batch_size, self.worker_id)
+        if not items:
+            return 0
+        work = [(item['dir_name'], item['parse_dos'], item['additional_fields'])
+                for item in items]
+        parsed = pool.map(_parse_run, work) if pool else [_parse_run(w) for w in work]
+
+        # the drone settings used when writing
+        groups = {}
+        for item, (d, error) in zip(items, parsed):
+            if error:
+                self._fail(item, error)
+                continue
+            key = (item['parse_dos'], item['update_duplicates'])
+            groups.setdefault(key, []).append((item, d))
+
+        for (parse_dos, update_duplicates), group in groups.items():
+            drone = get_vasp_drone(parse_dos=parse_dos, update_duplicates=update_duplicates)
+            try:
+                outcomes = drone.insert_task_docs([(item['dir_name'], d) for item, d in group])
+            except Exception:
+                # nothing was written yet: the lookups failed
+                error = traceback.format_exc()
+                for item, d in group:
+                    self._fail(item, error)
+                continue
+            for (item, d), (t_id, error) in zip(group, outcomes):
+                if error:
+                    self._fail(item, error, retry=False)
+                    continue
+                if t_id is None:
+                    # a retry would find it there again
+                    self._fail(item, 'already in the database: {}'.format(item['dir_name']),
+                               retry=False)
+                    continue
+                try:
+                    if item.get('fw_spec'):
+                        self._complete(item, get_insertion_action(item['fw_spec'], t_id, d),
+                                       'COMPLETED')
+                    self.queue.finish(item, t_id)
+                    self.stats['inserted'] += 1
+                    logger.info('ENTERED task id: {} ({})'.format(t_id, item['dir_name']))
+                except Exception:
+                    # the run is in the database, only FireWorks wasn't told
+                    self.queue.finish(item, t_id)
+                    logger.exception('Could not complete the launch of fw_id {}'.format(
+                        item.get('fw_id')))
+        self.stats['batches'] += 1
+        return len(items)
+
+    def run(self, poll_interval=10, max_idle=None):
+        """
+        Insert runs as they come
+
+        :param poll_interval: (int) secs to wait when there is nothing to do
+        :param max_idle: (int) stop after that many secs with nothing to do,
+        None to run forever
+        :return: (dict) the stats of the daemon
+        """
+        pool = Pool(self.nprocs) if self.nprocs > 1 else None
+        last_work = time.time()
+        try:
+            while True:
+                try:
+                    n_stale = self.queue.requeue_stale(self.stale_secs)
+                    if n_stale:
+                        logger.warn('Requeued {} stale runs'.format(n_stale))
+                    self.ping_launches()
+                    # about a batch ahead: the others stay READY for other daemons
+                    self.fetch_fireworks(max(0, self.batch_size - self.queue.count_queued()))
+                    if self.process_batch(pool):
+                        last_work = time.time()
+                        continue
+                except Exception:
+                    # e.g. the database is unreachable for a while
+                    logger.exception('Insertion loop failed, retrying')
+                if max_idle is not None and time.time() - last_work > max_idle:
+                    break
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            # claimed runs go back to the queue once they are stale
+            logger.info('Stopped')
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return self.stats
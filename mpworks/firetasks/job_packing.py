@@ -0,0 +1,206 @@
+"""
+Packs several small VASP FireWorks onto one node. The cores of the node are
+split into disjoint slots; each slot is a separate process that keeps pulling
+small FireWorks (by the cost_estimate of their spec) from the LaunchPad and
+runs them one at a time in its own directory, restricted to the cores of the
+slot (see SLOT_CPUS_ENV and get_slot_vasp_cmd in vasp_launcher). Every run
+still gets its own Rocket, launch dir and VaspCustodianTask. Packing is
+refused when vasp_cmd cannot be bound to the slots (e.g. aprun without
+{cpus}: ALPS doesn't run several apruns on one node anyway).
+
+At the end, a report with the wall time of each FireWork and the overall
+throughput, compared to running the same FireWorks one per node, is written
+to packing_report.json.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import time
+from Queue import Empty
+from fireworks.core.fworker import FWorker
+from fireworks.core.launchpad import LaunchPad
+from fireworks.core.rocket_launcher import launch_rocket
+from fireworks.utilities.fw_utilities import get_fw_logger, create_datestamp_dir
+from mpworks.firetasks.potcar_cache import warm_for_fworker
+from mpworks.firetasks.vasp_launcher import get_affinity_cpu_ids, \
+    get_walltime_end, get_slot_vasp_cmd, get_vasp_cmd_template, SLOT_CPUS_ENV
+from mpworks.workflows.cost_model import get_cost_model
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 28, 2013'
+
+logger = logging.getLogger(__name__)
+
+
+def get_core_slots(cpu_ids, ncores_per_job):
+    """
+    Split cpu_ids into disjoint, contiguous slots of ncores_per_job cores
+    (left-over cores are not used)
+
+    :return: ([str]) cpu lists of the slots, e.g. ['0,1,2,3', '4,5,6,7']
+    """
+    cpu_ids = sorted(cpu_ids)
+    slots = []
+    for i in range(0, len(cpu_ids) - ncores_per_job + 1, ncores_per_job):
+        slots.append(','.join([str(c) for c in cpu_ids[i:i + ncores_per_job]]))
+    return slots
+
+
+def get_packing_query(max_nsites, max_core_hours=None):
+    """
+    FWorker query for the FireWorks small enough to be packed
+    """
+    query = {'spec.cost_estimate.nsites': {'$lte': max_nsites}}
+    if max_core_hours:
+        query['spec.cost_estimate.core_hours'] = {'$lte': max_core_hours}
+    return query
+
+
+def _run_slot(slot_idx, cpus, launchpad_file, fworker_dict, slot_dir, walltime_end,
+              min_time_left, results):
+    # runs in a child process: the LaunchPad connection can't be shared across a fork
+    os.environ[SLOT_CPUS_ENV] = cpus
+    launchpad = LaunchPad.from_file(launchpad_file)
+    fworker = FWorker.from_dict(fworker_dict)
+    l_logger = get_fw_logger('rocket.launcher', l_dir=launchpad.logdir)
+
+    while launchpad.run_exists(fworker):
+        if walltime_end and walltime_end - time.time() < min_time_left:
+            l_logger.info('Slot {}: not enough walltime left for another run'.format(slot_idx))
+            break
+        os.chdir(slot_dir)
+        launcher_dir = create_datestamp_dir(slot_dir, l_logger, prefix='launcher_')
+        os.chdir(launcher_dir)
+        start = time.time()
+        try:
+            launch_rocket(launchpad, fworker)
+        except ValueError:
+            if os.path.exists('FW.json'):
+                logger.exception('Slot {}: launch in {} failed'.format(slot_idx, launcher_dir))
+            else:
+                # another slot took the FireWork first
+                l_logger.info('Slot {}: nothing to run'.format(slot_idx))
+        except Exception:
+            logger.exception('Slot {}: launch in {} failed'.format(slot_idx, launcher_dir))
+        record = {'slot': slot_idx, 'cpus': cpus, 'launch_dir': launcher_dir,
+                  'start': start, 'end': time.time(), 'fw_id': None}
+        if os.path.exists('FW.json'):
+            with open('FW.json') as f:
+                fw_dict = json.load(f)
+            record.update({'fw_id': fw_dict['fw_id'],
+                           'task_type': fw_dict['spec'].get('task_type'),
+                           'cost_estimate': fw_dict['spec'].get('cost_estimate')})
+        results.put(record)
+        time.sleep(0.15)  # as in rapidfire(), give the DB a moment
+
+
+def get_packing_report(records, node_cores, ncores_per_job):
+    """
+    Per-FireWork wall times and the throughput of the packed launch, vs. the
+    same FireWorks run one after the other on the whole node. The baseline
+    uses the TaskCostModel when there is one; otherwise it assumes perfect
+    scaling to the whole node, which flatters the baseline for small runs.
+    """
+    # no fw_id: another slot checked the FireWork out first, nothing ran
+    misses = [r for r in records if r['fw_id'] is None]
+    records = [r for r in records if r['fw_id'] is not None]
+    report = {'fireworks': records, 'n_fireworks': len(records), 'n_misses': len(misses),
+              'node_cores': node_cores, 'ncores_per_job': ncores_per_job}
+    if not records:
+        return report
+
+    makespan = max([r['end'] for r in records]) - min([r['start'] for r in records])
+    model = get_cost_model()
+    baseline = 0
+    for r in records:
+        r['walltime'] = r['end'] - r['start']
+        if model and r.get('cost_estimate'):
+            baseline += model.predict_estimate(r['cost_estimate'], r['task_type'],
+                                               node_cores)['walltime']
+        else:
+            baseline += r['walltime'] * ncores_per_job / float(node_cores)
+
+    report.update({'makespan': makespan,
+                   'packed_fw_per_hour': len(records) * 3600.0 / makespan if makespan else None,
+                   'baseline_makespan': baseline,
+                   'baseline_method': 'model' if model else 'linear scaling',
+                   'baseline_fw_per_hour': len(records) * 3600.0 / baseline if baseline else None})
+    if makespan and baseline:
+        report['speedup'] = baseline / makespan
+    return report
+
+
+class PackedLauncher():
+
+    def __init__(self, launchpad_file, fworker=None, ncores_per_job=4, max_nsites=8,
+                 max_core_hours=None, min_time_left=1800):
+        """
+        :param launchpad_file: (str) path to the LaunchPad file (each slot
+        process opens its own connection)
+        :param fworker: (FWorker) its query is restricted to small FireWorks
+        :param ncores_per_job: (int) cores of each slot
+        :param max_nsites: (int) largest structure that gets packed
+        :param max_core_hours: (float) largest estimated cost that gets packed
+        :param min_time_left: (int) secs of walltime a slot needs to start a run
+        """
+        fworker = fworker if fworker else FWorker()
+        query = dict(fworker.query)
+        query.update(get_packing_query(max_nsites, max_core_hours))
+        self.fworker = FWorker(fworker.name, fworker.category, query)
+        self.launchpad_file = launchpad_file
+        self.ncores_per_job = ncores_per_job
+        self.min_time_left = min_time_left
+
+    def run(self, m_dir=None):
+        """
+        Run small FireWorks on all slots until none is left
+
+        :param m_dir: (str) where to create the slot dirs, default is cwd
+        :return: (dict) the packing report
+        """
+        m_dir = os.path.abspath(m_dir if m_dir else os.getcwd())
+        cpu_ids = get_affinity_cpu_ids()
+        slots = get_core_slots(cpu_ids, self.ncores_per_job)
+        if not slots:
+            raise ValueError('{} cores per job, but only {} cores available'.format(
+                self.ncores_per_job, len(cpu_ids)))
+        get_slot_vasp_cmd(get_vasp_cmd_template(), slots[0])  # raises if runs can't be bound
+
+        # all slots write their POTCARs from the node-local cache
+        try:
+            warm_for_fworker(LaunchPad.from_file(self.launchpad_file), self.fworker)
+        except Exception:
+            logger.exception('Could not warm the POTCAR cache')
+
+        walltime_end = get_walltime_end()
+        results = multiprocessing.Queue()
+        procs = []
+        for idx, cpus in enumerate(slots):
+            slot_dir = os.path.join(m_dir, 'slot_{}'.format(idx))
+            if not os.path.exists(slot_dir):
+                os.mkdir(slot_dir)
+            p = multiprocessing.Process(target=_run_slot, args=(
+                idx, cpus, self.launchpad_file, self.fworker.to_dict(), slot_dir,
+                walltime_end, self.min_time_left, results))
+            p.start()
+            procs.append(p)
+
+        records = []
+        while any([p.is_alive() for p in procs]) or not results.empty():
+            try:
+                records.append(results.get(timeout=5))
+            except Empty:
+                pass
+        for p in procs:
+            p.join()
+
+        report = get_packing_report(records, len(cpu_ids), self.ncores_per_job)
+        with open(os.path.join(m_dir, 'packing_report.json'), 'w') as f:
+            json.dump(report, f, indent=4)
+        return report
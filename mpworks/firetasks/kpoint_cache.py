@@ -0,0 +1,271 @@
+"""
+Cache of the k-points of the non-SCF (uniform and band structure) runs. The
+high-symmetry k-path (HighSymmKpath) and the irreducible uniform mesh
+(1000 k-points per reciprocal atom) of MPNonSCFVaspInputSet only depend on
+the symmetry and lattice of the structure, so they are computed once for all
+the runs of equivalent structures (e.g. the GGA and GGA+U runs of an SNL
+group, or reruns).
+
+Entries are keyed on the spacegroup and the lattice: the standard primitive
+lattice for the k-path; for the mesh, the lattice of the structure (already
+the standard primitive cell in non-SCF runs), the number of sites and the
+rotations of the spacegroup, which fix the irreducible points. Lattices are
+rounded to FINGERPRINT_DECIMALS.
+
+Entries are kept in memory, and in kpoint_cache_dir if set in the VASP
+launcher config (see vasp_launcher). On a filesystem shared by the nodes,
+the k-points can be precomputed for many structures in a process pool before
+the runs start (KpointCache.precompute), e.g. by AddEStructureTask.
+"""
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+from collections import OrderedDict
+import pymatgen
+from mpworks.firetasks.potcar_cache import _write_atomic
+from mpworks.firetasks.vasp_launcher import load_launcher_config
+from mpworks.snl_utils.symmetry import get_structure_fingerprint, FINGERPRINT_DECIMALS
+from pymatgen import Structure
+from pymatgen.io.vaspio_set import MPNonSCFVaspInputSet
+from pymatgen.symmetry.bandstructure import HighSymmKpath
+from pymatgen.symmetry.finder import SymmetryFinder
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'Jun 11, 2013'
+
+logger = logging.getLogger(__name__)
+
+MODES = ['line', 'uniform']
+SYMPREC = 0.01  # as in MPNonSCFVaspInputSet and HighSymmKpath
+# MPNonSCFVaspInputSet requires the NBANDS of the SCF run, which the k-points
+# don't depend on
+_PLACEHOLDER_INCAR = {'NBANDS': 1}
+
+
+def _round_matrix(matrix):
+    return [[round(x, FINGERPRINT_DECIMALS) for x in row] for row in matrix.tolist()]
+
+
+def _to_list(obj):
+    # the k-path has numpy arrays, which can't be stored as JSON or BSON
+    if isinstance(obj, dict):
+        return dict([(k, _to_list(v)) for k, v in obj.items()])
+    if isinstance(obj, (list, tuple)):
+        return [_to_list(v) for v in obj]
+    return obj.tolist() if hasattr(obj, 'tolist') else obj
+
+
+def get_kpoints_key(structure, mode):
+    """
+    :param structure: (Structure) of the non-SCF run
+    :param mode: (str) 'line' or 'uniform'
+    :return: (str) the cache key
+    """
+    sf = SymmetryFinder(structure, SYMPREC)
+    if mode == 'line':
+        d = {'lattice': _round_matrix(sf.get_primitive_standard_structure().lattice.matrix)}
+    else:
+        rotations = sorted([r.tolist() for r in sf.get_symmetry_dataset()['rotations']])
+        d = {'lattice': _round_matrix(structure.lattice.matrix),
+             'nsites': structure.num_sites, 'rotations': rotations}
+    d.update({'mode': mode, 'spacegroup': sf.get_spacegroup_number(),
+              'pymatgen': pymatgen.__version__})
+    return hashlib.sha1(json.dumps(d, sort_keys=True)).hexdigest()
+
+
+def get_nonscf_kpoints(structure, mode):
+    """
+    :return: (dict) 'kpoints': text of the KPOINTS file of MPNonSCFVaspInputSet,
+    and in line mode 'kpath' and 'kpath_name'
+    """
+    if mode == 'line':
+        kpoints = MPNonSCFVaspInputSet(_PLACEHOLDER_INCAR, mode='Line').get_kpoints(structure)
+        kpath = HighSymmKpath(structure)
+        return {'kpoints': str(kpoints), 'kpath': _to_list(kpath.kpath),
+                'kpath_name': kpath.name}
+    kpoints = MPNonSCFVaspInputSet(_PLACEHOLDER_INCAR, mode='Uniform').get_kpoints(structure)
+    return {'kpoints': str(kpoints)}
+
+
+def get_nonscf_structure(structure):
+    """
+    The structure the non-SCF runs will use, from the relaxed structure: the
+    static run standardizes it, and SetupNonSCFTask again
+
+    :param structure: (Structure) e.g. of the snl_final of the relaxation
+    """
+    for _ in range(2):
+        structure = SymmetryFinder(structure, SYMPREC).get_primitive_standard_structure()
+    return structure
+
+
+def _precompute_from_dict(args):
+    # top-level helper so that it can be pickled by multiprocessing
+    s_dict, modes, standardize, cache_dir = args
+    structure = Structure.from_dict(s_dict)
+    if standardize:
+        structure = get_nonscf_structure(structure)
+    cache = KpointCache(cache_dir, max_cache_size=len(modes))
+    results = []
+    for mode in modes:
+        key = get_kpoints_key(structure, mode)
+        entry = cache._lookup(key)
+        computed = entry is None
+        if computed:
+            entry = get_nonscf_kpoints(structure, mode)
+            cache._store(key, entry)
+        results.append((key, entry, computed))
+    return results
+
+
+class KpointCache():
+    """
+    Non-SCF k-points by key (see get_kpoints_key), in memory and optionally
+    in cache_dir
+    """
+
+    def __init__(self, cache_dir=None, max_cache_size=1000, nprocs=None):
+        """
+        :param cache_dir: (str) where entries are kept across processes,
+        ideally on a filesystem shared by the nodes; None to only keep them
+        in memory
+        :param max_cache_size: (int) number of entries kept in memory, oldest
+        are evicted first
+        :param nprocs: (int) number of processes used by precompute(),
+        defaults to the number of CPUs
+        """
+        self.cache_dir = cache_dir
+        self.max_cache_size = max_cache_size
+        self.nprocs = nprocs if nprocs else multiprocessing.cpu_count()
+        self._cache = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0}
+        if cache_dir and not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def _entry_file(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def _cache_put(self, key, entry):
+        self._cache[key] = entry
+        while len(self._cache) > self.max_cache_size:
+            self._cache.popitem(last=False)
+
+    def _lookup(self, key):
+        if key in self._cache:
+            entry = self._cache.pop(key)
+            self._cache[key] = entry  # evicted last
+            return entry
+        if not self.cache_dir or not os.path.exists(self._entry_file(key)):
+            return None
+        try:
+            with open(self._entry_file(key)) as f:
+                entry = json.load(f)
+        except ValueError:
+            logger.warn('Corrupt k-point cache entry {}, recomputing'.format(
+                self._entry_file(key)))
+            return None
+        self._cache_put(key, entry)
+        return entry
+
+    def _store(self, key, entry):
+        self._cache_put(key, entry)
+        if not self.cache_dir:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self._entry_file(key))):
+                try:
+                    os.makedirs(os.path.dirname(self._entry_file(key)))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(self._entry_file(key))):
+                        raise
+            _write_atomic(self._entry_file(key), json.dumps(entry))
+        except (IOError, OSError):
+            logger.exception('Could not cache k-points {}'.format(key))
+
+    def get_kpoints(self, structure, mode):
+        """
+        :param structure: (Structure) of the non-SCF run
+        :param mode: (str) 'line' or 'uniform'
+        :return: (dict) see get_nonscf_kpoints
+        """
+        key = get_kpoints_key(structure, mode)
+        entry = self._lookup(key)
+        if entry is not None:
+            self.stats['hits'] += 1
+            return entry
+        self.stats['misses'] += 1
+        entry = get_nonscf_kpoints(structure, mode)
+        self._store(key, entry)
+        return entry
+
+    def precompute(self, structures, modes=None, standardize=False):
+        """
+        Fill the cache for many structures, in parallel. Equivalent structures
+        are only computed once.
+
+        :param structures: ([Structure])
+        :param modes: ([str]) defaults to MODES
+        :param standardize: (bool) the structures are relaxed ones, which the
+        static run will standardize (see get_nonscf_structure)
+        :return: (dict) number of structures, entries already cached and
+        computed
+        """
+        modes = modes if modes else MODES
+        todo = OrderedDict()
+        for s in structures:
+            todo.setdefault(get_structure_fingerprint(s, SYMPREC), s)
+        work = [(s.to_dict, modes, standardize, self.cache_dir) for s in todo.values()]
+
+        if len(work) > 1 and self.nprocs > 1:
+            pool = multiprocessing.Pool(min(self.nprocs, len(work)))
+            try:
+                results = pool.map(_precompute_from_dict, work)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_precompute_from_dict(w) for w in work]
+
+        stats = {'n_structures': len(structures), 'cached': 0, 'computed': 0}
+        for key, entry, computed in [r for result in results for r in result]:
+            self._cache_put(key, entry)
+            stats['computed' if computed else 'cached'] += 1
+        return stats
+
+    @classmethod
+    def auto_load(cls):
+        """
+        :return: (KpointCache) with the kpoint_cache_dir of the launcher
+        config, if any
+        """
+        cache_dir = load_launcher_config().get('kpoint_cache_dir')
+        if cache_dir:
+            try:
+                return KpointCache(cache_dir)
+            except OSError:
+                logger.exception('Cannot use k-point cache {}'.format(cache_dir))
+        return KpointCache()
+
+
+_default_cache = None
+
+
+def get_kpoint_cache():
+    """
+    Returns the KpointCache shared by the current process
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = KpointCache.auto_load()
+    return _default_cache
@@ -0,0 +1,262 @@
+"""
+An opt-in profiler of the Mongo operations of the adapters (SNLMongoAdapter,
+SubmissionMongoAdapter, MPVaspDrone, and the LaunchPad collections used by
+the SubmissionProcessor).
+
+Adapter methods are decorated with @profiled, and the adapters wrap their
+collections with profile_collection(). Every operation on a wrapped
+collection (or on a cursor it returned) is then attributed to the innermost
+profiled method running in the thread, e.g.
+
+    SNLMongoAdapter.build_groups  snlgroups.find  n=200 time=1.3s bytes_in=12MB
+
+and the number of calls of each method is kept, so that N+1 patterns (many
+operations per call) stand out. Operations slower than $MP_MONGO_SLOW_MS
+(default 100) are logged as they happen; the summary is logged at process
+exit and, if $MP_MONGO_PROFILE_FILE is set, written there as JSON.
+
+Set $MP_MONGO_PROFILE=1 to switch it on. When off, @profiled and
+profile_collection() return their argument unchanged.
+"""
+
+import atexit
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from bson import BSON
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'Jun 03, 2013'
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('MP_MONGO_PROFILE', '0').lower() in ['1', 'true', 'yes']
+SLOW_MS = float(os.environ.get('MP_MONGO_SLOW_MS', 100))
+
+# Collection methods that go to the server, and the positional arguments
+# of each that are documents sent with it
+OPERATIONS = {'find': [0], 'find_one': [0], 'count': [], 'distinct': [], 'insert': [0],
+              'save': [0], 'update': [0, 1], 'remove': [0], 'find_and_modify': [0, 1],
+              'aggregate': [0], 'group': [], 'map_reduce': [], 'ensure_index': [],
+              'drop': []}
+# Cursor methods that go to the server (iteration aside)
+CURSOR_OPERATIONS = ['count', 'distinct', 'explain']
+
+NO_SITE = '(unprofiled)'
+
+_local = threading.local()
+_lock = threading.Lock()
+# site -> {'calls': int, 'ops': {'<collection>.<op>': {n, time, max_time, bytes_out,
+# bytes_in, docs_in}}}
+_stats = {}
+
+
+def _bson_size(doc):
+    if isinstance(doc, dict):
+        try:
+            return len(BSON.encode(doc))
+        except Exception:
+            return 0
+    if isinstance(doc, (list, tuple)):
+        return sum([_bson_size(d) for d in doc])
+    return 0
+
+
+def _get_site():
+    stack = getattr(_local, 'sites', None)
+    return stack[-1] if stack else NO_SITE
+
+
+def _record(site, op, dt, bytes_out=0, bytes_in=0, docs_in=0, new_op=True):
+    with _lock:
+        site_stats = _stats.setdefault(site, {'calls': 0, 'ops': {}})
+        entry = site_stats['ops'].setdefault(op, {'n': 0, 'time': 0.0, 'max_time': 0.0,
+                                                  'bytes_out': 0, 'bytes_in': 0,
+                                                  'docs_in': 0})
+        if new_op:
+            entry['n'] += 1
+        entry['time'] += dt
+        entry['max_time'] = max(entry['max_time'], dt)
+        entry['bytes_out'] += bytes_out
+        entry['bytes_in'] += bytes_in
+        entry['docs_in'] += docs_in
+
+
+def _log_if_slow(site, op, dt, query):
+    if dt * 1000 >= SLOW_MS:
+        # only the shape of the query, not the values
+        shape = sorted(query.keys()) if isinstance(query, dict) else None
+        logger.warning('Slow Mongo op: {} {} took {:.0f} ms (query keys: {})'.format(
+            site, op, dt * 1000, shape))
+
+
+def profiled(method):
+    """
+    Decorator for adapter methods: the Mongo operations run inside are
+    attributed to '<class>.<method>'
+    """
+    if not ENABLED:
+        return method
+
+    @functools.wraps(method)
+    def _profiled(self, *args, **kwargs):
+        site = '{}.{}'.format(self.__class__.__name__, method.__name__)
+        with _lock:
+            _stats.setdefault(site, {'calls': 0, 'ops': {}})['calls'] += 1
+        if not hasattr(_local, 'sites'):
+            _local.sites = []
+        _local.sites.append(site)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _local.sites.pop()
+    return _profiled
+
+
+class _ProfiledCursor():
+    # times the iteration (the round trips of the batches) of a cursor
+
+    def __init__(self, cursor, site, op):
+        self._cursor = cursor
+        self._site = site
+        self._op = op
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        t0 = time.time()
+        doc = self._cursor.next()  # StopIteration goes through
+        _record(self._site, self._op, time.time() - t0, bytes_in=_bson_size(doc), docs_in=1,
+                new_op=False)
+        return doc
+
+    def __getitem__(self, index):
+        result = self._cursor[index]
+        return self if result is self._cursor else result
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def _call(*args, **kwargs):
+            t0 = time.time()
+            result = attr(*args, **kwargs)
+            if result is self._cursor:  # sort(), limit(), ...
+                return self
+            if name in CURSOR_OPERATIONS:
+                dt = time.time() - t0
+                op = self._op.rsplit('.', 1)[0] + '.' + name
+                _record(self._site, op, dt)
+                _log_if_slow(self._site, op, dt, None)
+            return result
+        return _call
+
+
+class _ProfiledCollection():
+    # wraps the operations of a pymongo Collection
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in OPERATIONS:
+            return attr
+
+        def _call(*args, **kwargs):
+            site = _get_site()
+            op = '{}.{}'.format(self._collection.name, name)
+            bytes_out = sum([_bson_size(args[i]) for i in OPERATIONS[name] if i < len(args)])
+            t0 = time.time()
+            result = attr(*args, **kwargs)
+            dt = time.time() - t0
+            if name == 'find':
+                # the query is sent with the first batch, when iterating
+                _record(site, op, dt, bytes_out=bytes_out)
+                return _ProfiledCursor(result, site, op)
+            _record(site, op, dt, bytes_out=bytes_out, bytes_in=_bson_size(result),
+                    docs_in=1 if isinstance(result, dict) else 0)
+            _log_if_slow(site, op, dt, args[0] if args else kwargs.get('query', kwargs.get('spec')))
+            return result
+        return _call
+
+    def __getitem__(self, name):
+        # sub-collections, e.g. db.fs['files']
+        return profile_collection(self._collection[name])
+
+
+def profile_collection(collection):
+    """
+    :param collection: (pymongo Collection)
+    :return: the collection, wrapped if profiling is on
+    """
+    if not ENABLED or isinstance(collection, _ProfiledCollection):
+        return collection
+    return _ProfiledCollection(collection)
+
+
+def profile_launchpad(launchpad):
+    """
+    Wrap the collections of a LaunchPad, so that its queries are attributed
+    to the profiled methods calling it
+    """
+    if ENABLED:
+        for name in ['fireworks', 'workflows', 'launches', 'links', 'fw_id_assigner']:
+            if hasattr(launchpad, name):
+                setattr(launchpad, name, profile_collection(getattr(launchpad, name)))
+    return launchpad
+
+
+def get_summary():
+    """
+    :return: ([dict]) one entry per (site, operation), sorted by total time,
+    with ops_per_call telling the N+1 patterns apart
+    """
+    rows = []
+    with _lock:
+        for site, site_stats in _stats.items():
+            for op, entry in site_stats['ops'].items():
+                row = dict(entry)
+                row.update({'site': site, 'op': op, 'calls': site_stats['calls']})
+                row['ops_per_call'] = float(entry['n']) / site_stats['calls'] \
+                    if site_stats['calls'] else None
+                rows.append(row)
+    return sorted(rows, key=lambda r: -r['time'])
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def dump_summary(filename=None):
+    """
+    Log the summary, and write it as JSON to filename (default
+    $MP_MONGO_PROFILE_FILE, if set)
+    """
+    rows = get_summary()
+    if not rows:
+        return
+    logger.info('Mongo profile ({} sites):'.format(len(set([r['site'] for r in rows]))))
+    for r in rows:
+        logger.info('{:<50} {:<30} calls={:<6} n={:<7} time={:.3f}s max={:.3f}s '
+                    'out={}B in={}B docs={}'.format(r['site'], r['op'], r['calls'], r['n'],
+                                                    r['time'], r['max_time'], r['bytes_out'],
+                                                    r['bytes_in'], r['docs_in']))
+    filename = filename if filename else os.environ.get('MP_MONGO_PROFILE_FILE')
+    if filename:
+        with open(filename, 'w') as f:
+            json.dump({'pid': os.getpid(), 'summary': rows}, f, indent=4)
+
+
+if ENABLED:
+    atexit.register(dump_summary)
@@ -0,0 +1,217 @@
+"""
+Gzips the large VASP outputs of a run. Outputs of intermediate custodian jobs
+(e.g., OUTCAR.relax1) are compressed in the background, on a single thread,
+while the next job runs; the outputs of the final job are compressed with all
+threads once VASP is done. pigz is used when it is installed, otherwise the
+files are spread over a pool of threads (zlib releases the GIL).
+
+The files stay readable by the code that consumes them: pymatgen opens them
+through zopen, signals.py and VaspCopyTask look for the .gz when the plain
+file is missing.
+
+Configured through the VASP launcher config (see vasp_launcher):
+
+    compress_outputs: set to false to leave outputs uncompressed
+    compress_threads: threads for the final compression (default: 4)
+    compress_min_bytes: only gzip files at least this large
+"""
+
+import gzip
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+from mpworks.firetasks.vasp_launcher import load_launcher_config
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 23, 2013'
+
+logger = logging.getLogger(__name__)
+
+# WAVECAR is left alone: it hardly compresses and continuations restart from it
+COMPRESS_FILES = ['OUTCAR', 'vasprun.xml', 'CHGCAR', 'CHG', 'PROCAR', 'DOSCAR',
+                  'EIGENVAL', 'XDATCAR', 'LOCPOT', 'ELFCAR', 'AECCAR0', 'AECCAR2']
+DEFAULT_MIN_BYTES = 1024 * 1024
+DEFAULT_THREADS = 4
+COPY_BUFSIZE = 4 * 1024 * 1024
+
+
+def _which(program):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        exe = os.path.join(path, program)
+        if os.path.isfile(exe) and os.access(exe, os.X_OK):
+            return exe
+    return None
+
+
+def _pigz_file(filename, nthreads):
+    # pigz replaces filename by filename.gz only once the .gz is complete
+    p = subprocess.Popen(['pigz', '-f', '-p', str(nthreads), filename])
+    _, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = status
+    if status != 0:
+        raise IOError('pigz failed on {} (status {})'.format(filename, status))
+    return rusage.ru_utime + rusage.ru_stime
+
+
+def _gzip_file(filename):
+    # write to a temp file and rename, so readers never see a partial .gz
+    t0 = time.time()
+    tmp_file = filename + '.gz.tmp'
+    with open(filename, 'rb') as f_in:
+        f_out = gzip.open(tmp_file, 'wb')
+        try:
+            shutil.copyfileobj(f_in, f_out, COPY_BUFSIZE)
+        finally:
+            f_out.close()
+    shutil.copystat(filename, tmp_file)
+    os.rename(tmp_file, filename + '.gz')
+    os.remove(filename)
+    # a single-threaded compression is CPU bound, wall time ~ CPU time
+    return time.time() - t0
+
+
+def compress_files(filenames, nthreads=1):
+    """
+    Gzip filenames in place.
+
+    :param filenames: ([str]) files to compress
+    :param nthreads: (int) number of threads to use
+    :return: (dict) filename -> bytes_in, bytes_out, wall_time, cpu_time
+    """
+    report = {}
+    use_pigz = _which('pigz') is not None
+    sizes = dict([(f, os.path.getsize(f)) for f in filenames])
+
+    def _compress(filename):
+        t0 = time.time()
+        try:
+            cpu_time = _pigz_file(filename, nthreads) if use_pigz else _gzip_file(filename)
+        except (IOError, OSError):
+            logger.exception('Could not compress {}'.format(filename))
+            return
+        report[os.path.basename(filename)] = {
+            'bytes_in': sizes[filename], 'bytes_out': os.path.getsize(filename + '.gz'),
+            'wall_time': time.time() - t0, 'cpu_time': cpu_time,
+            'codec': 'pigz' if use_pigz else 'gzip'}
+
+    if use_pigz or nthreads == 1:
+        for filename in filenames:
+            _compress(filename)
+    else:
+        pool = ThreadPool(min(nthreads, len(filenames)) or 1)
+        try:
+            pool.map(_compress, filenames)
+        finally:
+            pool.close()
+    return report
+
+
+class OutputCompressor(threading.Thread):
+    """
+    Background thread that compresses the outputs of finished custodian jobs
+    in dir_name, in the order they are submitted.
+    """
+
+    def __init__(self, dir_name, nthreads=DEFAULT_THREADS, min_bytes=DEFAULT_MIN_BYTES,
+                 files=None):
+        """
+        :param dir_name: (str) the run directory
+        :param nthreads: (int) threads for the final compression in finish()
+        :param min_bytes: (int) smaller outputs are not compressed
+        :param files: ([str]) names of the outputs to compress
+        """
+        super(OutputCompressor, self).__init__()
+        self.daemon = True
+        self.dir_name = dir_name
+        self.nthreads = nthreads
+        self.min_bytes = min_bytes
+        self.files = files if files is not None else COMPRESS_FILES
+        self.queue = Queue()
+        self.report = {}
+
+    def _get_outputs(self, suffix):
+        outputs = []
+        for f in self.files:
+            filename = os.path.join(self.dir_name, f + suffix)
+            if os.path.isfile(filename) and os.path.getsize(filename) >= self.min_bytes:
+                outputs.append(filename)
+        return outputs
+
+    def submit(self, suffix):
+        """
+        Compress the outputs of a finished job (e.g., suffix '.relax1') in the
+        background, using a single thread so VASP is barely slowed down
+        """
+        self.queue.put((suffix, 1))
+
+    def finish(self, suffix=None):
+        """
+        Wait for the background compression, then compress the outputs with
+        the given suffix ('' for the unsuffixed files) using all threads.
+        None only waits.
+
+        :return: (dict) summary and per-file report
+        """
+        if suffix is not None:
+            self.queue.put((suffix, self.nthreads))
+        self.queue.put(None)
+        self.join()
+
+        bytes_in = sum([r['bytes_in'] for r in self.report.values()])
+        bytes_out = sum([r['bytes_out'] for r in self.report.values()])
+        return {'files': self.report, 'bytes_in': bytes_in, 'bytes_out': bytes_out,
+                'bytes_saved': bytes_in - bytes_out,
+                'cpu_time': sum([r['cpu_time'] for r in self.report.values()])}
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            suffix, nthreads = item
+            try:
+                self.report.update(compress_files(self._get_outputs(suffix), nthreads))
+            except Exception:
+                logger.exception('Error compressing outputs in {}'.format(self.dir_name))
+
+    @classmethod
+    def auto_load(cls, dir_name):
+        """
+        :return: (OutputCompressor) or None if compression is switched off
+        """
+        config = load_launcher_config()
+        if not config.get('compress_outputs', True):
+            return None
+        return OutputCompressor(dir_name, config.get('compress_threads', DEFAULT_THREADS),
+                                config.get('compress_min_bytes', DEFAULT_MIN_BYTES))
+
+
+def get_compression_report(tasks_coll):
+    """
+    Disk saved vs. CPU spent on compression, per task type
+
+    :param tasks_coll: (pymongo Collection) the tasks collection
+    :return: (dict) task_type -> n_tasks, bytes_in, bytes_saved, cpu_time
+    and MB saved per CPU second
+    """
+    report = {}
+    for t in tasks_coll.find({'compression': {'$exists': True}},
+                             {'task_type': 1, 'compression': 1}):
+        r = report.setdefault(t['task_type'], {'n_tasks': 0, 'bytes_in': 0,
+                                               'bytes_saved': 0, 'cpu_time': 0})
+        r['n_tasks'] += 1
+        for k in ['bytes_in', 'bytes_saved', 'cpu_time']:
+            r[k] += t['compression'][k]
+    for r in report.values():
+        r['mb_saved_per_cpu_sec'] = r['bytes_saved'] / 1e6 / r['cpu_time'] \
+            if r['cpu_time'] else None
+    return report
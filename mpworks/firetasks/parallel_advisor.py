@@ -0,0 +1,193 @@
+"""
+Chooses NPAR/KPAR (and the implied NCORE) for a VASP run from the number of
+sites, an NBANDS estimate, the number of irreducible k-points and the number
+of MPI ranks. When past task documents recorded their launch layout, the
+fastest settings seen for similar runs are preferred over the heuristic.
+"""
+
+import json
+import logging
+import math
+import os
+from pymongo import MongoClient
+from pymatgen.io.vaspio.vasp_input import Kpoints, Poscar, Potcar
+from pymatgen.symmetry.finder import SymmetryFinder
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 17, 2013'
+
+logger = logging.getLogger(__name__)
+
+# below this many bands per rank, band parallelization stops paying off
+MIN_BANDS_PER_RANK = 4
+
+
+def _divisors(n):
+    return [i for i in range(1, n + 1) if n % i == 0]
+
+
+def estimate_nbands(dir_name='.'):
+    """
+    Default VASP NBANDS, max(NELECT/2 + NIONS/2, 0.6 * NELECT), computed from
+    the POSCAR and POTCAR in dir_name (NELECT is guessed if there's no POTCAR)
+    """
+    poscar = Poscar.from_file(os.path.join(dir_name, 'POSCAR'))
+    nions = sum(poscar.natoms)
+    potcar_file = os.path.join(dir_name, 'POTCAR')
+    if os.path.exists(potcar_file):
+        potcar = Potcar.from_file(potcar_file)
+        nelect = sum([p.nelectrons * n for p, n in zip(potcar, poscar.natoms)])
+    else:
+        nelect = 8 * nions
+    return int(math.ceil(max(nelect / 2.0 + nions / 2.0, 0.6 * nelect)))
+
+
+def get_num_ir_kpoints(structure, kpoints):
+    """
+    Number of irreducible k-points VASP will use for a KPOINTS object
+    """
+    style = str(kpoints.style).lower()[0]
+    if kpoints.num_kpts > 0:
+        if style == 'l':
+            # line mode: num_kpts points along each segment
+            return kpoints.num_kpts * max(len(kpoints.kpts) // 2, 1)
+        return kpoints.num_kpts
+
+    if style == 'a':
+        length = kpoints.kpts[0][0]
+        mesh = [max(1, int(length * b / (2 * math.pi) + 0.5))
+                for b in structure.lattice.reciprocal_lattice.abc]
+    elif style in 'gm':
+        mesh = [int(n) for n in kpoints.kpts[0]]
+    else:
+        return 1
+
+    shift = [1 if style == 'm' and n % 2 == 0 else 0 for n in mesh]
+    try:
+        return len(SymmetryFinder(structure, 0.1).get_ir_reciprocal_mesh(mesh, shift))
+    except Exception:
+        # time reversal symmetry alone halves the mesh
+        return max(int(math.ceil(reduce(lambda x, y: x * y, mesh) / 2.0)), 1)
+
+
+def get_heuristic_parallelization(nranks, nbands, nkpts):
+    """
+    Use k-point parallelization (KPAR) once there are more ranks than can be
+    used on bands, then pick NPAR close to sqrt(ranks per k-point group) as
+    recommended in the VASP manual.
+    """
+    useful_ranks = max(nbands // MIN_BANDS_PER_RANK, 1)
+    kpar_choices = [k for k in _divisors(nranks) if k <= nkpts]
+    kpar = kpar_choices[-1]
+    for k in kpar_choices:
+        if nranks // k <= useful_ranks:
+            kpar = k
+            break
+
+    group_ranks = nranks // kpar
+    npar = 1
+    for i in _divisors(group_ranks):
+        if i * i <= group_ranks and i <= nbands:
+            npar = i
+    return {'npar': npar, 'kpar': kpar, 'ncore': group_ranks // npar}
+
+
+def get_elapsed_time(run_stats):
+    # run_stats holds the OUTCAR timing of each calculation (e.g., relax1, relax2)
+    if 'overall' in run_stats:
+        return run_stats['overall'].get('Elapsed time (sec)')
+    return sum([v.get('Elapsed time (sec)', 0) for v in run_stats.values()
+                if isinstance(v, dict)])
+
+
+class ParallelizationAdvisor():
+
+    def __init__(self, tasks_coll=None, min_samples=3, nsites_tol=0.25):
+        """
+        :param tasks_coll: (pymongo Collection) tasks collection used to learn
+        from past wall times, or None to only use the heuristic
+        :param min_samples: (int) number of past runs a setting needs before
+        it is trusted
+        :param nsites_tol: (float) relative difference in nsites for a past
+        task to be considered similar
+        """
+        self.tasks_coll = tasks_coll
+        self.min_samples = min_samples
+        self.nsites_tol = nsites_tol
+
+    def get_history_parallelization(self, task_type, nsites, nranks, nkpts):
+        """
+        :return: (dict) the NPAR/KPAR with the lowest mean wall time among
+        similar past tasks, or None if there is not enough history
+        """
+        if self.tasks_coll is None:
+            return None
+
+        query = {'state': 'successful', 'task_type': task_type,
+                 'launch_layout.nranks': nranks,
+                 'nsites': {'$gte': nsites * (1 - self.nsites_tol),
+                            '$lte': nsites * (1 + self.nsites_tol)}}
+        times = {}
+        try:
+            for t in self.tasks_coll.find(query, {'launch_layout': 1, 'run_stats': 1}):
+                elapsed = get_elapsed_time(t.get('run_stats', {}))
+                if elapsed:
+                    key = (t['launch_layout']['npar'], t['launch_layout']['kpar'])
+                    times.setdefault(key, []).append(elapsed)
+        except Exception:
+            logger.exception('Could not load parallelization history')
+            return None
+
+        times = {k: sum(v) / len(v) for k, v in times.items() if len(v) >= self.min_samples}
+        if not times:
+            return None
+        npar, kpar = min(times, key=times.get)
+        # similar tasks may have had more k-points: as in the heuristic, KPAR
+        # is at most nkpts and divides nranks, and NPAR divides what is left
+        kpar = max([k for k in _divisors(nranks) if k <= min(kpar, nkpts)])
+        group_ranks = nranks // kpar
+        npar = max([i for i in _divisors(group_ranks) if i <= npar])
+        return {'npar': npar, 'kpar': kpar, 'ncore': group_ranks // npar}
+
+    def get_parallelization(self, nranks, task_type=None, dir_name='.'):
+        """
+        :param nranks: (int) number of MPI ranks VASP will run on
+        :param task_type: (str) used to find similar past tasks
+        :param dir_name: (str) directory containing the VASP inputs
+        :return: (dict) npar, kpar, ncore plus the estimates they are based on
+        """
+        structure = Poscar.from_file(os.path.join(dir_name, 'POSCAR')).structure
+        nbands = estimate_nbands(dir_name)
+        nkpts = get_num_ir_kpoints(structure, Kpoints.from_file(os.path.join(dir_name, 'KPOINTS')))
+
+        settings = None
+        if task_type:
+            settings = self.get_history_parallelization(task_type, len(structure), nranks,
+                                                        nkpts)
+        if settings:
+            settings['source'] = 'history'
+        else:
+            settings = get_heuristic_parallelization(nranks, nbands, nkpts)
+            settings['source'] = 'heuristic'
+
+        settings.update({'nbands_est': nbands, 'nkpts_irr': nkpts})
+        return settings
+
+    @classmethod
+    def auto_load(cls):
+        # learning from history is optional, e.g. compute nodes might not reach the DB
+        try:
+            with open(os.path.join(os.environ['DB_LOC'], 'tasks_db.json')) as f:
+                db_creds = json.load(f)
+            conn = MongoClient(db_creds['host'], db_creds['port'])
+            db = conn[db_creds['database']]
+            db.authenticate(db_creds['admin_user'], db_creds['admin_password'])
+            return ParallelizationAdvisor(db[db_creds['collection']])
+        except Exception:
+            logger.warning('Tasks DB unavailable, using heuristic parallelization only')
+            return ParallelizationAdvisor()
+
@@ -0,0 +1,196 @@
+"""
+Runs the static -> uniform -> band structure chain of AddEStructureTask as a
+single FireWork. The runs happen one after the other on node-local scratch,
+so the static CHGCAR never leaves the node; each finished run is copied back
+to a subdirectory of the launch dir and inserted into the tasks database by
+a background thread while the next run is computing.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import traceback
+from Queue import Queue
+from fireworks.core.firework import FireTaskBase, FWAction
+from fireworks.utilities.fw_serializers import FWSerializable
+from mpworks.firetasks.custodian_task import VaspCustodianTask
+from mpworks.firetasks.vasp_io_tasks import VaspCopyTask, get_vasp_drone
+from mpworks.firetasks.vasp_setup_tasks import SetupStaticRunTask, \
+    SetupNonSCFTask
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 21, 2013'
+
+logger = logging.getLogger(__name__)
+
+
+def _keep_failed_run(run_dir, dest_dir):
+    # a function of its own, so that the exception of the run is the one re-raised
+    try:
+        shutil.copytree(run_dir, dest_dir)
+    except (IOError, OSError, shutil.Error):
+        logger.exception('Could not copy {} to {}'.format(run_dir, dest_dir))
+
+
+def get_scratch_root():
+    return os.environ.get('TMPDIR', tempfile.gettempdir())
+
+
+class _DBInsertionThread(threading.Thread):
+    """
+    Inserts finished run directories into the tasks database, in the order
+    they are queued, without holding up the next VASP run
+    """
+
+    def __init__(self):
+        super(_DBInsertionThread, self).__init__()
+        self.daemon = True
+        self.queue = Queue()
+        self.results = []
+        self._done = threading.Condition()
+
+    def insert(self, name, dir_name, parse_dos=False):
+        self.queue.put((name, dir_name, parse_dos))
+
+    def wait_for(self, n):
+        """
+        :return: (dict) the result of the n-th queued run, once it is in
+        """
+        with self._done:
+            while len(self.results) < n:
+                self._done.wait()
+            return self.results[n - 1]
+
+    def finish(self):
+        self.queue.put(None)
+        self.join()
+        return self.results
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            name, dir_name, parse_dos = item
+            result = {'name': name, 'dir_name': dir_name}
+            try:
+                t_id, d = get_vasp_drone(parse_dos=parse_dos).assimilate(dir_name)
+                print 'ENTERED task id:', t_id
+                result.update({'task_id': t_id, 'state': d['state'],
+                               'analysis': d.get('analysis')})
+            except Exception:
+                logger.exception('DB insertion of {} failed'.format(dir_name))
+                result.update({'state': 'error', 'error': traceback.format_exc()})
+            with self._done:
+                self.results.append(result)
+                self._done.notify_all()
+
+
+class VaspEStructurePipelineTask(FireTaskBase, FWSerializable):
+    """
+    Run the static, uniform and band structure calculations starting from
+    the relaxation in 'prev_vasp_dir'.
+    """
+
+    _fw_name = "Vasp Electronic Structure Pipeline Task"
+
+    def __init__(self, parameters):
+        """
+        :param parameters: (dict) 'steps' is a list of dicts, each with the
+        'name' (used as subdirectory), 'task_type' and 'custodian' (the
+        VaspCustodianTask parameters) of a run; 'scratch_dir' optionally
+        overrides $TMPDIR
+        """
+        self.update(parameters)
+        self.steps = self['steps']
+        self.scratch_dir = self.get('scratch_dir')
+
+    def run_task(self, fw_spec):
+        launch_dir = os.getcwd()
+        scratch = tempfile.mkdtemp(prefix='estructure_',
+                                   dir=self.scratch_dir or get_scratch_root())
+        fw_id = None
+        if os.path.exists('FW.json'):
+            with open('FW.json') as f:
+                fw_id = json.load(f)['fw_id']
+
+        db_thread = _DBInsertionThread()
+        db_thread.start()
+        stored_data = {'scratch_dir': scratch, 'steps': [], 'timing': {}}
+        try:
+            for idx, step in enumerate(self.steps):
+                step_spec = dict(fw_spec)
+                step_spec['task_type'] = step['task_type']
+                run_dir = os.path.join(scratch, step['name'])
+                os.mkdir(run_dir)
+                os.chdir(run_dir)
+                try:
+                    if idx == 0:
+                        VaspCopyTask({'extension': '.relax2'}).run_task(fw_spec)
+                        setup_action = SetupStaticRunTask().run_task(step_spec)
+                    else:
+                        # both non-SCF runs start from the static CHGCAR on scratch
+                        VaspCopyTask().run_task({'prev_vasp_dir': os.path.join(
+                            scratch, self.steps[0]['name'])})
+                        mode = 'uniform' if 'Uniform' in step['task_type'] else 'line'
+                        setup_action = SetupNonSCFTask({'mode': mode}).run_task(step_spec)
+
+                    custodian_params = dict(step['custodian'])
+                    # a continuation can't resume in the middle of the pipeline
+                    custodian_params['max_continuations'] = 0
+                    run_action = VaspCustodianTask(custodian_params).run_task(step_spec)
+                except Exception:
+                    # scratch is removed below: keep the failed run to debug it
+                    _keep_failed_run(run_dir, os.path.join(launch_dir, step['name']))
+                    raise
+                finally:
+                    os.chdir(launch_dir)
+
+                dest_dir = os.path.join(launch_dir, step['name'])
+                shutil.copytree(run_dir, dest_dir)
+                # MPVaspDrone reads the spec of the run from FW.json
+                with open(os.path.join(dest_dir, 'FW.json'), 'w') as f:
+                    json.dump({'fw_id': fw_id, 'spec': step_spec}, f)
+                db_thread.insert(step['name'], dest_dir,
+                                 parse_dos='Uniform' in step['task_type'])
+
+                step_data = dict(setup_action.stored_data)
+                step_data.update(run_action.stored_data)
+                step_data.update({'name': step['name'], 'task_type': step['task_type'],
+                                  'dir_name': dest_dir})
+                step_data.pop('timing', None)
+                stored_data['timing'][step['name']] = {
+                    'setup': setup_action.stored_data.get('timing'),
+                    'run': run_action.stored_data.get('timing')}
+                stored_data['steps'].append(step_data)
+
+                if idx == 0 and db_thread.wait_for(1)['state'] != 'successful':
+                    # as the FireWorks would be defused after a bad static run
+                    logger.error('Static run {} not successful, stopping'.format(dest_dir))
+                    break
+        finally:
+            db_results = db_thread.finish()
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        for step_data, result in zip(stored_data['steps'], db_results):
+            step_data.update({'task_id': result.get('task_id'), 'state': result['state']})
+        # failed insertions (a run inserted as an 'error' just defuses the children)
+        errors = [r for r in db_results if 'error' in r]
+        if errors:
+            raise RuntimeError('DB insertion failed for {}:\n{}'.format(
+                ', '.join([r['dir_name'] for r in errors]), errors[0]['error']))
+
+        update_spec = {'prev_vasp_dir': os.path.join(launch_dir, self.steps[-1]['name']),
+                       'prev_task_type': self.steps[-1]['task_type'],
+                       'mpsnl': fw_spec['mpsnl'], 'snlgroup_id': fw_spec['snlgroup_id']}
+        if any([r['state'] != 'successful' for r in db_results]):
+            return FWAction(stored_data=stored_data, defuse_children=True)
+        update_spec['analysis'] = db_results[-1]['analysis']
+        return FWAction(stored_data=stored_data, update_spec=update_spec)
@@ -0,0 +1,230 @@
+"""
+Node-local, content-addressed cache of the single-element POTCARs. Each
+POTCAR is stored once under objects/<sha1 of its text>, and a small index
+file <functional>/<symbol> holds the hash, so the same data is never copied
+twice even if several symbols or functionals point to it. A POTCAR is only
+read from VASP_PSP_DIR on the shared filesystem the first time a node needs
+it; after that, writing the POTCAR of a run is a local concatenation.
+
+The cache can be warmed before any FireWork runs, with the element sets of
+the FireWorks that are READY or RESERVED for the FWorker (see
+scripts/warm_potcar_cache).
+
+Configured through the VASP launcher config (see vasp_launcher):
+
+    potcar_cache_dir: node-local cache dir (default: $TMPDIR/mp_potcar_cache),
+        set to false to always read from VASP_PSP_DIR
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+from mpworks.firetasks.vasp_launcher import load_launcher_config
+from pymatgen.io.vaspio.vasp_input import Potcar, PotcarSingle
+from pymatgen.io.vaspio_set import MPVaspInputSet
+from pymatgen.matproj.snl import StructureNL
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 29, 2013'
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIRNAME = 'mp_potcar_cache'
+DEFAULT_FUNCTIONAL = Potcar.DEFAULT_FUNCTIONAL
+WARM_STATES = ['READY', 'RESERVED']
+
+
+def _write_atomic(filename, data):
+    # concurrent runs on the same node may fill the same entry; rename is atomic
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.rename(tmp_file, filename)
+    except (IOError, OSError):
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+class PotcarCache():
+    """
+    POTCAR data by (functional, symbol), kept in cache_dir
+    """
+
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: (str) node-local directory, created if needed
+        """
+        self.cache_dir = cache_dir
+        self.stats = {'hits': 0, 'misses': 0}
+        if not os.path.exists(os.path.join(cache_dir, 'objects')):
+            try:
+                os.makedirs(os.path.join(cache_dir, 'objects'))
+            except OSError:
+                if not os.path.isdir(os.path.join(cache_dir, 'objects')):
+                    raise
+
+    def _index_file(self, symbol, functional):
+        return os.path.join(self.cache_dir, functional, symbol)
+
+    def _object_file(self, digest):
+        return os.path.join(self.cache_dir, 'objects', digest)
+
+    def _lookup(self, symbol, functional):
+        index_file = self._index_file(symbol, functional)
+        if not os.path.exists(index_file):
+            return None
+        with open(index_file) as f:
+            digest = f.read().strip()
+        object_file = self._object_file(digest)
+        if not os.path.exists(object_file):
+            return None
+        with open(object_file) as f:
+            data = f.read()
+        if hashlib.sha1(data).hexdigest() != digest:
+            logger.warn('Corrupt POTCAR cache entry {}, refetching'.format(object_file))
+            return None
+        return data
+
+    def _store(self, symbol, functional, data):
+        digest = hashlib.sha1(data).hexdigest()
+        if not os.path.exists(self._object_file(digest)):
+            _write_atomic(self._object_file(digest), data)
+        index_dir = os.path.join(self.cache_dir, functional)
+        if not os.path.isdir(index_dir):
+            try:
+                os.makedirs(index_dir)
+            except OSError:
+                if not os.path.isdir(index_dir):
+                    raise
+        _write_atomic(self._index_file(symbol, functional), digest)
+        return digest
+
+    def get_data(self, symbol, functional=DEFAULT_FUNCTIONAL):
+        """
+        :return: (str) the text of a single POTCAR, read from VASP_PSP_DIR
+        (and cached) if it is not in the cache yet
+        """
+        data = self._lookup(symbol, functional)
+        if data is not None:
+            self.stats['hits'] += 1
+            return data
+        self.stats['misses'] += 1
+        data = PotcarSingle.from_symbol_and_functional(symbol, functional).data
+        try:
+            self._store(symbol, functional, data)
+        except (IOError, OSError):
+            logger.exception('Could not cache POTCAR {} {}'.format(functional, symbol))
+        return data
+
+    def get_potcar(self, symbols, functional=DEFAULT_FUNCTIONAL):
+        """
+        :param symbols: ([str]) POTCAR symbols, e.g. ['Fe_pv', 'O']
+        :param functional: (str) e.g. 'PBE'
+        :return: (Potcar)
+        """
+        sym_potcar_map = dict([(s, self.get_data(s, functional)) for s in set(symbols)])
+        return Potcar(symbols, functional, sym_potcar_map)
+
+    def warm(self, symbol_sets):
+        """
+        Make sure the POTCARs are in the cache
+
+        :param symbol_sets: ([(functional, [symbols])])
+        :return: (dict) number of cache hits and misses (fetched POTCARs)
+        """
+        before = dict(self.stats)
+        needed = set()
+        for functional, symbols in symbol_sets:
+            needed.update([(functional, s) for s in symbols])
+        for functional, symbol in sorted(needed):
+            try:
+                self.get_data(symbol, functional)
+            except IOError:
+                logger.exception('Cannot warm POTCAR {} {}'.format(functional, symbol))
+        return dict([(k, self.stats[k] - before[k]) for k in self.stats])
+
+    @classmethod
+    def auto_load(cls):
+        """
+        :return: (PotcarCache) or None if there is no usable node-local cache dir
+        """
+        config = load_launcher_config()
+        cache_dir = config.get('potcar_cache_dir')
+        if cache_dir is False:
+            return None
+        if not cache_dir and os.environ.get('TMPDIR'):
+            cache_dir = os.path.join(os.environ['TMPDIR'], CACHE_DIRNAME)
+        if not cache_dir:
+            return None
+        try:
+            return PotcarCache(cache_dir)
+        except OSError:
+            logger.exception('Cannot use POTCAR cache {}'.format(cache_dir))
+            return None
+
+
+def get_potcar(symbols, functional=DEFAULT_FUNCTIONAL):
+    """
+    The Potcar for symbols, through the node-local cache when there is one
+    """
+    cache = PotcarCache.auto_load()
+    if cache:
+        return cache.get_potcar(symbols, functional)
+    return Potcar(symbols, functional)
+
+
+def get_spec_potcar_symbols(spec):
+    """
+    :param spec: (dict) spec of a VASP FireWork
+    :return: (functional, [symbols]) of the POTCAR the FireWork will need, or
+    None if the spec gives no hint
+    """
+    if 'vasp' in spec:
+        return spec['vasp']['potcar'].get('functional', DEFAULT_FUNCTIONAL), \
+            spec['vasp']['potcar']['symbols']
+    if 'mpsnl' in spec:
+        # e.g. static and non-SCF runs: same POTCAR settings as the relaxation
+        structure = StructureNL.from_dict(spec['mpsnl']).structure
+        return DEFAULT_FUNCTIONAL, MPVaspInputSet().get_potcar_symbols(structure)
+    return None
+
+
+def warm_for_fworker(launchpad, fworker, limit=100, cache=None):
+    """
+    Warm the cache with the POTCARs of the FireWorks this FWorker is likely to
+    run next, i.e. the READY or RESERVED ones matching its query
+
+    :param launchpad: (LaunchPad)
+    :param fworker: (FWorker)
+    :param limit: (int) max number of FireWorks to look at, by priority
+    :param cache: (PotcarCache) defaults to the node-local one
+    :return: (dict) number of FireWorks, cache hits and misses, or None
+    without a cache
+    """
+    cache = cache if cache else PotcarCache.auto_load()
+    if not cache:
+        return None
+    query = dict(fworker.query)
+    query['state'] = {'$in': WARM_STATES}
+    symbol_sets = set()
+    n_fws = 0
+    for fw in launchpad.fireworks.find(query, {'spec.vasp.potcar': 1, 'spec.mpsnl': 1},
+                                       sort=[('spec._priority', -1)], limit=limit):
+        n_fws += 1
+        try:
+            symbols = get_spec_potcar_symbols(fw.get('spec', {}))
+        except (KeyError, ValueError):
+            logger.exception('Cannot get the POTCAR symbols of a FireWork')
+            continue
+        if symbols:
+            symbol_sets.add((symbols[0], tuple(symbols[1])))
+    stats = cache.warm(symbol_sets)
+    stats['n_fireworks'] = n_fws
+    return stats
@@ -0,0 +1,168 @@
+"""
+Moves a VASP run from the launch dir on the shared filesystem to node-local
+scratch and back. Inputs are copied to scratch before the run; afterwards all
+files are streamed back, with the large outputs that nothing downstream reads
+(e.g., WAVECAR of a finished run) gzipped on the way. Runs stay in place when
+no node-local scratch is available.
+
+Configured through the VASP launcher config (see vasp_launcher):
+
+    scratch_dir: node-local scratch root (default: $TMPDIR)
+    stage_compress_files: outputs to gzip when copying back (also matches
+        their copies from the relaxations, e.g. WAVECAR.relax1)
+    stage_compress_min_bytes: only gzip files at least this large
+"""
+
+import gzip
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from mpworks.firetasks.task_timing import count, BYTES_READ, BYTES_WRITTEN
+from mpworks.firetasks.vasp_launcher import load_launcher_config
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 22, 2013'
+
+logger = logging.getLogger(__name__)
+
+# outputs not used by later FireWorks or by MPVaspDrone
+DEFAULT_COMPRESS_FILES = ['WAVECAR', 'PROCAR', 'LOCPOT', 'ELFCAR', 'XDATCAR']
+DEFAULT_COMPRESS_MIN_BYTES = 10 * 1024 * 1024
+COPY_BUFSIZE = 4 * 1024 * 1024
+# suffix custodian gives the outputs of each step of a double relaxation
+RELAX_SUFFIX = re.compile(r'\.relax\d+$')
+
+
+def _copy_file(src, dest, compress=False):
+    # returns the number of bytes written
+    if compress:
+        with open(src, 'rb') as f_in:
+            f_out = gzip.open(dest, 'wb')
+            try:
+                shutil.copyfileobj(f_in, f_out, COPY_BUFSIZE)
+            finally:
+                f_out.close()
+    else:
+        with open(src, 'rb') as f_in:
+            with open(dest, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, COPY_BUFSIZE)
+    shutil.copystat(src, dest)
+    return os.path.getsize(dest)
+
+
+def get_node_scratch(launch_dir, config=None):
+    """
+    :return: (str) the node-local scratch root, or None if there is none
+    (or if it is on the same filesystem as launch_dir, so staging is pointless)
+    """
+    config = config if config is not None else load_launcher_config()
+    scratch = config.get('scratch_dir', os.environ.get('TMPDIR'))
+    if not scratch or not os.path.isdir(scratch) or not os.access(scratch, os.W_OK):
+        return None
+    if os.stat(scratch).st_dev == os.stat(launch_dir).st_dev:
+        return None
+    return scratch
+
+
+class ScratchStager():
+    """
+    Stages the files of launch_dir to a private directory under scratch_root,
+    and back.
+    """
+
+    def __init__(self, launch_dir, scratch_root, compress_files=None,
+                 compress_min_bytes=DEFAULT_COMPRESS_MIN_BYTES):
+        """
+        :param launch_dir: (str) the directory with the inputs, and where the
+        outputs end up
+        :param scratch_root: (str) node-local directory, or None to run in place
+        :param compress_files: ([str]) outputs to gzip when staging out
+        :param compress_min_bytes: (int) smaller files are not compressed
+        """
+        self.launch_dir = launch_dir
+        self.scratch_root = scratch_root
+        self.compress_files = compress_files if compress_files is not None \
+            else DEFAULT_COMPRESS_FILES
+        self.compress_min_bytes = compress_min_bytes
+        self.run_dir = launch_dir
+        self.stats = {'staged': False, 'scratch_dir': None}
+
+    @property
+    def staged(self):
+        return self.run_dir != self.launch_dir
+
+    def stage_in(self):
+        """
+        Copy the contents of launch_dir to scratch. Returns the dir to run in,
+        which is launch_dir itself if staging is not possible.
+        """
+        if not self.scratch_root:
+            return self.run_dir
+
+        t0 = time.time()
+        run_dir = None
+        try:
+            run_dir = tempfile.mkdtemp(prefix='vasp_', dir=self.scratch_root)
+            n_bytes = 0
+            for f in os.listdir(self.launch_dir):
+                src = os.path.join(self.launch_dir, f)
+                if os.path.isfile(src):
+                    n_bytes += _copy_file(src, os.path.join(run_dir, f))
+        except (IOError, OSError):
+            logger.exception('Could not stage to {}, running in place'.format(self.scratch_root))
+            if run_dir:
+                shutil.rmtree(run_dir, ignore_errors=True)
+            return self.run_dir
+
+        self.run_dir = run_dir
+        count(BYTES_READ, n_bytes)
+        count(BYTES_WRITTEN, n_bytes)
+        self.stats.update({'staged': True, 'scratch_dir': run_dir, 'stage_in_bytes': n_bytes,
+                           'stage_in_time': time.time() - t0})
+        return self.run_dir
+
+    def stage_out(self, compress=True):
+        """
+        Copy everything back from scratch, gzipping the large outputs in
+        compress_files (unless compress is False), and remove the scratch dir.
+        """
+        if not self.staged:
+            return
+
+        t0 = time.time()
+        n_bytes, n_written, compressed = 0, 0, []
+        for f in sorted(os.listdir(self.run_dir)):
+            src = os.path.join(self.run_dir, f)
+            if not os.path.isfile(src):
+                continue
+            size = os.path.getsize(src)
+            dest = os.path.join(self.launch_dir, f)
+            if compress and RELAX_SUFFIX.sub('', f) in self.compress_files and \
+                    size >= self.compress_min_bytes:
+                n_written += _copy_file(src, dest + '.gz', compress=True)
+                if os.path.exists(dest):
+                    os.remove(dest)  # stale input copy
+                compressed.append(f)
+            else:
+                n_written += _copy_file(src, dest)
+            n_bytes += size
+
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        count(BYTES_READ, n_bytes)
+        count(BYTES_WRITTEN, n_written)
+        self.stats.update({'stage_out_bytes': n_bytes, 'stage_out_bytes_written': n_written,
+                           'stage_out_time': time.time() - t0, 'compressed_files': compressed})
+
+    @classmethod
+    def auto_load(cls, launch_dir):
+        config = load_launcher_config()
+        return ScratchStager(launch_dir, get_node_scratch(launch_dir, config),
+                             config.get('stage_compress_files'),
+                             config.get('stage_compress_min_bytes', DEFAULT_COMPRESS_MIN_BYTES))
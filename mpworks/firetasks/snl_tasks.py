@@ -1,6 +1,7 @@
 import os
 from fireworks.core.firework import FireTaskBase, FWAction
 from fireworks.utilities.fw_serializers import FWSerializable
+from mpworks.firetasks.task_timing import timed_task
 from mpworks.snl_utils.snl_mongo import SNLMongoAdapter
 from pymatgen.matproj.snl import StructureNL
 
@@ -19,6 +20,7 @@ class AddSNLTask(FireTaskBase, FWSerializable):
 
     _fw_name = "Add SNL Task"
 
+    @timed_task
     def run_task(self, fw_spec):
         # get the SNL mongo adapter
         sma = SNLMongoAdapter.auto_load()
@@ -0,0 +1,224 @@
+"""
+Lightweight timing of the phases of FireTasks. A FireTask's run_task is
+wrapped with @timed_task; inside it (and in anything it calls), phases are
+timed with
+
+    with span('parse'):
+        ...
+
+or with the @timed('parse') decorator, and counters (bytes read/written,
+Mongo round trips) are added with count(). Spans nest ('assimilate/parse').
+The result is stored in the FWAction's stored_data['timing'], together with
+that of the earlier FireTasks of the same FireWork, and can be aggregated
+across launches with get_timing_report() (see scripts/timing_report).
+
+Set $MP_TASK_TIMING=0 to switch timing off: the decorators then return the
+functions unchanged, and span()/count() return right away.
+"""
+
+import functools
+import os
+import threading
+import time
+from fireworks.core.firework import FWAction
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 31, 2013'
+
+ENABLED = os.environ.get('MP_TASK_TIMING', '1').lower() not in ['0', 'false', 'no']
+
+BYTES_READ = 'bytes_read'
+BYTES_WRITTEN = 'bytes_written'
+MONGO_ROUND_TRIPS = 'mongo_round_trips'
+
+PERCENTILES = [50, 90, 99]
+
+_local = threading.local()
+# timings of the FireTasks run so far in the current FireWork
+_launch = {'key': None, 'timing': None}
+
+
+class TaskTimer():
+    """
+    Spans and counters of one run of a FireTask
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.spans = {}
+        self.counters = {}
+        self.stack = []
+        self.start = time.time()
+        self.total_time = None
+
+    def count(self, key, n=1):
+        self.counters[key] = self.counters.get(key, 0) + n
+        if self.stack:
+            entry = self.spans['/'.join(self.stack)]
+            entry[key] = entry.get(key, 0) + n
+
+    def stop(self):
+        self.total_time = time.time() - self.start
+
+    def to_dict(self):
+        return {'total_time': self.total_time, 'spans': self.spans, 'counters': self.counters}
+
+
+class _Span():
+    # __enter__/__exit__ of a timed phase
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.t0 = None
+
+    def __enter__(self):
+        self.timer.stack.append(self.name)
+        self.timer.spans.setdefault('/'.join(self.timer.stack), {'time': 0.0, 'calls': 0})
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        entry = self.timer.spans['/'.join(self.timer.stack)]
+        entry['time'] += time.time() - self.t0
+        entry['calls'] += 1
+        self.timer.stack.pop()
+        return False
+
+
+class _NullSpan():
+    # returned when there is nothing to time
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def get_current_timer():
+    """
+    :return: (TaskTimer) of the FireTask running in this thread, or None
+    """
+    return getattr(_local, 'timer', None)
+
+
+def span(name):
+    """
+    Context manager timing a phase of the current FireTask (a no-op outside
+    of a @timed_task, or when timing is off)
+    """
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        return _NULL_SPAN
+    return _Span(timer, name)
+
+
+def count(key, n=1):
+    """
+    Add n to a counter (e.g. BYTES_WRITTEN) of the current FireTask and span
+    """
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.count(key, n)
+
+
+def timed(name):
+    """
+    Decorator: time each call of the function as a span
+    """
+    def _decorate(f):
+        if not ENABLED:
+            return f
+
+        @functools.wraps(f)
+        def _timed(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return _timed
+    return _decorate
+
+
+def _add_to_launch(fw_spec, name, timing):
+    # all FireTasks of a FireWork get the same spec object and run in the same dir
+    key = (id(fw_spec), os.getcwd())
+    if _launch['key'] != key:
+        _launch['key'] = key
+        _launch['timing'] = {'task_type': fw_spec.get('task_type'), 'tasks': {}}
+    tasks = _launch['timing']['tasks']
+    task_name, i = name, 2
+    while task_name in tasks:
+        task_name = '{} ({})'.format(name, i)
+        i += 1
+    tasks[task_name] = timing
+    return _launch['timing']
+
+
+def timed_task(run_task):
+    """
+    Decorator for FireTask.run_task: times the whole task and the spans
+    inside it, and stores the result in stored_data['timing']
+    """
+    if not ENABLED:
+        return run_task
+
+    @functools.wraps(run_task)
+    def _run_task(self, fw_spec):
+        timer = TaskTimer(self._fw_name)
+        parent = getattr(_local, 'timer', None)
+        _local.timer = timer
+        try:
+            action = run_task(self, fw_spec)
+        finally:
+            _local.timer = parent
+            timer.stop()
+        action = action if action else FWAction()
+        action.stored_data['timing'] = _add_to_launch(fw_spec, self._fw_name, timer.to_dict())
+        return action
+    return _run_task
+
+
+def _get_percentiles(values):
+    values = sorted(values)
+    d = {'n': len(values), 'mean': sum(values) / float(len(values)), 'max': values[-1]}
+    for p in PERCENTILES:
+        d['p{}'.format(p)] = values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+    return d
+
+
+def get_timing_report(launches_coll, query=None):
+    """
+    Aggregate the timings of past launches
+
+    :param launches_coll: (pymongo Collection) the launches of a LaunchPad
+    :param query: (dict) restricts the launches, e.g. by time_start
+    :return: (dict) task_type -> metric -> percentiles, where metrics are
+    '<FireTask>' (its total time), '<FireTask>/<span>' (time) and
+    '<FireTask>/<span>:<counter>'
+    """
+    m_query = dict(query) if query else {}
+    m_query['action.stored_data.timing'] = {'$exists': True}
+    values = {}
+    for launch in launches_coll.find(m_query, {'action.stored_data.timing': 1}):
+        timing = launch['action']['stored_data']['timing']
+        metrics = values.setdefault(timing.get('task_type'), {})
+        for task_name, t in timing['tasks'].items():
+            if t.get('total_time') is not None:
+                metrics.setdefault(task_name, []).append(t['total_time'])
+            for span_name, s in t['spans'].items():
+                prefix = task_name + '/' + span_name
+                for k, v in s.items():
+                    if k == 'time':
+                        metrics.setdefault(prefix, []).append(v)
+                    elif k != 'calls':
+                        metrics.setdefault(prefix + ':' + k, []).append(v)
+
+    return dict([(task_type, dict([(m, _get_percentiles(v)) for m, v in metrics.items()]))
+                 for task_type, metrics in values.items()])
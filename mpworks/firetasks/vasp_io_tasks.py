@@ -10,7 +10,11 @@ import shutil
 from fireworks.utilities.fw_serializers import FWSerializable
 from fireworks.core.firework import FireTaskBase, FWAction
 from mpworks.drones.mp_vaspdrone import MPVaspDrone
-from pymatgen.io.vaspio.vasp_input import Incar, Poscar, Potcar, Kpoints
+from mpworks.firetasks.potcar_cache import get_potcar
+from mpworks.firetasks.task_timing import timed_task, span, count, BYTES_READ, \
+    BYTES_WRITTEN
+from pymatgen.io.vaspio.vasp_input import Incar, Poscar, Kpoints
+from pymatgen.util.io_utils import zopen, zpath
 
 __author__ = 'Anubhav Jain'
 __copyright__ = 'Copyright 2013, The Materials Project'
@@ -20,6 +24,28 @@ __email__ = 'ajain@lbl.gov'
 __date__ = 'Mar 15, 2013'
 
 
+def get_vasp_drone(parse_dos=False, additional_fields=None, update_duplicates=False):
+    """
+    An MPVaspDrone for the tasks database described in $DB_LOC/tasks_db.json;
+    'compact_arrays': true in that file turns on the compact storage of the
+    calculation outputs
+    """
+    # get the directory containing the db file
+    db_dir = os.environ['DB_LOC']
+    db_path = os.path.join(db_dir, 'tasks_db.json')
+
+    with open(db_path) as f:
+        db_creds = json.load(f)
+    return MPVaspDrone(
+        host=db_creds['host'], port=db_creds['port'],
+        database=db_creds['database'], user=db_creds['admin_user'],
+        password=db_creds['admin_password'],
+        collection=db_creds['collection'], parse_dos=parse_dos,
+        additional_fields=additional_fields if additional_fields else {},
+        update_duplicates=update_duplicates,
+        compact_arrays=db_creds.get('compact_arrays', False))
+
+
 class VaspWriterTask(FireTaskBase, FWSerializable):
     """
     Write VASP input files based on the fw_spec
@@ -27,11 +53,17 @@ class VaspWriterTask(FireTaskBase, FWSerializable):
 
     _fw_name = "Vasp Writer Task"
 
+    @timed_task
     def run_task(self, fw_spec):
-        Incar.from_dict(fw_spec['vasp']['incar']).write_file('INCAR')
-        Poscar.from_dict(fw_spec['vasp']['poscar']).write_file('POSCAR')
-        Potcar.from_dict(fw_spec['vasp']['potcar']).write_file('POTCAR')
-        Kpoints.from_dict(fw_spec['vasp']['kpoints']).write_file('KPOINTS')
+        with span('write_inputs'):
+            Incar.from_dict(fw_spec['vasp']['incar']).write_file('INCAR')
+            Poscar.from_dict(fw_spec['vasp']['poscar']).write_file('POSCAR')
+            Kpoints.from_dict(fw_spec['vasp']['kpoints']).write_file('KPOINTS')
+        with span('write_potcar'):
+            potcar = fw_spec['vasp']['potcar']
+            get_potcar(potcar['symbols'], potcar['functional']).write_file('POTCAR')
+        count(BYTES_WRITTEN, sum([os.path.getsize(f) for f in
+                                  ['INCAR', 'POSCAR', 'KPOINTS', 'POTCAR']]))
 
 
 class VaspCopyTask(FireTaskBase, FWSerializable):
@@ -55,6 +87,7 @@ class VaspCopyTask(FireTaskBase, FWSerializable):
                                         '')  # e.g., 'relax2' means to move relax2 files
         self.use_contcar = parameters.get('use_CONTCAR', True)  # whether to move CONTCAR to POSCAR
 
+    @timed_task
     def run_task(self, fw_spec):
         prev_dir = fw_spec['prev_vasp_dir']
 
@@ -64,8 +97,18 @@ class VaspCopyTask(FireTaskBase, FWSerializable):
                 prev_filename = os.path.join(prev_dir,
                                              file)  # no extension gets added to POTCAR files
             dest_file = 'POSCAR' if file == 'CONTCAR' and self.use_contcar else file
+            # outputs might have been compressed after the run (see OutputCompressor)
+            prev_filename = zpath(prev_filename)
             print 'COPYING', prev_filename, dest_file
-            shutil.copy2(prev_filename, dest_file)
+            with span('copy'):
+                if prev_filename.lower().endswith(('.gz', '.bz2', '.z')):
+                    with zopen(prev_filename, 'rb') as f_in:
+                        with open(dest_file, 'wb') as f_out:
+                            shutil.copyfileobj(f_in, f_out, 4 * 1024 * 1024)
+                else:
+                    shutil.copy2(prev_filename, dest_file)
+                count(BYTES_READ, os.path.getsize(prev_filename))
+                count(BYTES_WRITTEN, os.path.getsize(dest_file))
 
         return FWAction(stored_data={'copied_files': self.files})
 
@@ -88,31 +131,33 @@ class VaspToDBTask(FireTaskBase, FWSerializable):
         self.additional_fields = self.get('additional_fields', {})
         self.update_duplicates = self.get('update_duplicates', False)
 
+    @timed_task
     def run_task(self, fw_spec):
         prev_dir = fw_spec['prev_vasp_dir']
-        update_spec = {'prev_vasp_dir': prev_dir, 'prev_task_type': fw_spec['prev_task_type']}
-        # get the directory containing the db file
-        db_dir = os.environ['DB_LOC']
-        db_path = os.path.join(db_dir, 'tasks_db.json')
-
-        with open(db_path) as f:
-            db_creds = json.load(f)
-            drone = MPVaspDrone(
-                host=db_creds['host'], port=db_creds['port'],
-                database=db_creds['database'], user=db_creds['admin_user'],
-                password=db_creds['admin_password'],
-                collection=db_creds['collection'], parse_dos=self.parse_uniform,
-                additional_fields=self.additional_fields,
-                update_duplicates=self.update_duplicates)
+        drone = get_vasp_drone(parse_dos=self.parse_uniform,
+                               additional_fields=self.additional_fields,
+                               update_duplicates=self.update_duplicates)
+        with span('assimilate'):
             t_id, d = drone.assimilate(prev_dir)
 
-        mpsnl = d['snl_final'] if 'snl_final' in d else d['snl']
-        snlgroup_id = d['snlgroup_id_final'] if 'snlgroup_id_final' in d else d['snlgroup_id']
-        update_spec.update({'mpsnl': mpsnl, 'snlgroup_id': snlgroup_id})
-
         print 'ENTERED task id:', t_id
-        stored_data = {'task_id': t_id}
-        if d['state'] == 'successful':
-            update_spec['analysis'] = d['analysis']
-            return FWAction(stored_data=stored_data, update_spec=update_spec)
-        return FWAction(stored_data=stored_data, defuse_children=True)
+        return get_insertion_action(fw_spec, t_id, d)
+
+
+def get_insertion_action(fw_spec, t_id, d):
+    """
+    The FWAction of a VaspToDBTask once the run in fw_spec['prev_vasp_dir']
+    is in the database: the children get the final SNL and the analysis, or
+    are defused if the run failed
+    """
+    update_spec = {'prev_vasp_dir': fw_spec['prev_vasp_dir'],
+                   'prev_task_type': fw_spec['prev_task_type']}
+    mpsnl = d['snl_final'] if 'snl_final' in d else d['snl']
+    snlgroup_id = d['snlgroup_id_final'] if 'snlgroup_id_final' in d else d['snlgroup_id']
+    update_spec.update({'mpsnl': mpsnl, 'snlgroup_id': snlgroup_id})
+
+    stored_data = {'task_id': t_id}
+    if d['state'] == 'successful':
+        update_spec['analysis'] = d['analysis']
+        return FWAction(stored_data=stored_data, update_spec=update_spec)
+    return FWAction(stored_data=stored_data, defuse_children=True)
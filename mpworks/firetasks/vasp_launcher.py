@@ -0,0 +1,269 @@
+"""
+Figures out how VASP should be launched on the current node: how many MPI
+ranks are available (from the scheduler environment, the CPU affinity or an
+explicit config file) and which MPI launcher to use. NPAR/KPAR are chosen by
+the ParallelizationAdvisor once the number of ranks is known. Also reports
+when the scheduler allocation ends, so that runs can stop in time.
+
+The optional config file is found in $VASP_LAUNCHER_CONFIG, or as
+my_vasp_launcher.yaml in the FireWorks config dir. Recognized keys:
+
+    vasp_cmd: MPI command template, e.g. "aprun -n {ncores} vasp"; packed
+        runs also fill in {cpus} (see get_slot_vasp_cmd)
+    ncores: total number of ranks to use (overrides the scheduler)
+    max_ranks_per_site: cap the number of ranks for small structures
+    walltime: allocation length in seconds, if the scheduler can't tell
+    scratch_dir, stage_compress_files, stage_compress_min_bytes: see
+        scratch_staging
+    compress_outputs, compress_threads, compress_min_bytes: see
+        output_compression
+    potcar_cache_dir: see potcar_cache
+    kpoint_cache_dir: see kpoint_cache
+"""
+
+import multiprocessing
+import os
+import shlex
+import socket
+import subprocess
+import time
+import yaml
+from fireworks.core.fw_config import FWConfig
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 16, 2013'
+
+LAUNCHER_CONFIG_FILE = 'my_vasp_launcher.yaml'
+# cores (e.g. '0-7') a packed run is restricted to
+SLOT_CPUS_ENV = 'MP_VASP_CPUS'
+
+
+def _get_env_int(*names):
+    for name in names:
+        if os.environ.get(name, '').isdigit():
+            return int(os.environ[name])
+    return None
+
+
+def _expand_cpu_list(cpu_list):
+    # e.g. '0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]
+    cpus = []
+    for part in cpu_list.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part.strip():
+            cpus.append(int(part))
+    return cpus
+
+
+def _parse_cpu_list(cpu_list):
+    # e.g. '0-3,8,10-11' -> 7
+    return len(_expand_cpu_list(cpu_list))
+
+
+def get_affinity_cpu_ids():
+    """
+    Ids of the cores this process is allowed to run on, falling back to all
+    the cores when the affinity cannot be read.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Cpus_allowed_list:'):
+                    return _expand_cpu_list(line.split(':', 1)[1].strip())
+    except (IOError, ValueError):
+        pass
+    return range(multiprocessing.cpu_count())
+
+
+def get_affinity_cores():
+    """
+    Number of cores this process is allowed to run on, falling back to the
+    total number of cores when the affinity cannot be read.
+    """
+    return len(get_affinity_cpu_ids())
+
+
+def get_scheduler_resources():
+    """
+    :return: (dict) with keys 'scheduler' ('slurm', 'pbs' or 'local'),
+    'nodes' and 'ncores' (total number of MPI ranks in the allocation)
+    """
+    if 'SLURM_JOB_ID' in os.environ:
+        nodes = _get_env_int('SLURM_JOB_NUM_NODES', 'SLURM_NNODES') or 1
+        ncores = _get_env_int('SLURM_NTASKS', 'SLURM_NPROCS')
+        if not ncores:
+            per_node = _get_env_int('SLURM_NTASKS_PER_NODE', 'SLURM_CPUS_ON_NODE')
+            ncores = per_node * nodes if per_node else None
+        return {'scheduler': 'slurm', 'nodes': nodes,
+                'ncores': ncores or get_affinity_cores() * nodes}
+
+    if 'PBS_JOBID' in os.environ:
+        ncores = _get_env_int('PBS_NP')
+        nodes = _get_env_int('PBS_NUM_NODES')
+        if not ncores and os.path.exists(os.environ.get('PBS_NODEFILE', '')):
+            with open(os.environ['PBS_NODEFILE']) as f:
+                hosts = [line.strip() for line in f if line.strip()]
+            ncores = len(hosts)
+            nodes = nodes or len(set(hosts))
+        if not ncores:
+            per_node = _get_env_int('PBS_NUM_PPN')
+            ncores = per_node * nodes if per_node and nodes else None
+        nodes = nodes or 1
+        return {'scheduler': 'pbs', 'nodes': nodes,
+                'ncores': ncores or get_affinity_cores() * nodes}
+
+    return {'scheduler': 'local', 'nodes': 1, 'ncores': get_affinity_cores()}
+
+
+def _parse_duration(duration):
+    # '[D-]HH:MM:SS' or 'MM:SS' (as printed by squeue and qstat) -> seconds
+    days = 0
+    if '-' in duration:
+        days, duration = duration.split('-', 1)
+    secs = 0
+    for part in duration.split(':'):
+        secs = secs * 60 + int(part)
+    return int(days) * 86400 + secs
+
+
+def _get_command_output(cmd):
+    try:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return p.communicate()[0]
+    except OSError:
+        return ''
+
+
+def get_walltime_end(config=None):
+    """
+    :return: (float) epoch time at which the current allocation is killed,
+    or None if it cannot be determined
+    """
+    config = config if config is not None else load_launcher_config()
+    try:
+        if _get_env_int('SLURM_JOB_END_TIME'):
+            return float(os.environ['SLURM_JOB_END_TIME'])
+        if 'SLURM_JOB_ID' in os.environ:
+            time_left = _get_command_output(
+                ['squeue', '-h', '-j', os.environ['SLURM_JOB_ID'], '-o', '%L']).strip()
+            if time_left and time_left[0].isdigit():
+                return time.time() + _parse_duration(time_left)
+        if 'PBS_JOBID' in os.environ:
+            limit, used = None, None
+            for line in _get_command_output(['qstat', '-f', os.environ['PBS_JOBID']]).splitlines():
+                if 'Resource_List.walltime' in line:
+                    limit = _parse_duration(line.split('=')[1].strip())
+                elif 'resources_used.walltime' in line:
+                    used = _parse_duration(line.split('=')[1].strip())
+            if limit:
+                return time.time() + limit - (used or 0)
+    except ValueError:
+        pass
+    if config.get('walltime'):
+        # best guess: the allocation started when this process did
+        return time.time() - _get_process_age() + config['walltime']
+    return None
+
+
+def _get_process_age():
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = float(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (IOError, ValueError, IndexError, OSError):
+        return 0
+
+
+def load_launcher_config():
+    config_file = os.environ.get('VASP_LAUNCHER_CONFIG',
+                                 os.path.join(FWConfig().CONFIG_FILE_DIR, LAUNCHER_CONFIG_FILE))
+    if os.path.exists(config_file):
+        with open(config_file) as f:
+            return yaml.load(f.read()) or {}
+    return {}
+
+
+def get_default_vasp_cmd(scheduler, hostname):
+    if 'nid' in hostname:  # Cray compute nodes (e.g., hopper)
+        return 'aprun -n {ncores} vasp'
+    if scheduler == 'slurm':
+        return 'srun -n {ncores} vasp'
+    return 'mpirun -n {ncores} vasp'
+
+
+def get_vasp_cmd_template(config=None):
+    config = config if config is not None else load_launcher_config()
+    return config.get('vasp_cmd', get_default_vasp_cmd(get_scheduler_resources()['scheduler'],
+                                                       socket.gethostname()))
+
+
+def get_slot_vasp_cmd(cmd_template, slot_cpus):
+    """
+    The command template of a packed run, bound to the cores of its slot:
+    srun binds the ranks itself, a local mpirun passes the affinity of
+    taskset on to them. The ranks of other launchers (e.g. aprun) are not
+    children of the command, so vasp_cmd must place them with {cpus}.
+
+    :param cmd_template: (str) e.g. 'srun -n {ncores} vasp'
+    :param slot_cpus: (str) e.g. '0-3' or '0,1,2,3'
+    :return: (str) the template, still to be formatted with ncores and cpus
+    """
+    if '{cpus}' in cmd_template:
+        return cmd_template
+    launcher = os.path.basename(shlex.split(cmd_template)[0])
+    if launcher == 'srun':
+        cpu_map = ','.join([str(c) for c in _expand_cpu_list(slot_cpus)])
+        return 'srun --exclusive --cpu_bind=map_cpu:{} {}'.format(
+            cpu_map, cmd_template.split(None, 1)[1])
+    if launcher in ['mpirun', 'mpiexec']:
+        return 'taskset -c {cpus} ' + cmd_template
+    raise ValueError("Can't bind the ranks of '{}' to a slot, put {{cpus}} in vasp_cmd"
+                     .format(cmd_template))
+
+
+def get_launch_layout(nsites=None, config=None):
+    """
+    Decide how to launch VASP on this node.
+
+    :param nsites: (int) number of sites in the structure, used to cap the
+    number of ranks if max_ranks_per_site is configured
+    :param config: (dict) launcher config, loaded from file if None
+    :return: (dict) the layout: scheduler, hostname, nodes, ncores, nranks
+    and the vasp_cmd (as a String)
+    """
+    config = config if config is not None else load_launcher_config()
+    hostname = socket.gethostname()
+    resources = get_scheduler_resources()
+
+    # a packed launch (see job_packing) restricts each run to a set of cores
+    slot_cpus = os.environ.get(SLOT_CPUS_ENV)
+    if slot_cpus:
+        ncores = _parse_cpu_list(slot_cpus)
+    else:
+        ncores = config.get('ncores', resources['ncores'])
+    nranks = ncores
+    if nsites and config.get('max_ranks_per_site'):
+        nranks = max(min(nranks, nsites * config['max_ranks_per_site']), 1)
+
+    cmd_template = config.get('vasp_cmd', get_default_vasp_cmd(resources['scheduler'], hostname))
+    if slot_cpus:
+        cmd_template = get_slot_vasp_cmd(cmd_template, slot_cpus)
+
+    layout = {'scheduler': resources['scheduler'], 'hostname': hostname,
+              'nodes': 1 if slot_cpus else resources['nodes'], 'ncores': ncores,
+              'nranks': nranks, 'vasp_cmd': cmd_template.format(ncores=nranks, cpus=slot_cpus)}
+    if slot_cpus:
+        layout['cpus'] = slot_cpus
+    return layout
+
+
+def get_vasp_exe(layout):
+    return shlex.split(layout['vasp_cmd'])
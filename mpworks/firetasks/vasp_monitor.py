@@ -0,0 +1,359 @@
+"""
+Watches a running VASP job: the output files are tailed as they grow (only
+the appended bytes are read), the vasp.out signal rules are matched against
+the new data, and progress (ionic step, energy, elapsed time) is published
+to the FireWorks launch. Changes are picked up through inotify when
+available, with a polling fallback.
+
+VaspMonitorHandler plugs the monitor into Custodian, so that a run showing
+a fatal or correctable error is stopped early instead of burning the rest of
+the allocation: a fatal one ends the run (which is then recorded as an error)
+or, in 'checkpoint' mode, stops it cleanly to be continued, as is done ahead
+of the end of the allocation.
+"""
+
+import ctypes
+import ctypes.util
+import datetime
+import json
+import logging
+import os
+import re
+import select
+import struct
+import threading
+import time
+from custodian.custodian import ErrorHandler
+from custodian.vasp.handlers import VaspErrorHandler
+from fireworks.core.fw_config import FWConfig
+from fireworks.core.launchpad import LaunchPad
+from mpworks.drones.signal_rules import get_rule_set
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 20, 2013'
+
+logger = logging.getLogger(__name__)
+
+# signals after which continuing the run is pointless (see signal_rules.yaml)
+FATAL_SIGNALS = ['NETWORK_QUIESCED', 'HARD_KILLED', 'INCOHERENT_POTCARS',
+                 'ATOMS_TOO_CLOSE']
+
+# signals that custodian's VaspErrorHandler knows how to fix
+CORRECTABLE_SIGNALS = ['TETRAHEDRON_FAIL', 'KPOINT_DETECTION_FAIL',
+                       'TETIRR_FAIL', 'CLASSROTMAT_FAIL', 'KPOINT_SHIFT_FAIL',
+                       'INVROT_FAIL', 'BROYDENMIX_FAIL', 'DAVIDSON_FAIL',
+                       'RSPHER_FAIL']
+
+STOPCAR_CONTENT = 'LSTOP = .TRUE.\n'
+
+OSZICAR_IONIC_RE = re.compile(r'^\s*(\d+)\s+F=\s*([-+.\dEe]+)', re.MULTILINE)
+OUTCAR_LOOP_RE = re.compile(r'LOOP\+:\s+cpu time\s+([\d.]+):\s+real time\s+([\d.]+)')
+
+
+class VaspFatalSignalError(RuntimeError):
+    """
+    Raised through Custodian once a job was terminated on fatal signals
+    """
+
+    def __init__(self, signals):
+        RuntimeError.__init__(self, 'VASP run stopped early by monitor, signals: {}'
+                              .format(sorted(signals)))
+        self.signals = sorted(signals)
+
+
+class FileTailer():
+    """
+    Returns the complete lines appended to a file since the last call.
+    Starts over if the file is truncated or replaced (e.g. a new custodian
+    job rewriting vasp.out).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.inode = None
+        self.partial = ''
+
+    def read_new(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return ''
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            self.inode = st.st_ino
+            self.offset = 0
+            self.partial = ''
+        if st.st_size == self.offset:
+            return ''
+
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(st.st_size - self.offset)
+        self.offset += len(data)
+
+        data = self.partial + data
+        idx = data.rfind('\n')
+        self.partial = data[idx + 1:]
+        return data[:idx + 1]
+
+
+class _InotifyWatch():
+    IN_MODIFY = 0x00000002
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len of the name
+
+    def __init__(self, dir_name, filenames):
+        """
+        :param filenames: ([str]) only the events of these files wake wait()
+        up; e.g. not those of the files the monitor writes itself
+        """
+        # raises (AttributeError, OSError) where inotify is not available
+        self.filenames = set(filenames)
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        mask = self.IN_MODIFY | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, dir_name, mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def _read_names(self):
+        data = os.read(self.fd, 65536)
+        names = set()
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            _, _, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            names.add(data[offset:offset + length].rstrip('\0'))
+            offset += length
+        return names
+
+    def wait(self, timeout):
+        """
+        :return: (bool) True if one of the watched files changed before timeout
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if not ready:
+                return False
+            if self._read_names() & self.filenames:
+                return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LaunchProgressPublisher():
+    """
+    Publishes run progress on the RUNNING launch with the given launch_dir
+    (as 'vasp_progress'), and to vasp_progress.json in the run dir. Updates to
+    the LaunchPad are throttled to one per min_interval secs.
+    """
+
+    def __init__(self, dir_name, launchpad=None, min_interval=60, launch_dir=None):
+        self.dir_name = dir_name
+        self.launch_dir = launch_dir if launch_dir else dir_name  # differs when run on scratch
+        self.launchpad = launchpad
+        self.min_interval = min_interval
+        self.last_publish = 0
+
+    def publish(self, progress, force=False):
+        with open(os.path.join(self.dir_name, 'vasp_progress.json'), 'w') as f:
+            json.dump(progress, f)
+
+        if self.launchpad and (force or time.time() - self.last_publish > self.min_interval):
+            try:
+                self.launchpad.launches.update({'launch_dir': self.launch_dir, 'state': 'RUNNING'},
+                                               {'$set': {'vasp_progress': progress}})
+                self.last_publish = time.time()
+            except Exception:
+                logger.exception('Could not publish progress to the LaunchPad')
+
+    @classmethod
+    def auto_load(cls, dir_name, launch_dir=None):
+        l_file = os.path.join(FWConfig().CONFIG_FILE_DIR, 'my_launchpad.yaml')
+        launchpad = None
+        if os.path.exists(l_file):
+            try:
+                launchpad = LaunchPad.from_file(l_file)
+            except Exception:
+                logger.exception('Could not load the LaunchPad, progress only goes to file')
+        return LaunchProgressPublisher(dir_name, launchpad, launch_dir=launch_dir)
+
+
+class VaspOutputMonitor(threading.Thread):
+    """
+    Background thread that tails vasp.out, OSZICAR and OUTCAR in dir_name
+    """
+
+    def __init__(self, dir_name, publisher=None, poll_interval=10,
+                 walltime_end=None, walltime_margin=600):
+        """
+        :param dir_name: (str) the run directory
+        :param publisher: (LaunchProgressPublisher) where to report progress
+        :param poll_interval: (int) max secs between checks of the files
+        :param walltime_end: (float) epoch time at which the allocation ends
+        :param walltime_margin: (int) write the STOPCAR at least this many secs
+        before walltime_end (or two ionic steps, whichever is longer)
+        """
+        super(VaspOutputMonitor, self).__init__()
+        self.daemon = True
+        self.dir_name = dir_name
+        self.publisher = publisher
+        self.poll_interval = poll_interval
+        self.walltime_end = walltime_end
+        self.walltime_margin = walltime_margin
+        self.walltime_stop = False  # whether a STOPCAR was written for the walltime
+        self.checkpoint_signals = set()  # fatal signals a STOPCAR was written for
+
+        self.patterns = get_rule_set().get_patterns('vasp.out')
+        self.tailers = {f: FileTailer(os.path.join(dir_name, f))
+                        for f in ['vasp.out', 'OSZICAR', 'OUTCAR']}
+
+        self.start_time = time.time()
+        self.signals = set()  # all signals seen during the run
+        self.pending_signals = set()  # signals not yet consumed by a handler
+        self.progress = {'ionic_step': 0, 'energy': None, 'last_ionic_step_time': None,
+                         'elapsed_time': 0, 'signals': []}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def pop_signals(self):
+        with self._lock:
+            signals = self.pending_signals
+            self.pending_signals = set()
+        return signals
+
+    def check_once(self):
+        changed = False
+
+        new_text = self.tailers['vasp.out'].read_new().lower()
+        if new_text:
+            found = set([signal for pattern, signal in self.patterns if pattern in new_text])
+            if found:
+                # not deduplicated against earlier data: after a correction the
+                # job is rerun and the same error has to be caught again
+                if found - self.signals:
+                    logger.info('Detected VASP signals: {}'.format(sorted(found - self.signals)))
+                    changed = True
+                with self._lock:
+                    self.signals.update(found)
+                    self.pending_signals.update(found)
+
+        steps = OSZICAR_IONIC_RE.findall(self.tailers['OSZICAR'].read_new())
+        if steps:
+            self.progress['ionic_step'] = int(steps[-1][0])
+            self.progress['energy'] = float(steps[-1][1])
+            changed = True
+
+        loops = OUTCAR_LOOP_RE.findall(self.tailers['OUTCAR'].read_new())
+        if loops:
+            self.progress['last_ionic_step_time'] = float(loops[-1][1])
+
+        self.progress['elapsed_time'] = time.time() - self.start_time
+        if self.walltime_end and not self.walltime_stop:
+            margin = max(self.walltime_margin, 2 * (self.progress['last_ionic_step_time'] or 0))
+            if time.time() > self.walltime_end - margin:
+                with open(os.path.join(self.dir_name, 'STOPCAR'), 'w') as f:
+                    f.write(STOPCAR_CONTENT)
+                logger.warning('Walltime almost over, wrote STOPCAR')
+                self.walltime_stop = True
+                changed = True
+        self.progress['walltime_stop'] = self.walltime_stop
+        self.progress['signals'] = sorted(self.signals)
+        self.progress['updated_at'] = datetime.datetime.utcnow().isoformat()
+        if self.publisher:
+            self.publisher.publish(dict(self.progress), force=changed)
+
+    def run(self):
+        try:
+            watch = _InotifyWatch(self.dir_name, self.tailers.keys())
+        except (AttributeError, OSError, TypeError):
+            watch = None
+            logger.info('inotify unavailable, polling every {} s'.format(self.poll_interval))
+
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    self.check_once()
+                except Exception:
+                    logger.exception('Error while monitoring {}'.format(self.dir_name))
+                if watch:
+                    # wake up on file changes, but poll anyway in case writes
+                    # come from another node of a shared filesystem
+                    watch.wait(self.poll_interval)
+                else:
+                    self._stop_event.wait(self.poll_interval)
+        finally:
+            if watch:
+                watch.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join(2 * self.poll_interval)
+        self.check_once()  # pick up the final state of the run
+
+
+class VaspMonitorHandler(ErrorHandler):
+    """
+    Custodian monitor backed by a VaspOutputMonitor. On a fatal signal the
+    job is either terminated (and the task fails), or, in 'checkpoint' mode,
+    asked to stop cleanly after the current ionic step through a STOPCAR.
+    Correctable signals terminate the job and hand over to VaspErrorHandler.
+    """
+
+    def __init__(self, monitor, action='terminate', fatal_signals=None,
+                 correctable_signals=None):
+        self.monitor = monitor
+        self.action = action
+        self.fatal_signals = set(fatal_signals if fatal_signals is not None else FATAL_SIGNALS)
+        self.correctable_signals = set(correctable_signals if correctable_signals is not None
+                                       else CORRECTABLE_SIGNALS)
+        self.errors = set()
+        self.error_handler = VaspErrorHandler()
+
+    def check(self):
+        signals = self.monitor.pop_signals()
+        fatal = signals & self.fatal_signals
+        if fatal and self.action == 'checkpoint':
+            with open(os.path.join(self.monitor.dir_name, 'STOPCAR'), 'w') as f:
+                f.write(STOPCAR_CONTENT)
+            logger.warning('Wrote STOPCAR after signals {}'.format(sorted(fatal)))
+            # the run is continued, as after a walltime stop (see VaspCustodianTask)
+            self.monitor.checkpoint_signals.update(fatal)
+            return False
+
+        self.errors = fatal
+        if signals & self.correctable_signals and self.error_handler.check():
+            self.errors = self.errors | (signals & self.correctable_signals)
+        return len(self.errors) > 0
+
+    def correct(self):
+        fatal = self.errors & self.fatal_signals
+        if fatal:
+            # Custodian would rerun the job: end it here instead
+            raise VaspFatalSignalError(fatal)
+        d = self.error_handler.correct()
+        d['monitor_signals'] = sorted(self.errors)
+        return d
+
+    @property
+    def is_monitor(self):
+        return True
+
+    @property
+    def to_dict(self):
+        return {'@module': self.__class__.__module__,
+                '@class': self.__class__.__name__,
+                'action': self.action, 'fatal_signals': sorted(self.fatal_signals),
+                'correctable_signals': sorted(self.correctable_signals)}
@@ -1,10 +1,12 @@
 import os
 from fireworks.utilities.fw_serializers import FWSerializable
 from fireworks.core.firework import FireTaskBase, FWAction
+from mpworks.firetasks.kpoint_cache import get_kpoint_cache
+from mpworks.firetasks.potcar_cache import get_potcar
+from mpworks.firetasks.task_timing import timed_task, span
 from pymatgen.io.vaspio.vasp_output import Vasprun, Outcar
 from pymatgen.io.vaspio.vasp_input import Incar, Poscar, Kpoints, VaspInput
 from pymatgen.io.vaspio_set import MPVaspInputSet, MPStaticVaspInputSet, MPNonSCFVaspInputSet
-from pymatgen.symmetry.bandstructure import HighSymmKpath
 
 __author__ = 'Wei Chen, Anubhav Jain'
 __copyright__ = 'Copyright 2013, The Materials Project'
@@ -16,6 +18,30 @@ __date__ = 'Mar 20, 2013'
 module_dir = os.path.dirname(__file__)
 
 
+def write_vasp_input(vasp_input_set, structure, output_dir='.', kpoints=None):
+    """
+    Same as vasp_input_set.write_input(), but the POTCAR comes from the
+    node-local POTCAR cache instead of VASP_PSP_DIR
+
+    :param kpoints: (str) text of the KPOINTS file, if it is already known
+    (see kpoint_cache); the input set's k-points are not generated then
+    """
+    with span('write_inputs'):
+        if kpoints is None:
+            for k, v in vasp_input_set.get_all_vasp_input(structure,
+                                                          generate_potcar=False).items():
+                if k != 'POTCAR.spec':
+                    v.write_file(os.path.join(output_dir, k))
+        else:
+            vasp_input_set.get_incar(structure).write_file(os.path.join(output_dir, 'INCAR'))
+            vasp_input_set.get_poscar(structure).write_file(os.path.join(output_dir, 'POSCAR'))
+            with open(os.path.join(output_dir, 'KPOINTS'), 'w') as f:
+                f.write(kpoints)
+    with span('write_potcar'):
+        get_potcar(vasp_input_set.get_potcar_symbols(structure)).write_file(
+            os.path.join(output_dir, 'POTCAR'))
+
+
 class SetupStaticRunTask(FireTaskBase, FWSerializable):
     """
     Set VASP input sets for static runs, assuming vasp Outputs (vasprun.xml and OUTCAR) from
@@ -24,16 +50,25 @@ class SetupStaticRunTask(FireTaskBase, FWSerializable):
 
     _fw_name = "Setup Static Task"
 
+    @timed_task
     def run_task(self, fw_spec):
-        user_incar_settings = {"NPAR": 2}
-
-        MPStaticVaspInputSet.from_previous_vasp_run(os.getcwd(),
-                                                    user_incar_settings=user_incar_settings)
-        structure = MPStaticVaspInputSet.get_structure(Vasprun("vasprun.xml"), Outcar("OUTCAR"),
-                                                       initial_structure=False,
-                                                       refined_structure=True)
+        # NPAR/KPAR are set by VaspCustodianTask for the actual number of ranks
+        # (same as MPStaticVaspInputSet.from_previous_vasp_run, with a cached POTCAR)
+        try:
+            with span('parse_outputs'):
+                vasp_run = Vasprun("vasprun.xml", parse_dos=False, parse_eigen=None)
+                outcar = Outcar("OUTCAR")
+        except Exception as e:
+            raise RuntimeError("Can't get valid results from relaxed run: " + str(e))
         # redo POTCAR - this is necessary whenever you change a Structure
         # because element order might change!! (learned the hard way...) -AJ
+        with span('symmetry'):
+            primitive = MPStaticVaspInputSet.get_structure(vasp_run, outcar)
+        write_vasp_input(MPStaticVaspInputSet(), primitive)
+        with span('symmetry'):
+            structure = MPStaticVaspInputSet.get_structure(vasp_run, outcar,
+                                                           initial_structure=False,
+                                                           refined_structure=True)
 
         return FWAction(stored_data={'refined_struct': structure[1].to_dict})
 
@@ -53,31 +88,34 @@ class SetupNonSCFTask(FireTaskBase, FWSerializable):
         self.update(parameters)  # store the parameters explicitly set by the user
         self.line = parameters.get('mode', 'line').lower() == 'line'
 
+    @timed_task
     def run_task(self, fw_spec):
 
         try:
-            vasp_run = Vasprun("vasprun.xml", parse_dos=False,
-                               parse_eigen=False)
-            outcar = Outcar(os.path.join(os.getcwd(), "OUTCAR"))
+            with span('parse_outputs'):
+                vasp_run = Vasprun("vasprun.xml", parse_dos=False,
+                                   parse_eigen=False)
+                outcar = Outcar(os.path.join(os.getcwd(), "OUTCAR"))
         except Exception as e:
             raise RuntimeError("Can't get valid results from relaxed run: " + str(e))
 
         user_incar_settings = MPNonSCFVaspInputSet.get_incar_settings(vasp_run, outcar)
-        user_incar_settings.update({"NPAR": 2})
         structure = MPNonSCFVaspInputSet.get_structure(vasp_run, outcar, initial_structure=True)
 
+        # the k-path or uniform mesh, computed once for equivalent structures
+        with span('kpath' if self.line else 'kmesh'):
+            kpoints = get_kpoint_cache().get_kpoints(structure, 'line' if self.line else 'uniform')
+
         if self.line:
             mpnscfvip = MPNonSCFVaspInputSet(user_incar_settings, mode="Line")
-            for k, v in mpnscfvip.get_all_vasp_input(structure, generate_potcar=True).items():
-                v.write_file(os.path.join(os.getcwd(), k))
-            kpath = HighSymmKpath(structure)
+            write_vasp_input(mpnscfvip, structure, os.getcwd(), kpoints['kpoints'])
         else:
             mpnscfvip = MPNonSCFVaspInputSet(user_incar_settings, mode="Uniform")
-            for k, v in mpnscfvip.get_all_vasp_input(structure, generate_potcar=True).items():
-                v.write_file(os.path.join(os.getcwd(), k))
+            write_vasp_input(mpnscfvip, structure, os.getcwd(), kpoints['kpoints'])
 
         if self.line:
-            return FWAction(stored_data={"kpath": kpath.kpath, "kpath_name": kpath.name})
+            return FWAction(stored_data={"kpath": kpoints['kpath'],
+                                         "kpath_name": kpoints['kpath_name']})
         else:
             return FWAction()
 
@@ -2,10 +2,12 @@ import datetime
 import os
 from pymongo import MongoClient, DESCENDING
 from fireworks.utilities.fw_serializers import FWSerializable
+from mpworks.firetasks.mongo_profiler import profiled, profile_collection
+from mpworks.firetasks.task_timing import span, count, MONGO_ROUND_TRIPS
 from mpworks.snl_utils.mpsnl import MPStructureNL, SNLGroup
 from pymatgen import Structure
 from pymatgen.matproj.snl import StructureNL
-from pymatgen.symmetry.finder import SymmetryFinder
+from mpworks.snl_utils.symmetry import get_symmetry_service
 
 
 __author__ = 'Anubhav Jain'
@@ -15,9 +17,6 @@ __maintainer__ = 'Anubhav Jain'
 __email__ = 'ajain@lbl.gov'
 __date__ = 'Apr 24, 2013'
 
-# Parameters for spacegroup and mps_unique_id determination
-SPACEGROUP_TOLERANCE = 0.1  # as suggested by Shyue, 6/19/2012
-
 # TODO: add logging
 
 class SNLMongoAdapter(FWSerializable):
@@ -33,9 +32,9 @@ class SNLMongoAdapter(FWSerializable):
         if self.username:
             self.database.authenticate(username, password)
 
-        self.snl = self.database.snl
-        self.snlgroups = self.database.snlgroups
-        self.id_assigner = self.database.id_assigner
+        self.snl = profile_collection(self.database.snl)
+        self.snlgroups = profile_collection(self.database.snlgroups)
+        self.id_assigner = profile_collection(self.database.id_assigner)
 
         self._update_indices()
 
@@ -66,11 +65,13 @@ class SNLMongoAdapter(FWSerializable):
         self.snlgroups.ensure_index('autometa.is_ordered')
 
     def _get_next_snl_id(self):
+        count(MONGO_ROUND_TRIPS)
         snl_id = self.id_assigner.find_and_modify(query={}, update={'$inc': {'next_snl_id': 1}})[
             'next_snl_id']
         return snl_id
 
     def _get_next_snlgroup_id(self):
+        count(MONGO_ROUND_TRIPS)
         snlgroup_id = self.id_assigner.find_and_modify(query={}, update={'$inc': {'next_snlgroup_id': 1}})['next_snlgroup_id']
         return snlgroup_id
 
@@ -78,26 +79,34 @@ class SNLMongoAdapter(FWSerializable):
         self.id_assigner.remove()
         self.id_assigner.insert({"next_snl_id": next_snl_id, "next_snlgroup_id": next_snlgroup_id})
 
-    def add_snl(self, snl):
+    @profiled
+    def add_snl(self, snl, sym_data=None):
         snl_id = self._get_next_snl_id()
-        sf = SymmetryFinder(snl.structure, SPACEGROUP_TOLERANCE)
-        sf.get_spacegroup()
-        mpsnl = MPStructureNL.from_snl(snl, snl_id, sf.get_spacegroup_number(),
-                                       sf.get_spacegroup_symbol(), sf.get_hall(),
-                                       sf.get_crystal_system(), sf.get_lattice_type())
+        if not sym_data:
+            with span('symmetry'):
+                sym_data = get_symmetry_service().get_symmetry(snl.structure)
+        mpsnl = MPStructureNL.from_snl(snl, snl_id, sym_data['sg_num'],
+                                       sym_data['sg_symbol'], sym_data['hall'],
+                                       sym_data['xtal_system'], sym_data['lattice_type'])
         snlgroup, add_new = self.add_mpsnl(mpsnl)
         return mpsnl, snlgroup.snlgroup_id
 
+    @profiled
     def add_mpsnl(self, mpsnl):
         snl_d = mpsnl.to_dict
         snl_d['snl_timestamp'] = datetime.datetime.utcnow().isoformat()
-        self.snl.insert(snl_d)
-        return self.build_groups(mpsnl)
+        with span('insert'):
+            self.snl.insert(snl_d)
+            count(MONGO_ROUND_TRIPS)
+        with span('build_groups'):
+            return self.build_groups(mpsnl)
 
+    @profiled
     def build_groups(self, mpsnl, testing_mode=False):
         # testing mode is used to see if something already exists in DB w/o adding it to the db
         add_new = True
 
+        count(MONGO_ROUND_TRIPS)
         for entry in self.snlgroups.find({'snlgroup_key': mpsnl.snlgroup_key},
                                          sort=[("num_snl", DESCENDING)]):
             snlgroup = SNLGroup.from_dict(entry)
@@ -107,6 +116,7 @@ class SNLMongoAdapter(FWSerializable):
                     (mpsnl.snl_id, snlgroup.snlgroup_id))
                 if not testing_mode:
                     self.snlgroups.update({'snlgroup_id': snlgroup.snlgroup_id}, snlgroup.to_dict)
+                    count(MONGO_ROUND_TRIPS)
                 break
 
         if add_new:
@@ -115,9 +125,20 @@ class SNLMongoAdapter(FWSerializable):
             snlgroup = SNLGroup(snlgroup_id, mpsnl)
             if not testing_mode:
                 self.snlgroups.insert(snlgroup.to_dict)
+                count(MONGO_ROUND_TRIPS)
 
         return snlgroup, add_new
 
+    @profiled
+    def lookup_snlgroup_id(self, mpsnl):
+        # like build_groups(testing_mode=True), but never assigns a new snlgroup_id
+        count(MONGO_ROUND_TRIPS)
+        for entry in self.snlgroups.find({'snlgroup_key': mpsnl.snlgroup_key},
+                                         sort=[("num_snl", DESCENDING)]):
+            if SNLGroup.from_dict(entry).add_if_belongs(mpsnl):
+                return entry['snlgroup_id']
+        return None
+
     def to_dict(self):
         """
         Note: usernames/passwords are exported as unencrypted Strings!
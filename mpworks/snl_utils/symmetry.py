@@ -0,0 +1,162 @@
+import hashlib
+import json
+import multiprocessing
+from collections import OrderedDict
+from pymatgen import Structure
+from pymatgen.symmetry.finder import SymmetryFinder
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 14, 2013'
+
+# Parameters for spacegroup and mps_unique_id determination
+SPACEGROUP_TOLERANCE = 0.1  # as suggested by Shyue, 6/19/2012
+
+# number of decimals kept when fingerprinting lattices and fractional coords
+FINGERPRINT_DECIMALS = 6
+
+
+def get_structure_fingerprint(structure, tolerance=SPACEGROUP_TOLERANCE):
+    """
+    Returns a hash that identifies a structure (lattice, species and
+    fractional coordinates) together with the symmetry tolerance.
+    Two structures with the same fingerprint will give the same symmetry
+    data.
+    """
+    lattice = [[round(x, FINGERPRINT_DECIMALS) for x in row]
+               for row in structure.lattice.matrix.tolist()]
+    sites = [(str(site.species_and_occu),
+              [round(x, FINGERPRINT_DECIMALS) % 1.0 for x in site.frac_coords])
+             for site in structure.sites]
+    m_str = json.dumps([lattice, sorted(sites), tolerance], sort_keys=True)
+    return hashlib.md5(m_str).hexdigest()
+
+
+def get_symmetry_data(structure, tolerance=SPACEGROUP_TOLERANCE):
+    """
+    Compute all the symmetry fields needed by an MPStructureNL using a
+    single SymmetryFinder.
+
+    :param structure: (Structure)
+    :param tolerance: (float) symmetry tolerance passed to SymmetryFinder
+    :return: (dict) with keys sg_num, sg_symbol, hall, xtal_system and
+    lattice_type
+    """
+    sf = SymmetryFinder(structure, tolerance)
+    return {'sg_num': sf.get_spacegroup_number(),
+            'sg_symbol': sf.get_spacegroup_symbol(),
+            'hall': sf.get_hall(),
+            'xtal_system': sf.get_crystal_system(),
+            'lattice_type': sf.get_lattice_type()}
+
+
+def _symmetry_data_from_dict(args):
+    # top-level helper so that it can be pickled by multiprocessing
+    s_dict, tolerance = args
+    return get_symmetry_data(Structure.from_dict(s_dict), tolerance)
+
+
+class SymmetryService():
+    """
+    Computes symmetry data for structures, caching the results by
+    structure fingerprint and tolerance. Batches of structures can be
+    spread over a process pool.
+    """
+
+    def __init__(self, tolerance=SPACEGROUP_TOLERANCE, max_cache_size=10000,
+                 nprocs=None):
+        """
+        :param tolerance: (float) symmetry tolerance passed to SymmetryFinder
+        :param max_cache_size: (int) number of results to keep, oldest
+        results are evicted first
+        :param nprocs: (int) number of processes used by get_symmetry_batch(),
+        defaults to the number of CPUs
+        """
+        self.tolerance = tolerance
+        self.max_cache_size = max_cache_size
+        self.nprocs = nprocs if nprocs else multiprocessing.cpu_count()
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_get(self, key):
+        if key in self._cache:
+            self.hits += 1
+            # move to the end so that it is evicted last
+            value = self._cache.pop(key)
+            self._cache[key] = value
+            return dict(value)
+        self.misses += 1
+        return None
+
+    def _cache_put(self, key, value):
+        self._cache[key] = dict(value)
+        while len(self._cache) > self.max_cache_size:
+            self._cache.popitem(last=False)
+
+    def get_symmetry(self, structure):
+        key = get_structure_fingerprint(structure, self.tolerance)
+        sym_data = self._cache_get(key)
+        if sym_data is None:
+            sym_data = get_symmetry_data(structure, self.tolerance)
+            self._cache_put(key, sym_data)
+        return sym_data
+
+    def get_symmetry_batch(self, structures):
+        """
+        Returns a list of symmetry data dicts, in the same order as the
+        structures. Only the structures missing from the cache are computed,
+        in parallel if there is more than one of them.
+        """
+        keys = [get_structure_fingerprint(s, self.tolerance)
+                for s in structures]
+        results = [self._cache_get(k) for k in keys]
+
+        todo = OrderedDict()
+        for idx, (key, result) in enumerate(zip(keys, results)):
+            if result is None and key not in todo:
+                todo[key] = structures[idx]
+
+        if len(todo) == 1 or (todo and self.nprocs == 1):
+            new_data = [get_symmetry_data(s, self.tolerance)
+                        for s in todo.values()]
+        elif todo:
+            pool = multiprocessing.Pool(min(self.nprocs, len(todo)))
+            try:
+                new_data = pool.map(_symmetry_data_from_dict,
+                                    [(s.to_dict, self.tolerance)
+                                     for s in todo.values()])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            new_data = []
+
+        computed = dict(zip(todo.keys(), new_data))
+        for key, value in computed.items():
+            self._cache_put(key, value)
+
+        return [r if r is not None else dict(computed[k])
+                for k, r in zip(keys, results)]
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+_default_service = None
+
+
+def get_symmetry_service():
+    """
+    Returns the SymmetryService shared by the current process, so that
+    repeated adapter instantiations (e.g. in the drone) share one cache.
+    """
+    global _default_service
+    if _default_service is None:
+        _default_service = SymmetryService()
+    return _default_service
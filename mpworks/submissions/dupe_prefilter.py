@@ -0,0 +1,133 @@
+import hashlib
+import math
+import time
+from mpworks.snl_utils.mpsnl import MPStructureNL
+from mpworks.snl_utils.symmetry import get_symmetry_service
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 15, 2013'
+
+
+class BloomFilter():
+    """
+    A plain bit-array Bloom filter for String keys. Membership tests can
+    return false positives (at about error_rate) but never false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(int(capacity), 1)
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(int(round(self.num_bits / float(capacity) * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # double hashing, see Kirsch and Mitzenmacher (2006)
+        digest = hashlib.md5(key).hexdigest()
+        h1 = int(digest[:16], 16)
+        h2 = int(digest[16:], 16)
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos // 8] |= 1 << (pos % 8)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[pos // 8] & (1 << (pos % 8)) for pos in self._positions(key))
+
+
+def _get_prefilter_key(snlgroup_key, dupe_key):
+    return '{}||{}'.format(snlgroup_key, dupe_key).encode('utf-8')
+
+
+class SubmissionDupePrefilter():
+    """
+    Bloom filter of (snlgroup_key, dupe key) pairs of the FireWorks in the
+    LaunchPad, where the dupe key encodes task_type and run_tags (see
+    DupeFinderVasp). The SubmissionProcessor consults it before adding a
+    workflow: a miss means the workflow is certainly new; a hit is confirmed
+    against the SNL database and the LaunchPad before the submission is
+    reported as a duplicate.
+    """
+
+    def __init__(self, launchpad, snl_adapter, capacity=1000000, error_rate=0.01,
+                 rebuild_interval=3600):
+        """
+        :param launchpad: (LaunchPad)
+        :param snl_adapter: (SNLMongoAdapter) used to confirm that a
+        structure belongs to an existing SNL group
+        :param capacity: (int) minimum number of keys the filter is sized for
+        :param error_rate: (float) target false positive rate
+        :param rebuild_interval: (int) seconds after which rebuild_if_stale()
+        reloads the filter from the LaunchPad
+        """
+        self.launchpad = launchpad
+        self.snl_adapter = snl_adapter
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.last_rebuild = None
+        self.bloom = BloomFilter(capacity, error_rate)
+
+    def rebuild(self):
+        query = {'spec._dupe_key': {'$exists': True},
+                 'spec.mpsnl.snlgroup_key': {'$exists': True}}
+        n_fws = self.launchpad.fireworks.find(query).count()
+        bloom = BloomFilter(max(self.capacity, 2 * n_fws), self.error_rate)
+        for fw in self.launchpad.fireworks.find(
+                query, {'spec._dupe_key': 1, 'spec.mpsnl.snlgroup_key': 1}):
+            bloom.add(_get_prefilter_key(fw['spec']['mpsnl']['snlgroup_key'],
+                                         fw['spec']['_dupe_key']))
+        self.bloom = bloom
+        self.last_rebuild = time.time()
+
+    def rebuild_if_stale(self):
+        if self.last_rebuild is None or time.time() - self.last_rebuild > self.rebuild_interval:
+            self.rebuild()
+
+    def check(self, snl, wf):
+        """
+        Check whether all the deduplicated FireWorks of a new workflow
+        already exist in the LaunchPad.
+
+        :param snl: (StructureNL) the submitted SNL
+        :param wf: (Workflow) the workflow generated for the SNL
+        :return: (bool, [str], dict) whether the workflow is a confirmed
+        duplicate, the filter keys of the workflow (to pass to add_keys()),
+        and for a duplicate, the snlgroup_id and fw_ids of the existing
+        FireWorks
+        """
+        dupe_keys = [fw.spec['_dupe_key'] for fw in wf.fws if '_dupe_key' in fw.spec]
+        if not dupe_keys:
+            return False, [], None
+
+        sym_data = get_symmetry_service().get_symmetry(snl.structure)
+        mpsnl = MPStructureNL.from_snl(snl, -1, sym_data['sg_num'], sym_data['sg_symbol'],
+                                       sym_data['hall'], sym_data['xtal_system'],
+                                       sym_data['lattice_type'])
+        keys = [_get_prefilter_key(mpsnl.snlgroup_key, k) for k in dupe_keys]
+
+        if not all([k in self.bloom for k in keys]):
+            return False, keys, None
+
+        # possible duplicate, confirm against the databases
+        snlgroup_id = self.snl_adapter.lookup_snlgroup_id(mpsnl)
+        if snlgroup_id is None:
+            return False, keys, None
+        fw_ids = []
+        for dupe_key in dupe_keys:
+            ids = self.launchpad.get_fw_ids({'spec._dupe_key': dupe_key,
+                                             'spec.snlgroup_id': snlgroup_id}, limit=1)
+            if not ids:
+                return False, keys, None
+            fw_ids.extend(ids)
+        return True, keys, {'snlgroup_id': snlgroup_id, 'fw_ids': fw_ids}
+
+    def add_keys(self, keys):
+        for k in keys:
+            self.bloom.add(k)
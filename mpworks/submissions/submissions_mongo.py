@@ -3,10 +3,16 @@ import traceback
 import datetime
 from pymongo import MongoClient
 import time
+from fireworks.core.firework import Workflow
 from fireworks.core.fw_config import FWConfig
 from fireworks.core.launchpad import LaunchPad
 from fireworks.utilities.fw_serializers import FWSerializable
+from mpworks.dupefinders.dupefinder_vasp import ensure_dupe_indices
+from mpworks.firetasks.mongo_profiler import profiled, profile_collection, \
+    profile_launchpad
 from mpworks.snl_utils.mpsnl import get_meta_from_structure
+from mpworks.snl_utils.snl_mongo import SNLMongoAdapter
+from mpworks.submissions.dupe_prefilter import SubmissionDupePrefilter
 from mpworks.workflows.snl_to_wf import snl_to_wf
 from pymatgen.matproj.snl import StructureNL
 
@@ -36,8 +42,8 @@ class SubmissionMongoAdapter(FWSerializable):
         if self.username:
             self.database.authenticate(username, password)
 
-        self.jobs = self.database.jobs
-        self.id_assigner = self.database.id_assigner
+        self.jobs = profile_collection(self.database.jobs)
+        self.id_assigner = profile_collection(self.database.id_assigner)
 
         self._update_indices()
 
@@ -58,6 +64,7 @@ class SubmissionMongoAdapter(FWSerializable):
         self.id_assigner.remove()
         self.id_assigner.insert({"next_submission_id": next_submission_id})
 
+    @profiled
     def submit_snl(self, snl, submitter_email, parameters=None):
         parameters = parameters if parameters else {}
 
@@ -74,6 +81,7 @@ class SubmissionMongoAdapter(FWSerializable):
 
         return d['submission_id']
 
+    @profiled
     def resubmit(self, submission_id):
         self.jobs.update(
             {'submission_id': submission_id}, {'$set': {'state': 'submitted', 'state_details': {}, 'task_dict': {}}})
@@ -85,6 +93,7 @@ class SubmissionMongoAdapter(FWSerializable):
         # in the SubmissionProcessor, detect this state and defuse the FW
         raise NotImplementedError()
 
+    @profiled
     def get_state(self, submission_id):
         info = self.jobs.find_one({'submission_id': submission_id}, {'state': 1, 'state_details': 1, 'task_dict': 1})
         return info['state'], info['state_details'], info['task_dict']
@@ -97,6 +106,7 @@ class SubmissionMongoAdapter(FWSerializable):
              'password': self.password}
         return d
 
+    @profiled
     def update_state(self, submission_id, state, state_details, task_dict):
         self.jobs.find_and_modify({'submission_id': submission_id}, {'$set': {'state': state}})
 
@@ -113,23 +123,29 @@ class SubmissionMongoAdapter(FWSerializable):
 
 class SubmissionProcessor():
     # This is run on the server end
-    def __init__(self, sma, launchpad):
+    def __init__(self, sma, launchpad, prefilter=None):
         self.sma = sma
         self.jobs = sma.jobs
-        self.launchpad = launchpad
+        self.launchpad = profile_launchpad(launchpad)
+        ensure_dupe_indices(self.launchpad)
+        self.prefilter = prefilter  # (SubmissionDupePrefilter) optional
 
     def run(self):
         while True:
             self.submit_all_new_workflows()
             self.update_existing_workflows()
+            self.update_duplicates()
             print 'sleeping 30s'
             time.sleep(30)
 
     def submit_all_new_workflows(self):
+        if self.prefilter:
+            self.prefilter.rebuild_if_stale()
         last_id = -1
         while last_id:
             last_id = self.submit_new_workflow()
 
+    @profiled
     def submit_new_workflow(self):
         # finds a submitted job, creates a workflow, and submits it to FireWorks
         job = self.jobs.find_and_modify({'state': 'submitted'}, {'$set': {'state': 'waiting'}})
@@ -142,7 +158,23 @@ class SubmissionProcessor():
 
                 # create a workflow
                 wf = snl_to_wf(snl)
+                if self.prefilter:
+                    is_dupe, keys, dupe_of = self.prefilter.check(snl, wf)
+                    if is_dupe:
+                        # the SNL still goes to the SNL database, and the
+                        # submission follows the existing FireWorks
+                        snl_fw = [fw for fw in wf.fws if fw.spec['task_type'] ==
+                                  'Add to SNL database'][0]
+                        snl_fw.spec['submission_id'] = submission_id
+                        self.launchpad.add_wf(Workflow([snl_fw], name=wf.name))
+                        self.jobs.find_and_modify({'submission_id': submission_id},
+                                                  {'$set': {'state': 'duplicate',
+                                                            'duplicate_of': dupe_of}})
+                        print 'SKIPPED DUPLICATE WORKFLOW FOR {}'.format(snl.structure.formula)
+                        return submission_id
                 self.launchpad.add_wf(wf)
+                if self.prefilter:
+                    self.prefilter.add_keys(keys)
                 print 'ADDED WORKFLOW FOR {}'.format(snl.structure.formula)
             except:
                 self.jobs.find_and_modify({'submission_id': submission_id}, {'$set': {'state': 'error'}})
@@ -150,6 +182,7 @@ class SubmissionProcessor():
 
             return submission_id
 
+    @profiled
     def update_existing_workflows(self):
         # updates the state of existing workflows by querying the FireWorks database
         for submission_id in self.jobs.find({'status': {'$in': ['waiting', 'running']}}, {'submission_id': 1}):
@@ -165,6 +198,35 @@ class SubmissionProcessor():
                 print 'ERROR while processing s_id', submission_id
                 traceback.print_exc()
 
+    @profiled
+    def update_duplicates(self):
+        # the task_dict of a duplicate submission comes from the existing FireWorks
+        for job in self.jobs.find({'state': 'duplicate', 'duplicate_of': {'$ne': None}},
+                                  {'submission_id': 1, 'duplicate_of': 1}):
+            try:
+                task_dict = {}
+                for fw_id in job['duplicate_of']['fw_ids']:
+                    task_dict.update(self._get_task_dict(self.launchpad.get_wf_by_fw_id(fw_id)))
+                self.jobs.update({'submission_id': job['submission_id']},
+                                 {'$set': {'task_dict': task_dict}})
+            except:
+                print 'ERROR while processing s_id', job['submission_id']
+                traceback.print_exc()
+
+    @staticmethod
+    def _get_task_dict(wf):
+        # task_ids of the runs inserted so far, by task type
+        m_taskdict = {}
+        for fw in wf.fws:
+            if fw.state == 'COMPLETED' and fw.spec['task_type'] == 'VASP db insertion':
+                for l in fw.launches:
+                    if l.state == 'COMPLETED':
+                        t_id = l.action.stored_data['task_id']
+                        m_taskdict[fw.spec['prev_task_type']] = t_id
+                        break
+        return m_taskdict
+
+    @profiled
     def update_wf_state(self, wf, submission_id):
         # state of the workflow
 
@@ -192,13 +254,7 @@ class SubmissionProcessor():
         m_taskdict = {}
         states = [fw.state for fw in self.fws]
         if any([s == 'COMPLETED' for s in states]):
-            for fw in wf.fws:
-                if fw.state == 'COMPLETED' and fw.spec['task_type'] == 'VASP db insertion':
-                    for l in fw.launches:
-                        if l.state == 'COMPLETED':
-                            t_id = l.action.stored_data['task_id']
-                            m_taskdict[fw.spec['prev_task_type']] = t_id
-                            break
+            m_taskdict = self._get_task_dict(wf)
 
         self.sma.update_state(wf.state, details, m_taskdict)
         return wf.state, details, m_taskdict
@@ -211,7 +267,9 @@ class SubmissionProcessor():
         l_file = os.path.join(l_dir, 'my_launchpad.yaml')
         lp = LaunchPad.from_file(l_file)
 
-        return SubmissionProcessor(sma, lp)
+        prefilter = SubmissionDupePrefilter(lp, SNLMongoAdapter.auto_load())
+
+        return SubmissionProcessor(sma, lp, prefilter)
 
 
 if __name__ == '__main__':
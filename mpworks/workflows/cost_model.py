@@ -0,0 +1,195 @@
+"""
+Wall time model learned from the tasks collection. A log-linear
+(ridge) regression is fit on the structure metadata (nsites, nelements),
+ENCUT, the number of irreducible k-points, LDAU, the number of cores and
+the kind of task. The model is small enough to be kept as a JSON file on
+each machine that generates workflows or submits jobs.
+
+The model file is $MP_COST_MODEL, or task_cost_model.json in the FireWorks
+config dir; use scripts/train_cost_model to (re)create it.
+"""
+
+import datetime
+import json
+import logging
+import math
+import os
+import numpy as np
+from fireworks.core.fw_config import FWConfig
+from mpworks.firetasks.parallel_advisor import get_elapsed_time
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 27, 2013'
+
+logger = logging.getLogger(__name__)
+
+COST_MODEL_FILE = 'task_cost_model.json'
+
+# the first family is the baseline of the one-hot encoding
+TASK_FAMILIES = ['optimize structure', 'static', 'Uniform', 'band structure',
+                 'electronic structure']
+FEATURES = ['intercept', 'log_nsites', 'nelements', 'log_encut', 'log_nkpts', 'ldau',
+            'log_ncores'] + ['is_' + f.replace(' ', '_') for f in TASK_FAMILIES[1:]]
+
+DEFAULT_ENCUT = 520  # MPVaspInputSet
+DEFAULT_NCORES = 24
+MIN_SAMPLES = 20
+# the walltime request covers this quantile of the residuals (~95%)
+REQUEST_Z = 1.645
+
+
+def _get_features(nsites, nelements, encut, nkpts, ldau, ncores, task_type):
+    families = [1.0 if f in task_type else 0.0 for f in TASK_FAMILIES[1:]]
+    return [1.0, math.log(nsites), float(nelements), math.log(encut),
+            math.log(max(nkpts, 1)), 1.0 if ldau else 0.0, math.log(ncores)] + families
+
+
+def get_task_features(task):
+    """
+    :param task: (dict) a task document, as inserted by MPVaspDrone
+    :return: (features, wall time in secs), or None if the document lacks the
+    data
+    """
+    try:
+        calc = task['calculations'][-1]
+        incar = calc['input']['incar']
+        encut = incar.get('ENCUT', calc['input'].get('parameters', {}).get('ENCUT', DEFAULT_ENCUT))
+        nkpts = len(calc['input']['kpoints']['actual_points'])
+        ldau = incar.get('LDAU', False)
+        ncores = task.get('launch_layout', {}).get('nranks', DEFAULT_NCORES)
+        elapsed = get_elapsed_time(task['run_stats'])
+    except (KeyError, IndexError, ValueError):
+        return None
+    if not elapsed:
+        return None
+    features = _get_features(task['nsites'], task['nelements'], encut, nkpts, ldau,
+                             ncores, task['task_type'])
+    return features, elapsed
+
+
+def _fit(X, y, ridge):
+    # ridge regression, the intercept is not penalized
+    penalty = math.sqrt(ridge) * np.eye(X.shape[1])
+    penalty[0, 0] = 0
+    coefs = np.linalg.lstsq(np.vstack([X, penalty]),
+                            np.concatenate([y, np.zeros(X.shape[1])]))[0]
+    residuals = y - X.dot(coefs)
+    return coefs.tolist(), float(np.sqrt(np.mean(residuals ** 2)))
+
+
+class TaskCostModel():
+
+    def __init__(self, walltime_coefs, walltime_sigma, n_samples=0, trained_at=None):
+        """
+        :param walltime_coefs: ([float]) coefficients for log(wall time in secs)
+        :param walltime_sigma: (float) RMS residual of log(wall time)
+        :param n_samples: (int) number of tasks the model was fit on
+        :param trained_at: (datetime)
+        """
+        self.walltime_coefs = walltime_coefs
+        self.walltime_sigma = walltime_sigma
+        self.n_samples = n_samples
+        self.trained_at = trained_at
+
+    def predict_features(self, features, ncores):
+        log_walltime = sum([c * x for c, x in zip(self.walltime_coefs, features)])
+        walltime = math.exp(log_walltime)
+        return {'walltime': walltime,
+                'walltime_request': math.exp(log_walltime + REQUEST_Z * self.walltime_sigma),
+                'walltime_safety': math.exp(REQUEST_Z * self.walltime_sigma),
+                'core_hours': walltime * ncores / 3600.0, 'ncores': ncores}
+
+    def predict_estimate(self, cost_estimate, task_type, ncores=DEFAULT_NCORES):
+        """
+        :param cost_estimate: (dict) as stored in a spec by the scheduling
+        hints (nsites, nelements, nkpts, ldau and optionally encut)
+        :param task_type: (str)
+        :param ncores: (int) number of cores the run would get
+        :return: (dict) expected 'walltime' (secs), a 'walltime_request' that
+        covers ~95% of similar runs and 'core_hours'
+        """
+        ce = cost_estimate
+        return self.predict_features(_get_features(ce['nsites'], ce['nelements'],
+                                                   ce.get('encut', DEFAULT_ENCUT), ce['nkpts'],
+                                                   ce['ldau'], ncores, task_type), ncores)
+
+    @staticmethod
+    def fit(tasks_coll, query=None, limit=0, ridge=1.0):
+        """
+        :param tasks_coll: (pymongo Collection) the tasks collection
+        :param query: (dict) restricts the tasks used, defaults to successful ones
+        :param limit: (int) max number of tasks to use (0 for all)
+        :param ridge: (float) regularization strength
+        """
+        query = query if query is not None else {'state': 'successful'}
+        fields = {'nsites': 1, 'nelements': 1, 'task_type': 1, 'run_stats': 1,
+                  'launch_layout': 1, 'calculations.input.incar': 1,
+                  'calculations.input.parameters.ENCUT': 1,
+                  'calculations.input.kpoints.actual_points': 1}
+        X, walltimes = [], []
+        for t in tasks_coll.find(query, fields, limit=limit):
+            data = get_task_features(t)
+            if data:
+                X.append(data[0])
+                walltimes.append(math.log(data[1]))
+
+        if len(X) < MIN_SAMPLES:
+            raise ValueError('Only {} usable tasks, need at least {}'.format(len(X),
+                                                                           MIN_SAMPLES))
+        walltime_coefs, walltime_sigma = _fit(np.array(X), np.array(walltimes), ridge)
+        return TaskCostModel(walltime_coefs, walltime_sigma, len(X), datetime.datetime.utcnow())
+
+    @property
+    def to_dict(self):
+        return {'features': FEATURES, 'walltime_coefs': self.walltime_coefs,
+                'walltime_sigma': self.walltime_sigma, 'n_samples': self.n_samples,
+                'trained_at': self.trained_at.isoformat() if self.trained_at else None}
+
+    @staticmethod
+    def from_dict(d):
+        if d['features'] != FEATURES:
+            raise ValueError('Cost model was trained on different features, retrain it')
+        trained_at = datetime.datetime.strptime(d['trained_at'].split('.')[0],
+                                                '%Y-%m-%dT%H:%M:%S') \
+            if d.get('trained_at') else None
+        return TaskCostModel(d['walltime_coefs'], d['walltime_sigma'], d.get('n_samples', 0),
+                             trained_at)
+
+    def to_file(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict, f, indent=4)
+
+    @staticmethod
+    def from_file(filename):
+        with open(filename) as f:
+            return TaskCostModel.from_dict(json.load(f))
+
+
+def get_cost_model_file():
+    return os.environ.get('MP_COST_MODEL',
+                          os.path.join(FWConfig().CONFIG_FILE_DIR, COST_MODEL_FILE))
+
+
+_cost_model = None
+_cost_model_loaded = False
+
+
+def get_cost_model():
+    """
+    Returns the TaskCostModel of this machine (loaded once per process), or
+    None if no usable model file exists
+    """
+    global _cost_model, _cost_model_loaded
+    if not _cost_model_loaded:
+        _cost_model_loaded = True
+        model_file = get_cost_model_file()
+        if os.path.exists(model_file):
+            try:
+                _cost_model = TaskCostModel.from_file(model_file)
+            except (ValueError, KeyError):
+                logger.exception('Ignoring cost model {}'.format(model_file))
+    return _cost_model
@@ -0,0 +1,222 @@
+"""
+Deferred, batched expansion of the electronic structure workflows. With
+'deferred': True, AddEStructureTask only records the (snlgroup_id, type)
+pairs whose band gap qualifies, in the 'estructure_queue' collection of the
+tasks database, instead of adding six FireWorks to the LaunchPad each time
+it fires. expand_deferred (see scripts/expand_estructure) then claims a batch
+of them, biggest band gaps first, and:
+
+- drops the pairs that already have electronic structure FireWorks (static or
+  pipelined, by their dupe key and snlgroup_id, through the dupe index of
+  the LaunchPad) and the repeats within the batch;
+- precomputes the non-SCF k-points of all the structures at once, if the
+  controllers asked for it (see kpoint_cache);
+- adds the new FireWorks, one small workflow per pair.
+
+Each pair gets its own workflow, as with the controllers: in FireWorks, each
+checkout or completion of a FireWork loads and rewrites its whole workflow,
+so one workflow for the batch would make the runs quadratically slower. The
+new workflows are not linked to the ones of the controllers, and start from
+the prev_vasp_dir the controller recorded.
+
+Items are claimed with find_and_modify, so concurrent runs do not expand the
+same pairs; the claims of a run that died are released after stale_secs
+(whatever it added by then is caught by the dupe check).
+"""
+
+import datetime
+import json
+import logging
+import os
+import socket
+from fireworks.core.firework import Workflow
+from mpworks.dupefinders.dupefinder_vasp import get_dupe_key, ensure_dupe_indices
+from mpworks.firetasks.controller_tasks import AddEStructureTask
+from pymatgen.matproj.snl import StructureNL
+from pymongo import MongoClient
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'Jun 13, 2013'
+
+logger = logging.getLogger(__name__)
+
+QUEUE_COLLECTION = 'estructure_queue'
+# task types of the first FireWork of an electronic structure workflow
+ROOT_TASK_TYPES = ['{} static', '{} electronic structure']
+
+
+class EStructureQueue():
+    """
+    The (snlgroup_id, type) pairs waiting for their electronic structure
+    FireWorks. Items go from 'pending' to 'expanding' (claimed by a batch)
+    to 'expanded' or 'duplicate'.
+    """
+
+    def __init__(self, coll):
+        """
+        :param coll: (pymongo Collection)
+        """
+        self.coll = coll
+        # the batch takes the pending pairs by decreasing band gap
+        self.coll.ensure_index([('state', 1), ('bandgap', -1)])
+
+    def defer(self, fw_spec, type_name, parameters):
+        """
+        :param fw_spec: (dict) spec of the AddEStructureTask
+        :param type_name: (str) 'GGA' or 'GGA+U'
+        :param parameters: (dict) of the AddEStructureTask
+        """
+        return self.coll.insert({'snlgroup_id': fw_spec['snlgroup_id'], 'type_name': type_name,
+                                 'bandgap': fw_spec['analysis']['bandgap'],
+                                 'fw_spec': fw_spec, 'parameters': parameters,
+                                 'state': 'pending', 'created_at': datetime.datetime.utcnow()})
+
+    def get_pending(self, min_bandgap=None, limit=0):
+        query = {'state': 'pending'}
+        if min_bandgap is not None:
+            query['bandgap'] = {'$gte': min_bandgap}
+        return list(self.coll.find(query, sort=[('bandgap', -1)], limit=limit))
+
+    def claim(self, n, worker_id, min_bandgap=None):
+        """
+        :return: ([dict]) up to n pending items, biggest band gaps first, now
+        'expanding'
+        """
+        query = {'state': 'pending'}
+        if min_bandgap is not None:
+            query['bandgap'] = {'$gte': min_bandgap}
+        items = []
+        for _ in range(n):
+            item = self.coll.find_and_modify(
+                query=query, sort=[('bandgap', -1)], new=True,
+                update={'$set': {'state': 'expanding', 'claimed_by': worker_id,
+                                 'claimed_at': datetime.datetime.utcnow()}})
+            if not item:
+                break
+            items.append(item)
+        return items
+
+    def release_stale(self, stale_secs):
+        """
+        :return: (int) number of items claimed more than stale_secs ago put
+        back to 'pending'
+        """
+        oldest = datetime.datetime.utcnow() - datetime.timedelta(seconds=stale_secs)
+        result = self.coll.update({'state': 'expanding', 'claimed_at': {'$lt': oldest}},
+                                  {'$set': {'state': 'pending'}}, multi=True)
+        return result.get('n', 0) if result else 0
+
+    def mark(self, items, state, **kwargs):
+        if items:
+            kwargs.update({'state': state, 'updated_at': datetime.datetime.utcnow()})
+            self.coll.update({'_id': {'$in': [item['_id'] for item in items]}},
+                             {'$set': kwargs}, multi=True)
+
+    def get_counts(self):
+        return dict([(state, self.coll.find({'state': state}).count())
+                     for state in ['pending', 'expanding', 'expanded', 'duplicate']])
+
+    @classmethod
+    def auto_load(cls):
+        """
+        The queue in the tasks database of $DB_LOC/tasks_db.json
+        """
+        with open(os.path.join(os.environ['DB_LOC'], 'tasks_db.json')) as f:
+            db_creds = json.load(f)
+        db = MongoClient(db_creds['host'], db_creds['port'])[db_creds['database']]
+        db.authenticate(db_creds['admin_user'], db_creds['admin_password'])
+        return EStructureQueue(db[QUEUE_COLLECTION])
+
+
+def _get_root_keys(item):
+    # dupe keys of the FireWorks that would make this pair a duplicate
+    from mpworks.workflows.snl_to_wf import _get_metadata
+    run_tags = _get_metadata(StructureNL.from_dict(item['fw_spec']['mpsnl']))['run_tags']
+    return [get_dupe_key({'task_type': t.format(item['type_name']), 'run_tags': run_tags})
+            for t in ROOT_TASK_TYPES]
+
+
+def find_existing(launchpad, items):
+    """
+    :return: (set) the (snlgroup_id, dupe key) of the items that already have
+    electronic structure FireWorks in the LaunchPad
+    """
+    keys = set()
+    for item in items:
+        keys.update(_get_root_keys(item))
+    snlgroup_ids = list(set([item['snlgroup_id'] for item in items]))
+    existing = set()
+    for fw in launchpad.fireworks.find({'spec._dupe_key': {'$in': list(keys)},
+                                        'spec.snlgroup_id': {'$in': snlgroup_ids}},
+                                       {'spec._dupe_key': 1, 'spec.snlgroup_id': 1}):
+        existing.add((fw['spec']['snlgroup_id'], fw['spec']['_dupe_key']))
+    return existing
+
+
+def expand_deferred(queue, launchpad, min_bandgap=None, max_batch=500, dry_run=False,
+                    stale_secs=3600):
+    """
+    Add the FireWorks of a batch of pending pairs to the LaunchPad
+
+    :param queue: (EStructureQueue)
+    :param launchpad: (LaunchPad)
+    :param min_bandgap: (float) only expand the pairs with at least this band
+    gap (they already passed the gap_cutoff of their controller)
+    :param max_batch: (int) pairs per batch, biggest band gaps first
+    :param dry_run: (bool) don't change the LaunchPad or the queue
+    :param stale_secs: (int) after which the claims of another run are
+    released
+    :return: (dict) number of pairs in the batch, expanded, duplicates, and
+    FireWorks added
+    """
+    ensure_dupe_indices(launchpad)
+    if dry_run:
+        items = queue.get_pending(min_bandgap, max_batch)
+    else:
+        n_stale = queue.release_stale(stale_secs)
+        if n_stale:
+            logger.warn('Released {} stale claims'.format(n_stale))
+        worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        items = queue.claim(max_batch, worker_id, min_bandgap)
+    existing = find_existing(launchpad, items) if items else set()
+
+    seen = set()
+    todo, duplicates = [], []
+    for item in items:
+        pair = (item['snlgroup_id'], item['type_name'])
+        root_keys = set([(item['snlgroup_id'], k) for k in _get_root_keys(item)])
+        if pair in seen or root_keys & existing:
+            duplicates.append(item)
+            continue
+        seen.add(pair)
+        todo.append(item)
+
+    wfs = []
+    to_precompute = []
+    for item in todo:
+        task = AddEStructureTask(item['parameters'])
+        snl = StructureNL.from_dict(item['fw_spec']['mpsnl'])
+        if task.precompute_kpoints:
+            to_precompute.append(snl.structure)
+        fws, connections = task.get_fws(item['fw_spec'], snl, item['type_name'])
+        wfs.append((item, Workflow(fws, connections)))
+
+    stats = {'n_pairs': len(items), 'expanded': len(todo), 'duplicates': len(duplicates),
+             'n_fireworks': sum([len(wf.fws) for _, wf in wfs])}
+    if dry_run:
+        return stats
+
+    queue.mark(duplicates, 'duplicate')
+    if to_precompute:
+        # all the structures of the batch in one process pool
+        AddEStructureTask._precompute_kpoints(to_precompute)
+    for item, wf in wfs:
+        launchpad.add_wf(wf)
+        queue.mark([item], 'expanded')
+    logger.info('Expanded {expanded} of {n_pairs} pairs ({duplicates} duplicates) into '
+                '{n_fireworks} FireWorks'.format(**stats))
+    return stats
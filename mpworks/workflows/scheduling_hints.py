@@ -0,0 +1,137 @@
+"""
+Rough cost estimates for the VASP FireWorks of a workflow, turned into
+scheduling hints: a _priority (cheap runs first, for better turnaround) and
+a walltime/nnodes request through _queueadapter. When a TaskCostModel has
+been trained on past tasks, its predictions replace the heuristic estimate.
+DB insertion and controller FireWorks take seconds, so they go to a separate
+category with top priority instead of waiting behind VASP jobs; with
+$MP_INSERTION_DAEMON set, the DB insertions get a category of their own,
+which only the insertion daemon serves (see insertion_service).
+"""
+
+import math
+import os
+from mpworks.firetasks.parallel_advisor import get_num_ir_kpoints
+from mpworks.workflows.cost_model import get_cost_model
+from pymatgen.io.vaspio.vasp_input import Kpoints
+from pymatgen.io.vaspio_set import MPGGAVaspInputSet
+
+__author__ = 'Anubhav Jain'
+__copyright__ = 'Copyright 2013, The Materials Project'
+__version__ = '0.1'
+__maintainer__ = 'Anubhav Jain'
+__email__ = 'ajain@lbl.gov'
+__date__ = 'May 24, 2013'
+
+# FireWorkers with this category only pick up the quick, non-VASP FireWorks
+FAST_CATEGORY = 'fast'
+FAST_PRIORITY = 10
+# the category of the DB insertions when they are left to the insertion daemon
+INSERTION_CATEGORY = 'db_insertion'
+
+# core hours per (site^2 * irreducible k-point) of a GGA double relaxation,
+# i.e. ~0.7 core hours for Si (2 sites, ~30 k-points)
+COST_SCALE = 0.006
+LDAU_FACTOR = 1.5
+# relative cost of the other task types vs. a double relaxation
+TASK_TYPE_FACTORS = {'optimize structure (2x)': 1.0, 'static': 0.25,
+                     'Uniform': 0.5, 'band structure': 0.5,
+                     'electronic structure': 1.25}
+
+CORES_PER_NODE = 24
+MIN_WALLTIME = 1800  # secs
+MAX_WALLTIME = 48 * 3600
+WALLTIME_SAFETY = 2.0
+
+
+def get_fast_spec():
+    return {'_category': FAST_CATEGORY, '_priority': FAST_PRIORITY}
+
+
+def get_insertion_spec():
+    spec = get_fast_spec()
+    if os.environ.get('MP_INSERTION_DAEMON'):
+        spec['_category'] = INSERTION_CATEGORY
+    return spec
+
+
+def _get_task_type_factor(task_type):
+    for k, v in TASK_TYPE_FACTORS.items():
+        if k in task_type:
+            return v
+    return 1.0
+
+
+def estimate_cost(structure, task_type, incar=None, kpoints=None):
+    """
+    :param structure: (Structure)
+    :param task_type: (str) e.g. 'GGA+U optimize structure (2x)'
+    :param incar: (dict) INCAR settings, if None LDAU is guessed from task_type
+    :param kpoints: (Kpoints) if None, the MPGGAVaspInputSet one is assumed
+    :return: (dict) the quantities used and the estimated 'core_hours'
+    """
+    mpvis = MPGGAVaspInputSet()
+    kpoints = kpoints if kpoints else mpvis.get_kpoints(structure)
+    ldau = bool(incar.get('LDAU', False)) if incar else 'GGA+U' in task_type
+    nsites = len(structure)
+    nelements = len(structure.composition.elements)
+    nkpts = get_num_ir_kpoints(structure, kpoints)
+
+    core_hours = COST_SCALE * nsites ** 2 * nkpts * _get_task_type_factor(task_type)
+    # more species tends to mean more electrons per site and harder convergence
+    core_hours *= 1 + 0.1 * (nelements - 1)
+    if ldau:
+        core_hours *= LDAU_FACTOR
+
+    cost = {'nsites': nsites, 'nelements': nelements, 'ldau': ldau, 'nkpts': nkpts,
+            'core_hours': core_hours}
+    if incar and 'ENCUT' in incar:
+        cost['encut'] = incar['ENCUT']
+    return cost
+
+
+def get_priority(core_hours):
+    # ~5 for Si, ~2 for a 200-atom oxide, never above the fast FireWorks
+    return max(1, min(FAST_PRIORITY - 1, int(round(5 - math.log10(max(core_hours, 1e-3))))))
+
+
+def get_scheduling_hints(cost, safety=WALLTIME_SAFETY):
+    """
+    :param cost: (dict) as returned by estimate_cost()
+    :param safety: (float) factor between the expected and requested walltime
+    :return: (dict) spec keys to add to the FireWork
+    """
+    needed = cost['core_hours'] * safety * 3600
+    nnodes = max(1, int(math.ceil(needed / (CORES_PER_NODE * MAX_WALLTIME))))
+    walltime = int(min(max(needed / (CORES_PER_NODE * nnodes), MIN_WALLTIME), MAX_WALLTIME))
+    walltime_str = '{:02d}:{:02d}:00'.format(walltime // 3600, walltime % 3600 // 60)
+
+    estimate = dict(cost)
+    estimate.update({'walltime': walltime, 'ncores': CORES_PER_NODE * nnodes})
+    return {'_priority': get_priority(cost['core_hours']),
+            '_queueadapter': {'walltime': walltime_str, 'nnodes': nnodes},
+            'cost_estimate': estimate}
+
+
+def add_scheduling_hints(spec, structure):
+    """
+    Set the _priority, _queueadapter and cost_estimate of a VASP FireWork
+    spec, using the inputs in spec['vasp'] when they are there
+    """
+    incar, kpoints = None, None
+    if 'vasp' in spec:
+        incar = spec['vasp']['incar']
+        kpoints = Kpoints.from_dict(spec['vasp']['kpoints'])
+    cost = estimate_cost(structure, spec['task_type'], incar, kpoints)
+    cost['source'] = 'heuristic'
+    safety = WALLTIME_SAFETY
+
+    # prefer the model learned from past tasks, if this machine has one
+    model = get_cost_model()
+    if model:
+        # from the quantities just estimated: not all the specs have the
+        # structure (e.g. the non-SCF ones get it from their parent)
+        prediction = model.predict_estimate(cost, spec['task_type'], CORES_PER_NODE)
+        cost.update({'core_hours': prediction['core_hours'], 'source': 'model'})
+        safety = prediction['walltime_safety']
+    spec.update(get_scheduling_hints(cost, safety))
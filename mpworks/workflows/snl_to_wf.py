@@ -2,7 +2,7 @@ import os
 from custodian.vasp.jobs import VaspJob
 from custodian.vasp.handlers import VaspErrorHandler, FrozenJobErrorHandler, MeshSymmetryErrorHandler
 from fireworks.core.firework import FireWork, Workflow
-from mpworks.dupefinders.dupefinder_vasp import DupeFinderVasp
+from mpworks.dupefinders.dupefinder_vasp import DupeFinderVasp, get_dupe_key
 from mpworks.firetasks.controller_tasks import AddEStructureTask
 from mpworks.firetasks.custodian_task import VaspCustodianTask
 from mpworks.firetasks.snl_tasks import AddSNLTask
@@ -10,6 +10,8 @@ from mpworks.firetasks.vasp_io_tasks import VaspCopyTask, VaspWriterTask, \
     VaspToDBTask
 from mpworks.firetasks.vasp_setup_tasks import SetupGGAUTask, \
     SetupStaticRunTask, SetupNonSCFTask
+from mpworks.workflows.scheduling_hints import add_scheduling_hints, \
+    get_fast_spec, get_insertion_spec
 from pymatgen import Composition
 from pymatgen.io.cifio import CifParser
 from pymatgen.io.vaspio_set import MPVaspInputSet, MPGGAVaspInputSet
@@ -24,7 +26,6 @@ __date__ = 'Mar 15, 2013'
 
 # TODO: add duplicate checks for DB task - don't want to add the same dir
 # twice!!
-# TODO: different walltime requirements and priority for DB task
 
 
 def _get_custodian_task(spec):
@@ -50,12 +51,10 @@ def _snl_to_spec(snl, enforce_gga=True):
 
     spec['vasp'] = {}
     spec['vasp']['incar'] = mpvis.get_incar(structure).to_dict
-    spec['vasp']['incar']['NPAR'] = 2
     spec['vasp']['poscar'] = mpvis.get_poscar(structure).to_dict
     spec['vasp']['kpoints'] = mpvis.get_kpoints(structure).to_dict
     spec['vasp']['potcar'] = mpvis.get_potcar(structure).to_dict
     spec['_dupefinder'] = DupeFinderVasp().to_dict()
-    spec['_priority'] = 2
     # TODO: restore category
     # spec['_category'] = 'Materials Project'
     spec['vaspinputset_name'] = mpvis.__class__.__name__
@@ -63,6 +62,9 @@ def _snl_to_spec(snl, enforce_gga=True):
         'incar'].get('LDAU', False) else 'GGA optimize structure (2x)'
 
     spec.update(_get_metadata(snl))
+    spec['_dupe_key'] = get_dupe_key(spec)
+    # priority and walltime/nodes request from the estimated cost of the run
+    add_scheduling_hints(spec, structure)
 
     return spec
 
@@ -76,7 +78,8 @@ def _get_metadata(snl):
     return md
 
 
-def snl_to_wf(snl, do_bandstructure=True):
+def snl_to_wf(snl, do_bandstructure=True, pipelined_bandstructure=False,
+              deferred_bandstructure=False):
     # TODO: clean this up once we're out of testing mode
     # TODO: add WF metadata
     fws = []
@@ -85,6 +88,7 @@ def snl_to_wf(snl, do_bandstructure=True):
     # add the SNL to the SNL DB and figure out duplicate group
     tasks = [AddSNLTask()]
     spec = {'task_type': 'Add to SNL database', 'snl': snl.to_dict}
+    spec.update(get_fast_spec())
     fws.append(FireWork(tasks, spec, name=spec['task_type'], fw_id=0))
     connections[0] = 1
 
@@ -94,17 +98,21 @@ def snl_to_wf(snl, do_bandstructure=True):
     fws.append(FireWork(tasks, spec, name=spec['task_type'], fw_id=1))
 
     # insert into DB - GGA structure optimization
-    spec = {'task_type': 'VASP db insertion', '_priority': 2,
+    spec = {'task_type': 'VASP db insertion',
             '_allow_fizzled_parents': True}
+    spec.update(get_insertion_spec())
     spec.update(_get_metadata(snl))
     fws.append(FireWork([VaspToDBTask()], spec, name=spec['task_type'], fw_id=2))
     connections[1] = 2
 
     if do_bandstructure:
         spec = {'task_type': 'Controller: add Electronic Structure'}
+        spec.update(get_fast_spec())
         spec.update(_get_metadata(snl))
         fws.append(
-            FireWork([AddEStructureTask()], spec, name=spec['task_type'], fw_id=3))
+            FireWork([AddEStructureTask({'pipelined': pipelined_bandstructure,
+                                         'deferred': deferred_bandstructure})], spec,
+                     name=spec['task_type'], fw_id=3))
         connections[2] = 3
 
     # determine if GGA+U FW is needed
@@ -114,6 +122,8 @@ def snl_to_wf(snl, do_bandstructure=True):
         spec = {'task_type': 'GGA+U optimize structure (2x)',
                 '_dupefinder': DupeFinderVasp().to_dict()}
         spec.update(_get_metadata(snl))
+        spec['_dupe_key'] = get_dupe_key(spec)
+        add_scheduling_hints(spec, snl.structure)
         fws.append(FireWork(
             [VaspCopyTask({'extension': '.relax2'}), SetupGGAUTask(),
              _get_custodian_task(spec)], spec, name=spec['task_type'], fw_id=10))
@@ -121,6 +131,7 @@ def snl_to_wf(snl, do_bandstructure=True):
 
         spec = {'task_type': 'VASP db insertion',
                 '_allow_fizzled_parents': True}
+        spec.update(get_insertion_spec())
         spec.update(_get_metadata(snl))
         fws.append(
             FireWork([VaspToDBTask()], spec, name=spec['task_type'], fw_id=11))
@@ -128,8 +139,11 @@ def snl_to_wf(snl, do_bandstructure=True):
 
         if do_bandstructure:
             spec = {'task_type': 'Controller: add Electronic Structure'}
+            spec.update(get_fast_spec())
             spec.update(_get_metadata(snl))
-            fws.append(FireWork([AddEStructureTask()], spec, name=spec['task_type'], fw_id=12))
+            fws.append(FireWork([AddEStructureTask({'pipelined': pipelined_bandstructure,
+                                                    'deferred': deferred_bandstructure})],
+                                spec, name=spec['task_type'], fw_id=12))
             connections[11] = 12
 
     return Workflow(fws, connections, name=Composition.from_formula(snl.structure.composition.reduced_formula).alphabetical_formula)
@@ -148,8 +162,8 @@ def snl_to_wf_ggau(snl):
     fws.append(FireWork(tasks, spec, fw_id=1))
 
     # add GGA insertion to DB
-    spec = {'task_type': 'VASP db insertion', '_priority': 2,
-            '_category': 'VASP'}
+    spec = {'task_type': 'VASP db insertion'}
+    spec.update(get_insertion_spec())
     spec.update(_get_metadata(snl))
     fws.append(FireWork([VaspToDBTask()], spec, fw_id=2))
     connections[1] = 2
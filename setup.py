@@ -24,8 +24,9 @@ if __name__ == "__main__":
           author_email='anubhavster@gmail.com',
           license='modified BSD',
           packages=find_packages(),
+          package_data={'mpworks.drones': ['*.yaml']},
           zip_safe=False,
-          install_requires=['pymatgen>=2.5', 'fireworks>=0.1dev1.7', 'custodian>=0.2'],
+          install_requires=['pymatgen>=2.5', 'fireworks>=0.1dev1.7', 'custodian>=0.3.5'],
           classifiers=["Programming Language :: Python :: 2.7", "Development Status :: 2 - Pre-Alpha",
                        "Intended Audience :: Science/Research", "Intended Audience :: System Administrators",
                        "Intended Audience :: Information Technology",